@@ -0,0 +1,250 @@
+""" Benchmarks of MLA against the stand-in SSH server of `server.py`.
+
+    run.py [--hosts 1,10] [--todos 1,10] [--modules command,copy,...]
+           [--latency-ms 0,50] [--bandwidth-mbps 0,100] [--forks N]
+           [--runs N] [--agent] [--pools SPEC] [--output PATH]
+    run.py compare OLD.jsonl NEW.jsonl
+
+Every combination of the swept values is a scenario: a fresh server is
+started (its remote side is empty) and the todos are run `--runs` times on
+all the hosts through `main.preflight` and `main.executor`, the first run
+converges the hosts and the next ones find them already in state.
+
+Each run is appended as one JSON line to the output file (named after the
+current commit by default) with its throughput and latency percentiles,
+two output files can then be compared with `run.py compare`.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+from os import path
+from time import perf_counter, strftime
+
+BENCH_DIR = path.dirname(path.abspath(__file__))
+SRC_DIR = path.join(path.dirname(BENCH_DIR), "src")
+MODULES = ("command", "copy", "copy-large", "template", "apt", "service", "sysctl")
+
+
+def _csv(cast):
+    return lambda value: [cast(item) for item in value.split(",")]
+
+
+def _percentiles(values: list) -> dict:
+    """ p50, p90, p99 and max of `values`, in milliseconds. """
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def percentile(rank: float) -> float:
+        return round(values[min(len(values) - 1, int(rank * len(values)))] * 1000, 3)
+
+    return {"p50": percentile(0.5), "p90": percentile(0.9),
+            "p99": percentile(0.99), "max": percentile(1)}
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _sources(workdir: str) -> dict:
+    """ Local trees sent by the copy scenarios: many small files, a few big ones, and a template. """
+    sources = {"copy": path.join(workdir, "small"),
+               "copy-large": path.join(workdir, "large"),
+               "template": path.join(workdir, "bench.conf")}
+    with open(sources["template"], "w", encoding="utf-8") as template:
+        template.write("".join(f"key{line} = $value\n" for line in range(200)))
+    for name, count, size in (("copy", 200, 1024), ("copy-large", 2, 16 * 1024 * 1024)):
+        if path.isdir(sources[name]):
+            continue
+        os.makedirs(sources[name])
+        for index in range(count):
+            with open(path.join(sources[name], f"file{index}"), "wb") as source:
+                source.write(os.urandom(size))
+    return sources
+
+
+def _plan(module: str, count: int, sources: dict):
+    """ Plan of `count` todos of `module`, each one acting on its own resource. """
+    from resources.plan import compile_plan
+
+    params = {
+        "command": lambda index: {"command": f"echo {index}"},
+        "copy": lambda index: {"src": sources["copy"], "dest": f"copy{index}"},
+        "copy-large": lambda index: {"src": sources["copy-large"], "dest": f"large{index}"},
+        "template": lambda index: {"src": sources["template"], "dest": f"conf/{index}.conf",
+                                   "vars": {"value": index}},
+        "apt": lambda index: {"name": f"package{index}", "state": "present"},
+        "service": lambda index: {"name": f"unit{index}", "state": "started"},
+        "sysctl": lambda index: {"attribute": f"bench.param{index}", "value": "1",
+                                 "permanent": True, "file": "etc/sysctl.d/99-zz-mla.conf"},
+    }[module]
+    return compile_plan([{"module": module.split("-")[0], "params": params(index)}
+                         for index in range(count)])
+
+
+def _start_server(workdir: str, latency_ms: float, bandwidth_mbps: float):
+    """ Starts `server.py` and trusts its host key, returns the process and its port. """
+    server = subprocess.Popen(
+        [sys.executable, path.join(BENCH_DIR, "server.py"),
+         "--root", tempfile.mkdtemp(prefix="remote-", dir=workdir),
+         "--latency-ms", str(latency_ms), "--bandwidth-mbps", str(bandwidth_mbps)],
+        stdout=subprocess.PIPE, text=True)
+    _, port, key_type, key = server.stdout.readline().split()
+    with open(path.expanduser("~/.ssh/known_hosts"), "a", encoding="utf-8") as known_hosts:
+        known_hosts.write(f"[127.0.0.1]:{port} {key_type} {key}\n")
+    return server, int(port)
+
+
+def _run(main, profiler, hosts: list, plan) -> dict:
+    """ Runs the todos on the hosts the way `main.main` does, and measures it. """
+    profiler.clear()
+    durations = {}
+
+    def run_host(host):
+        start = perf_counter()
+        statuses = main._run_host(host, plan, clients[host.name])
+        durations[host.name] = perf_counter() - start
+        return statuses
+
+    start = perf_counter()
+    clients = main.preflight(hosts)
+    with ThreadPoolExecutor(max_workers=main.FORKS) as pool:
+        results = list(pool.map(run_host, [host for host in hosts if host.name in clients]))
+    wall = perf_counter() - start
+
+    statuses = [status for host_statuses in results for status in host_statuses]
+    report = profiler.report()
+    steps = [event["seconds"] for event in profiler.events if event["kind"] == "module"]
+    connects = [event["seconds"] for event in profiler.events if event["kind"] == "connect"]
+    return {
+        "seconds": round(wall, 3),
+        "unreachable": len(hosts) - len(clients),
+        "statuses": {status: statuses.count(status) for status in sorted(set(statuses))},
+        "todos_per_second": round(len(statuses) / wall, 3),
+        "bytes_per_second": round(report["totals"]["bytes"] / wall, 3),
+        "remote_calls": report["totals"]["remote_calls"],
+        "queued_seconds": round(report["totals"]["queued"], 3),
+        "host_ms": _percentiles(list(durations.values())),
+        "step_ms": _percentiles(steps),
+        "connect_ms": _percentiles(connects),
+    }
+
+
+def bench(args) -> None:
+    """ Runs every scenario in a work directory removed afterwards. """
+    with tempfile.TemporaryDirectory(prefix="mla-bench-") as workdir:
+        _bench(args, workdir)
+
+
+def _bench(args, workdir: str) -> None:
+    # the runs get their own ~/.ssh/known_hosts and ~/.mla (facts, broker, reports)
+    os.environ["HOME"] = path.join(workdir, "home")
+    os.makedirs(path.join(os.environ["HOME"], ".ssh"))
+    sys.path.insert(0, SRC_DIR)
+    import logging
+
+    import main
+    from resources.classes.host import Host
+    from resources.profiler import profiler
+    from resources.scheduler import scheduler
+
+    logging.disable(logging.INFO)
+    main.FORKS = args.forks
+    main.RETRIES = 1
+    main.AGENT = args.agent
+    scheduler.configure(args.pools)
+    sources = _sources(workdir)
+    output = args.output or path.join(BENCH_DIR, "results", f"{_commit()}.jsonl")
+    os.makedirs(path.dirname(path.abspath(output)), exist_ok=True)
+
+    for latency_ms, bandwidth_mbps, module, hosts_count, todos_count in product(
+            args.latency_ms, args.bandwidth_mbps, args.modules, args.hosts, args.todos):
+        scenario = {"module": module, "hosts": hosts_count, "todos": todos_count,
+                    "latency_ms": latency_ms, "bandwidth_mbps": bandwidth_mbps,
+                    "forks": args.forks, "agent": args.agent, "pools": args.pools}
+        server, port = _start_server(workdir, latency_ms, bandwidth_mbps)
+        try:
+            hosts = [Host(f"bench{index}", "127.0.0.1", port, True,
+                          f"bench{index}", "bench")
+                     for index in range(hosts_count)]
+            plan = _plan(module, todos_count, sources)
+            for run in range(args.runs):
+                result = {"commit": _commit(), "date": strftime("%Y-%m-%dT%H:%M:%S"),
+                          "scenario": scenario, "run": run, **_run(main, profiler, hosts, plan)}
+                with open(output, "a", encoding="utf-8") as results:
+                    results.write(json.dumps(result) + "\n")
+                print(f"{_key(scenario)} run {run}: {result['seconds']:.3f}s, "
+                      f"{result['todos_per_second']} todos/s, host p90 "
+                      f"{result['host_ms'].get('p90')} ms, {result['statuses']}")
+        finally:
+            server.kill()
+            server.wait()
+    print(f"Results written in {output}.")
+
+
+def _key(scenario: dict) -> str:
+    return (f"{scenario['module']} hosts={scenario['hosts']} todos={scenario['todos']} "
+            f"latency={scenario['latency_ms']}ms bandwidth={scenario['bandwidth_mbps']}Mbps "
+            f"forks={scenario['forks']}{' agent' if scenario.get('agent') else ''}"
+            f"{' pools=' + scenario['pools'] if scenario.get('pools') else ''}")
+
+
+def _load(results_path: str) -> dict:
+    """ Maps each scenario and run of a results file to its last result. """
+    results = {}
+    with open(results_path, "r", encoding="utf-8") as results_file:
+        for line in results_file:
+            result = json.loads(line)
+            results[(_key(result["scenario"]), result["run"])] = result
+    return results
+
+
+def compare(old_path: str, new_path: str) -> None:
+    """ Prints the wall time and host p90 of the scenarios found in both files. """
+    old, new = _load(old_path), _load(new_path)
+    print(f"{'scenario':<72} {'run':>3} {'old s':>8} {'new s':>8} {'ratio':>6} "
+          f"{'old p90':>9} {'new p90':>9}")
+    for key in sorted(old.keys() & new.keys()):
+        before, after = old[key], new[key]
+        ratio = after["seconds"] / before["seconds"] if before["seconds"] else 0
+        print(f"{key[0]:<72} {key[1]:>3} {before['seconds']:>8.3f} {after['seconds']:>8.3f} "
+              f"{ratio:>6.2f} {before['host_ms'].get('p90', 0):>9.1f} "
+              f"{after['host_ms'].get('p90', 0):>9.1f}")
+
+
+def main():
+    if sys.argv[1:2] == ["compare"] and len(sys.argv) == 4:
+        compare(sys.argv[2], sys.argv[3])
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--hosts", type=_csv(int), default=[1, 10])
+    parser.add_argument("--todos", type=_csv(int), default=[1, 10])
+    parser.add_argument("--modules", type=_csv(str), default=list(MODULES))
+    parser.add_argument("--latency-ms", type=_csv(float), default=[0, 50])
+    parser.add_argument("--bandwidth-mbps", type=_csv(float), default=[0])
+    parser.add_argument("--forks", type=int, default=10)
+    parser.add_argument("--runs", type=int, default=2)
+    parser.add_argument("--agent", action="store_true")
+    parser.add_argument("--pools", default="")
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+    unknown = set(args.modules) - set(MODULES)
+    if unknown:
+        parser.error(f"unknown modules: {', '.join(sorted(unknown))}")
+    bench(args)
+
+
+if __name__ == "__main__":
+    main()
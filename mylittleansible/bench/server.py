@@ -0,0 +1,295 @@
+""" Stand-in SSH/SFTP server for the benchmarks.
+
+    server.py --root DIR [--latency-ms MS] [--bandwidth-mbps MBPS]
+
+Every user is sandboxed in `DIR/<user>`: commands run there (it is their
+HOME) with the stub binaries of `bench/stubs` first in the PATH, and the
+sftp paths are resolved under it. Any password is accepted.
+
+The server listens behind a proxy delaying each direction of every
+connection by half of `--latency-ms` and pacing it to `--bandwidth-mbps`.
+Once ready, it prints `READY <port> <key type> <key base64>` on stdout.
+"""
+
+import argparse
+import os
+import socket
+import subprocess
+import threading
+from collections import deque
+from os import path
+from time import monotonic, sleep
+
+import paramiko
+from paramiko import (SFTP_OK, SFTPAttributes, SFTPHandle, SFTPServer,
+                      SFTPServerInterface)
+
+STUBS_DIR = path.join(path.dirname(path.abspath(__file__)), "stubs")
+CHUNK_SIZE = 32768
+
+
+def _user_root(root: str, user: str) -> str:
+    home = path.join(root, user)
+    os.makedirs(home, exist_ok=True)
+    return home
+
+
+class StubHandle(SFTPHandle):
+    """ sftp handle over a local file. """
+
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            SFTPServer.set_file_attr(self.filename, attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+
+class StubSFTPServer(SFTPServerInterface):
+    """ sftp subsystem jailed in the home of the authenticated user. """
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.home = server.home
+
+    def _real(self, remote_path: str) -> str:
+        return path.join(self.home, path.normpath("/" + remote_path).lstrip("/"))
+
+    def canonicalize(self, remote_path: str) -> str:
+        return path.normpath("/" + remote_path)
+
+    def list_folder(self, remote_path):
+        real = self._real(remote_path)
+        try:
+            return [SFTPAttributes.from_stat(os.stat(path.join(real, name)), name)
+                    for name in os.listdir(real)]
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, remote_path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._real(remote_path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, remote_path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self._real(remote_path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, remote_path, flags, attr):
+        real = self._real(remote_path)
+        try:
+            mode = getattr(attr, "st_mode", None) or 0o666
+            fd = os.open(real, flags, mode)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            file_mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            file_mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            file_mode = "rb"
+        handle = StubHandle(flags)
+        handle.filename = real
+        handle.readfile = handle.writefile = os.fdopen(fd, file_mode)
+        return handle
+
+    def remove(self, remote_path):
+        try:
+            os.remove(self._real(remote_path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self, old_path, new_path):
+        try:
+            os.rename(self._real(old_path), self._real(new_path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    posix_rename = rename
+
+    def mkdir(self, remote_path, attr):
+        try:
+            os.mkdir(self._real(remote_path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rmdir(self, remote_path):
+        try:
+            os.rmdir(self._real(remote_path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def chattr(self, remote_path, attr):
+        try:
+            SFTPServer.set_file_attr(self._real(remote_path), attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+
+class StubServer(paramiko.ServerInterface):
+    """ Accepts any password and runs the commands in the user's home. """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.home = None
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        self.home = _user_root(self.root, username)
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.run, args=(channel, command),
+                         daemon=True).start()
+        return True
+
+    def run(self, channel, command: bytes) -> None:
+        """ Runs `command` with `sh -c`, relaying its streams to `channel`. """
+        env = dict(os.environ, HOME=self.home,
+                   PATH=f"{STUBS_DIR}:{os.environ['PATH']}")
+        process = subprocess.Popen(
+            ["sh", "-c", command.decode()], cwd=self.home, env=env,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def feed_stdin():
+            try:
+                for data in iter(lambda: channel.recv(CHUNK_SIZE), b""):
+                    process.stdin.write(data)
+                    process.stdin.flush()
+            except (OSError, EOFError):
+                ...
+            process.stdin.close()
+
+        def relay_stderr():
+            for data in iter(lambda: process.stderr.read1(CHUNK_SIZE), b""):
+                channel.sendall_stderr(data)
+
+        threading.Thread(target=feed_stdin, daemon=True).start()
+        stderr_thread = threading.Thread(target=relay_stderr)
+        stderr_thread.start()
+        for data in iter(lambda: process.stdout.read1(CHUNK_SIZE), b""):
+            channel.sendall(data)
+        stderr_thread.join()
+        channel.send_exit_status(process.wait())
+        channel.shutdown_write()
+        # closing first could beat the reply to the exec request
+        for _ in range(500):
+            if channel.closed:
+                break
+            sleep(0.01)
+        channel.close()
+
+
+def _serve_ssh(sock: socket.socket, key: paramiko.PKey, root: str) -> None:
+    transport = paramiko.Transport(sock)
+    transport.add_server_key(key)
+    transport.set_subsystem_handler("sftp", SFTPServer, StubSFTPServer)
+    transport.start_server(server=StubServer(root))
+
+
+def _pump(source: socket.socket, target: socket.socket, delay: float, bandwidth: float) -> None:
+    """ Forwards `source` to `target` `delay` seconds later, at `bandwidth` bytes/s. """
+    pending = deque()
+    condition = threading.Condition()
+
+    def reader():
+        while True:
+            try:
+                data = source.recv(CHUNK_SIZE)
+            except OSError:
+                data = b""
+            with condition:
+                pending.append((monotonic() + delay, data))
+                condition.notify()
+            if not data:
+                return
+
+    threading.Thread(target=reader, daemon=True).start()
+    while True:
+        with condition:
+            condition.wait_for(lambda: pending)
+            deliver_at, data = pending.popleft()
+        wait = deliver_at - monotonic()
+        if wait > 0:
+            sleep(wait)
+        if not data:
+            try:
+                target.shutdown(socket.SHUT_WR)
+            except OSError:
+                ...
+            return
+        try:
+            target.sendall(data)
+        except OSError:
+            return
+        if bandwidth > 0:
+            sleep(len(data) / bandwidth)
+
+
+def _proxy(client: socket.socket, backend_port: int, delay: float, bandwidth: float) -> None:
+    backend = socket.create_connection(("127.0.0.1", backend_port))
+    for source, target in ((client, backend), (backend, client)):
+        threading.Thread(target=_pump, args=(source, target, delay, bandwidth),
+                         daemon=True).start()
+
+
+def _listen() -> socket.socket:
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(512)
+    return listener
+
+
+def _accept_forever(listener: socket.socket, handler, *args) -> None:
+    while True:
+        sock, _ = listener.accept()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=handler, args=(sock, *args), daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--root", required=True)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--bandwidth-mbps", type=float, default=0)
+    args = parser.parse_args()
+
+    key = paramiko.RSAKey.generate(2048)
+    backend = _listen()
+    threading.Thread(target=_accept_forever, args=(backend, _serve_ssh, key, args.root),
+                     daemon=True).start()
+
+    frontend = _listen()
+    delay = args.latency_ms / 2000
+    bandwidth = args.bandwidth_mbps * 1000 * 1000 / 8
+    threading.Thread(target=_accept_forever,
+                     args=(frontend, _proxy, backend.getsockname()[1], delay, bandwidth),
+                     daemon=True).start()
+
+    print(f"READY {frontend.getsockname()[1]} {key.get_name()} {key.get_base64()}",
+          flush=True)
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+""" Start-up time of the `mla` command line.
+
+    startup.py [--runs N] [--max-ms MS] [--output PATH]
+
+Each command is started `--runs` times, its median and p90 wall times are
+compared to those of a bare `python -c pass`: the run fails if the median
+overhead of one of them exceeds `--max-ms`, or if one of them imports a
+module it doesn't need (`HEAVY_MODULES`).
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from os import path
+from time import perf_counter, strftime
+
+from run import BENCH_DIR, SRC_DIR, _commit
+
+# modules each command must not import, only the runs need them
+HEAVY_MODULES = {
+    "help": ("paramiko", "yaml", "colorlog"),
+    "version": ("paramiko", "yaml", "colorlog"),
+    "syntax-check": ("paramiko",),
+}
+
+
+def _commands(todos_path: str) -> dict:
+    return {
+        "python": ["-c", "pass"],
+        "help": ["mla.py", "--help"],
+        "version": ["mla.py", "--version"],
+        "syntax-check": ["mla.py", "--syntax-check", "-f", todos_path],
+    }
+
+
+def _time(args: list, runs: int) -> dict:
+    """ Median and p90 wall time of `python args`, in milliseconds. """
+    durations = []
+    for _ in range(runs):
+        start = perf_counter()
+        subprocess.run([sys.executable, *args], cwd=SRC_DIR, capture_output=True, check=True)
+        durations.append((perf_counter() - start) * 1000)
+    durations.sort()
+    return {"p50": round(durations[len(durations) // 2], 1),
+            "p90": round(durations[min(len(durations) - 1, int(0.9 * len(durations)))], 1)}
+
+
+def _imported(args: list) -> set:
+    """ Top level modules imported by `python args`. """
+    stderr = subprocess.run([sys.executable, "-X", "importtime", *args], cwd=SRC_DIR,
+                            capture_output=True, text=True, check=True).stderr
+    return {line.rpartition("|")[2].strip().split(".")[0]
+            for line in stderr.splitlines() if line.startswith("import time:")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--runs", type=int, default=15)
+    parser.add_argument("--max-ms", type=float, default=150)
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="mla-startup-") as workdir:
+        os.environ["HOME"] = workdir
+        todos_path = path.join(workdir, "todos.yml")
+        with open(todos_path, "w", encoding="utf-8") as todos:
+            todos.write("- module: command\n  params: {command: echo}\n")
+
+        commands = _commands(todos_path)
+        timings = {name: _time(command, args.runs) for name, command in commands.items()}
+        failures = []
+        for name, timing in timings.items():
+            timing["overhead_ms"] = round(timing["p50"] - timings["python"]["p50"], 1)
+            print(f"{name:<14} p50 {timing['p50']:>7.1f} ms  p90 {timing['p90']:>7.1f} ms  "
+                  f"overhead {timing['overhead_ms']:>7.1f} ms")
+            if timing["overhead_ms"] > args.max_ms:
+                failures.append(f"{name} takes {timing['overhead_ms']} ms more than python")
+        for name, modules in HEAVY_MODULES.items():
+            heavy = _imported(commands[name]) & set(modules)
+            if heavy:
+                failures.append(f"{name} imports {', '.join(sorted(heavy))}")
+
+    output = args.output or path.join(BENCH_DIR, "results", f"startup-{_commit()}.jsonl")
+    os.makedirs(path.dirname(path.abspath(output)), exist_ok=True)
+    with open(output, "a", encoding="utf-8") as results:
+        results.write(json.dumps({"commit": _commit(), "date": strftime("%Y-%m-%dT%H:%M:%S"),
+                                  "runs": args.runs, "timings": timings,
+                                  "failures": failures}) + "\n")
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
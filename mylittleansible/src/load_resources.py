@@ -1,56 +1,218 @@
-""" Module that permit to load resources (todos and inventory files). """
+""" Module that permit to load resources (todos and inventory files).
 
+Inventories are YAML files or executables writing JSON, both indexed in
+an `Inventory` from which only the hosts selected by `--limit` are built.
+
+Files are parsed with the libyaml loader when it is available and checked
+once; the checked content is kept in `~/.mla/cache`, keyed by the path,
+size and mtime of the file, so that unchanged files are not parsed again.
+"""
+
+import json
+import os
+import pickle
+import subprocess
+from hashlib import sha256
 from os import path
+from time import perf_counter
 
-from yaml import FullLoader, YAMLError, load
+from yaml import YAMLError, load
+
+try:
+    from yaml import CFullLoader as FullLoader
+except ImportError:
+    from yaml import FullLoader
 
-import resources.classes.modules as mod
 from resources.classes.host import Host
-from resources.classes.todo import Todo
+from resources.classes.inventory import Inventory
+from resources.plan import Plan, PlanError, compile_plan
+from resources.tools import MLA_HOME
+
+CACHE_DIR = path.join(MLA_HOME, "cache")
+HOST_KEYS = {"ssh_address": str, "ssh_port": int, "ssh_user": str,
+             "ssh_password": str, "ssh_key_file": str}
+
+
+def _check_todos(content: any) -> None:
+    """ Raises ValueError if `content` is not a list of todos. """
+    if not isinstance(content, list):
+        raise ValueError("the todos file must be a list of todos")
+    for index, todo in enumerate(content):
+        if not isinstance(todo, dict) or not isinstance(todo.get("module"), str) \
+                or not isinstance(todo.get("params"), dict):
+            raise ValueError(
+                f"todo no {index} must have a `module` (str) and `params` (mapping)")
+
+
+def _check_params(params: any, where: str) -> None:
+    """ Raises ValueError if `params` are not host variables. """
+    if not isinstance(params, dict):
+        raise ValueError(f"{where} must be a mapping")
+    for key, value in params.items():
+        if key in HOST_KEYS and not isinstance(value, HOST_KEYS[key]):
+            raise ValueError(f"`{key}` of {where} must be a {HOST_KEYS[key].__name__}")
+
+
+def _check_inventory(content: any) -> None:
+    """ Raises ValueError if `content` is not an inventory. """
+    if not isinstance(content, dict) or not isinstance(content.get("hosts", {}), dict) \
+            or not isinstance(content.get("groups", {}), dict):
+        raise ValueError("the inventory `hosts` and `groups` must be mappings")
+    _check_params(content.get("vars", {}), "the inventory vars")
+    for hostname, params in content.get("hosts", {}).items():
+        _check_params(params or {}, f"host {hostname}")
+    for group, definition in content.get("groups", {}).items():
+        if not isinstance(definition or {}, dict):
+            raise ValueError(f"group {group} must be a mapping")
+        definition = definition or {}
+        for key in ("hosts", "children"):
+            if not isinstance(definition.get(key, []), list):
+                raise ValueError(f"`{key}` of group {group} must be a list")
+        _check_params(definition.get("vars", {}), f"group {group}")
+
+
+def _index(content: dict, inventory: Inventory) -> None:
+    """ Adds the hosts and groups of an inventory document to `inventory`. """
+    inventory.add_group("all", variables=content.get("vars"))
+    for hostname, params in content.get("hosts", {}).items():
+        inventory.add_host(hostname, params)
+    for group, definition in content.get("groups", {}).items():
+        definition = definition or {}
+        inventory.add_group(group, definition.get("hosts", []),
+                            definition.get("vars"), definition.get("children", []))
+
+
+def _json_stream(stream) -> any:
+    """ Yields the JSON values written one after the other on `stream`. """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    for chunk in iter(lambda: stream.read(65536), ""):
+        buffer += chunk
+        while True:
+            buffer = buffer.lstrip()
+            try:
+                value, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                break
+            yield value
+            buffer = buffer[end:]
+    if buffer.strip():
+        raise ValueError("the dynamic inventory output ends with invalid JSON")
+
+
+def _dynamic_inventory(executable: str, inventory: Inventory) -> None:
+    """ Indexes the JSON written by an inventory executable.
+
+    It writes whole inventory documents (same layout as the YAML files)
+    or a stream of `{"host": name, "groups": [...], ...variables}` and
+    `{"group": name, "hosts": [...], "vars": {...}, "children": [...]}`.
+    """
+    with subprocess.Popen([path.abspath(executable)], stdout=subprocess.PIPE,
+                          text=True) as process:
+        for value in _json_stream(process.stdout):
+            if not isinstance(value, dict):
+                raise ValueError("the dynamic inventory must write JSON objects")
+            if "host" in value:
+                params = {key: item for key, item in value.items()
+                          if key not in ("host", "groups")}
+                _check_params(params, f"host {value['host']}")
+                inventory.add_host(value["host"], params, value.get("groups", []))
+            elif "group" in value:
+                _check_params(value.get("vars", {}), f"group {value['group']}")
+                inventory.add_group(value["group"], value.get("hosts", []),
+                                    value.get("vars"), value.get("children", []))
+            else:
+                _check_inventory(value)
+                _index(value, inventory)
+    if process.returncode != 0:
+        raise RuntimeError(
+            f"the dynamic inventory {executable} exited with code {process.returncode}")
+
+
+def load_inventory(inventory_file_path: str) -> tuple[Inventory, bool]:
+    """ Indexes a YAML inventory or the output of an inventory executable. """
+    inventory = Inventory()
+    cached = False
+    if os.access(inventory_file_path, os.X_OK) \
+            and not inventory_file_path.endswith((".yml", ".yaml")):
+        _dynamic_inventory(inventory_file_path, inventory)
+    else:
+        content, cached = _load_yaml(inventory_file_path, _check_inventory)
+        _index(content, inventory)
+    inventory.resolve()
+    return inventory, cached
+
+
+def _load_yaml(file_path: str, check) -> tuple[any, bool]:
+    """ Returns the checked content of `file_path` and whether it came from the cache. """
+    file_stat = os.stat(file_path)
+    key = (path.abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns)
+    cache_path = path.join(
+        CACHE_DIR, sha256(key[0].encode()).hexdigest() + ".pickle")
+    try:
+        with open(cache_path, "rb") as cache:
+            cached_key, content = pickle.load(cache)
+        if cached_key == key:
+            return content, True
+    except (OSError, pickle.PickleError, EOFError, ValueError):
+        ...
+
+    with open(file_path, "rb") as yaml_file:
+        content = load(yaml_file, FullLoader)
+    check(content)
+
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as cache:
+            pickle.dump((key, content), cache, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        ...
+    return content, False
 
 
-def load_todos(todos_file_path: str, logger) -> list[Todo]:
-    """ Loads todos from the given `todo_file_path` in a list and returns it """
-    todos: Todo = Todo([])
+def load_todos(todos_file_path: str, logger) -> Plan:
+    """ Loads the todos of the given `todo_file_path` and compiles them, returns None if they are invalid """
     try:
         if path.isfile(todos_file_path):
-            with open(todos_file_path, 'r', encoding="utf-8") as todos_file:
-                converted_todos = load(todos_file.read(), FullLoader)
-            for todo in converted_todos:
-                todos.todo.append(mod.Base(todo["module"], todo["params"]))
-            logger.info("Todo loaded successfully.")
+            start = perf_counter()
+            converted_todos, cached = _load_yaml(todos_file_path, _check_todos)
+            plan = compile_plan(converted_todos)
+            logger.info(
+                f"{len(plan.steps)} todos loaded in {(perf_counter() - start) * 1000:.1f}ms"
+                f"{' (cached)' if cached else ''}.")
+            return plan
         else:
             logger.error("No such file")
             raise FileNotFoundError(todos_file_path)
+    except PlanError as e:
+        for error in e.errors:
+            logger.error(error)
     except YAMLError:
         logger.error("An error occurred when loading the todos file.")
     except Exception as e:
         logger.error(e.__str__())
-    return todos.todo
+    return None
 
 
-def load_host(inventory_file_path, logger):
-    """ Loads the specified hosts from the given `inventory_file_path` in a list and returns it. """
+def load_host(inventory_file_path, logger, limit: str = ""):
+    """ Loads the hosts of the given `inventory_file_path` selected by `limit` in a list and returns it. """
     hosts: list[Host] = []
     try:
         if path.isfile(inventory_file_path):
-            with open(inventory_file_path, "r", encoding="utf-8") as inventories:
-                converted_inventories = load(inventories.read(), FullLoader)
-                for hostname in converted_inventories["hosts"]:
-                    params = converted_inventories["hosts"][hostname]
-
-                    logger.info(f"Target host: {hostname}")
-
-                    target = Host(
-                        hostname,
-                        params["ssh_address"],
-                        params["ssh_port"],
-                        False if "ssh_key_file" in params else True,
-                        params["ssh_user"] if "ssh_user" in params and "ssh_key_file" not in params else None,
-                        params["ssh_password"] if "ssh_password" in params and "ssh_key_file" not in params else None,
-                        params["ssh_key_file"] if "ssh_key_file" in params and "ssh_key_file" not in params else None
-                    )
-                    hosts.append(target)
+            start = perf_counter()
+            inventory, cached = load_inventory(inventory_file_path)
+            for hostname in inventory.select(limit):
+                try:
+                    hosts.append(inventory.host(hostname))
+                except Exception as e:
+                    logger.error(f"Host {hostname} skipped: {e.__str__()}")
+            logger.info(
+                f"{len(hosts)} of {len(inventory.hosts)} hosts selected in "
+                f"{(perf_counter() - start) * 1000:.1f}ms{' (cached)' if cached else ''}.")
+            if limit and not hosts:
+                logger.warning(f"`{limit}` matches no host.")
         else:
             logger.error("No such file")
             raise FileNotFoundError(inventory_file_path)
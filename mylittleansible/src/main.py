@@ -1,58 +1,161 @@
-from os import getlogin, path
+""" MLA: runs the todos of a YAML file on the hosts of an inventory.
+
+Only what the command line needs is imported at start-up, paramiko and
+yaml are imported by the code paths using them, so that `--help`,
+`--version` and `--syntax-check` return at once.
+"""
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from os import path
 from socket import error as SocketError
 from sys import argv
+from time import sleep, strftime
+from typing import TYPE_CHECKING
 
-from paramiko import (AuthenticationException,
-                      BadHostKeyException, SSHClient, SSHException)
+from resources.profiler import profiler
+from resources.scheduler import scheduler
+from resources.tools import (MLA_HOME, Logs, close_sudo_session, set_log_host,
+                             set_log_todo)
 
-from resources.classes.host import Host
-from resources.classes.modules import (Apt, Command, Copy, Service, SysCTL)
-from resources.classes.todo import Todo
-from resources.tools import Logs
-from load_resources import load_host, load_todos
+if TYPE_CHECKING:
+    from resources.classes.host import Host
+    from resources.journal import Journal
+    from resources.plan import Plan
 
+VERSION = "1.0.0"
 TODO_FILE_PATH = ""
 INVENTORY_FILE_PATH = ""
+FORKS = 1
+CONNECT_TIMEOUT = 10.0
+AUTH_TIMEOUT = 10.0
+RETRIES = 3
+BACKOFF = 1.0
+MAX_UNREACHABLE = ""
+FACT_TTL = 0.0
+SOURCE_CACHE_MB = 256
+LOG_JSON = ""
+REPORT_PATH = ""
+PROFILE = False
+LIMIT = ""
+AGENT = False
+RESUME = False
+JOURNAL_PATH = ""
+SYNTAX_CHECK = False
+POOLS = ""
+PREFLIGHT_WORKERS = 64
+# clients kept open by the pre-flight, at least FORKS, the other hosts reconnect when they run
+PREFLIGHT_OPEN = 256
+OPTIONS = {
+    "-f": ("TODO_FILE_PATH", str, "todos file (YAML)"),
+    "-i": ("INVENTORY_FILE_PATH", str, "inventory file (YAML) or executable"),
+    "--forks": ("FORKS", int, "hosts run in parallel"),
+    "--connect-timeout": ("CONNECT_TIMEOUT", float, "TCP and banner timeout, in seconds"),
+    "--auth-timeout": ("AUTH_TIMEOUT", float, "authentication timeout, in seconds"),
+    "--retries": ("RETRIES", int, "connection attempts per host"),
+    "--backoff": ("BACKOFF", float, "first delay between two attempts, doubled each time"),
+    "--max-unreachable": ("MAX_UNREACHABLE", str, "unreachable hosts tolerated, N or P%%"),
+    "--fact-ttl": ("FACT_TTL", float, "seconds the gathered facts are reused"),
+    "--source-cache": ("SOURCE_CACHE_MB", int, "memory of the copy source cache, in MB"),
+    "--log-json": ("LOG_JSON", str, "also write the logs as JSON lines to PATH, - for stdout"),
+    "--report": ("REPORT_PATH", str, "path of the run report"),
+    "--profile": ("PROFILE", bool, "print where the time went"),
+    "--limit": ("LIMIT", str, "hosts and groups to run on"),
+    "--agent": ("AGENT", bool, "run the apt, service, sysctl and command todos on the hosts"),
+    "--resume": ("RESUME", bool, "skip the todos the journal records as done"),
+    "--journal": ("JOURNAL_PATH", str, "path of the run journal"),
+    "--syntax-check": ("SYNTAX_CHECK", bool, "check the todos (and inventory) and stop"),
+    "--pools": ("POOLS", str, "run-wide limits per module, e.g. apt=20,copy=500MB/s"),
+}
 LOGS = Logs()
 LOGS.setHandler()
 logger = LOGS.logger
+journal: Journal = None
+
+
+def _parser() -> ArgumentParser:
+    """ Command line parser built from `OPTIONS`. """
+    parser = ArgumentParser(prog="mla", description=__doc__.split("\n")[0])
+    parser.add_argument("--version", action="version", version=f"%(prog)s {VERSION}")
+    for option, (name, cast, help_text) in OPTIONS.items():
+        if cast is bool:
+            parser.add_argument(option, dest=name, action="store_true", help=help_text)
+        else:
+            parser.add_argument(option, dest=name, type=cast, default=globals()[name],
+                                help=help_text)
+    return parser
 
 
 def _valid_args() -> bool:
-    global TODO_FILE_PATH, INVENTORY_FILE_PATH
+    parser = _parser()
+    args = parser.parse_args(argv[1:])
     try:
-        if len(argv) != 5 or "-i" not in argv or "-f" not in argv:
-            logger.error("Invalid arguments")
-            logger.info("the program should be run like this:")
-            logger.info("mla -f todos.yml -i inventory.yml")
-            return False
+        globals().update(vars(args))
+        if TODO_FILE_PATH == "" or (INVENTORY_FILE_PATH == "" and not SYNTAX_CHECK):
+            raise ValueError("-f and -i are required")
+        if FORKS < 1 or RETRIES < 1:
+            raise ValueError("--forks and --retries must be at least 1")
+        try:
+            if _max_unreachable(100) < 0:
+                raise ValueError
+        except ValueError:
+            raise ValueError("--max-unreachable must be a count or a percentage (N or P%)")
+        from resources.source_cache import source_cache
 
-        TODO_FILE_PATH = argv[argv.index("-f") + 1]
-        INVENTORY_FILE_PATH = argv[argv.index("-i") + 1]
+        source_cache.max_bytes = SOURCE_CACHE_MB * 1024 * 1024
+        scheduler.configure(POOLS)
+        if LOG_JSON != "":
+            LOGS.setJsonSink(LOG_JSON)
 
         return True
     except Exception as e:
-        logger.error("Invalid arguments")
+        logger.error(f"Invalid arguments: {e.__str__()}")
         logger.info("the program should be run like this:")
-        logger.info("mla -f todos.yml -i inventory.yml")
+        logger.info(parser.format_usage())
         return False
 
 
 def ssh_conn(host: Host) -> any:
     """ Initiate SSH connexion with specified host. """
+    with profiler.measure("connect", host.ssh_address):
+        return _ssh_conn(host)
+
+
+def _ssh_conn(host: Host) -> any:
+    from paramiko import (AuthenticationException, BadHostKeyException,
+                          SSHClient, SSHException)
+
+    from resources.broker import broker_client
+
     logger.debug("Attempting to establish an SSH connection")
-    ssh_client = SSHClient()
     state = False
+    try:
+        ssh_client = broker_client(
+            host, logger, CONNECT_TIMEOUT, AUTH_TIMEOUT)
+        if ssh_client is not None:
+            return True, ssh_client
+    except Exception as e:
+        logger.error(f"The broker could not connect: {e.__str__()}")
+        return state, None
+
+    ssh_client = SSHClient()
+    ssh_client.load_system_host_keys()
     try:
         if host.auth:
             logger.debug("Connecting via username & password method")
             ssh_client.connect(host.ssh_address, host.ssh_port,
-                               host.ssh_user, host.ssh_password)
+                               host.ssh_user, host.ssh_password,
+                               timeout=CONNECT_TIMEOUT,
+                               banner_timeout=CONNECT_TIMEOUT,
+                               auth_timeout=AUTH_TIMEOUT)
             state = True
         else:
             logger.debug("Connecting via public key method")
             ssh_client.connect(
-                host.ssh_address, host.ssh_port, pkey=host.ssh_key_file)
+                host.ssh_address, host.ssh_port, host.ssh_user,
+                key_filename=host.ssh_key_file, timeout=CONNECT_TIMEOUT,
+                banner_timeout=CONNECT_TIMEOUT, auth_timeout=AUTH_TIMEOUT)
             state = True
     except BadHostKeyException:
         logger.error("The host key could not be verified.")
@@ -68,83 +171,283 @@ def ssh_conn(host: Host) -> any:
     return state, ssh_client
 
 
-def executor(host: Host, todos: Todo):
-    """ For a precise host, executes the todos. """
-    for _ in range(3):
+def connect(host: Host) -> any:
+    """ Connects to `host`, retrying with an exponential backoff. """
+    delay = BACKOFF
+    for attempt in range(RETRIES):
         state, ssh_client = ssh_conn(host)
         if state:
-            break
+            return state, ssh_client
+        if attempt < RETRIES - 1:
+            logger.debug(f"Retrying to connect to {host.ssh_address} in {delay}s.")
+            sleep(delay)
+            delay *= 2
 
-    if not state:
-        logger.info(
-            f"Could not connect to host {host.ssh_address}, process stopping."
-        )
-        logger.error(
-            f"Failed to connect to {host.ssh_address}, process stopping."
-        )
-        logger.error(
-            f"Used `username` + `password` authentication: {host.auth}.")
-        return
-
-    for index, todo in enumerate(todos):
-        match todo.module:
-            case "apt":
-                module = Apt(todo.module, todo.params)
-                status = module.process(
-                    ssh_client,
-                    host.ssh_password,
-                    host.ssh_address
-                )
-            case "command":
-                module = Command(todo.module, todo.params)
-                status = module.process(ssh_client, host.ssh_address)
-            case "copy":
-                module = Copy(todo.module, todo.params)
-                status = module.process(ssh_client)
-            case "service":
-                module = Service(todo.module, todo.params)
-                status = module.process(
-                    ssh_client,
-                    host.ssh_password,
-                    host.ssh_address
-                )
-            case "sysctl":
-                module = SysCTL(todo.module, todo.params)
-                status = module.process(
-                    ssh_client,
-                    host.ssh_password,
-                    host.ssh_address
-                )
-            case "template":
-                logger.warn(
-                    f"The module `{todo.module}` has yet to be implemented.")
-                continue
-            case __:
-                logger.error(f"Unrecognized module `{todo.module}`, skipping.")
-                continue
+    logger.error(f"Failed to connect to {host.ssh_address}.")
+    logger.error(f"Used `username` + `password` authentication: {host.auth}.")
+    return state, ssh_client
+
+
+def _max_unreachable(hosts_count: int) -> int:
+    """ Converts `MAX_UNREACHABLE` (count or percentage) to a count of hosts. """
+    if MAX_UNREACHABLE == "":
+        return hosts_count
+    if MAX_UNREACHABLE.endswith("%"):
+        return int(hosts_count * float(MAX_UNREACHABLE[:-1]) / 100)
+    return int(MAX_UNREACHABLE)
+
+
+def preflight(hosts: list[Host]) -> dict:
+    """ Connects to every host concurrently, returns the clients of the reachable ones.
+
+    Only the clients of the first `max(FORKS, PREFLIGHT_OPEN)` hosts are kept
+    open, the other reachable hosts are mapped to None and reconnect when
+    their turn comes, so that a big inventory doesn't hold a socket and a
+    thread per host while it waits.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    kept = max(FORKS, PREFLIGHT_OPEN)
+
+    def _connect(position: int, host: Host):
+        set_log_host(host.name)
+        state, ssh_client = connect(host)
+        set_log_host("-")
+        if state and position >= kept:
+            ssh_client.close()
+            ssh_client = None
+        return state, ssh_client
 
+    clients = {}
+    if hosts:
+        with ThreadPoolExecutor(max_workers=min(len(hosts), PREFLIGHT_WORKERS)) as pool:
+            for host, (state, ssh_client) in zip(
+                    hosts, pool.map(_connect, range(len(hosts)), hosts)):
+                if state:
+                    clients[host.name] = ssh_client
+
+    unreachable = [host.name for host in hosts if host.name not in clients]
+    logger.info(
+        f"Pre-flight: {len(clients)} reachable, {len(unreachable)} unreachable.")
+    if unreachable:
+        logger.warning(f"Unreachable hosts: {', '.join(unreachable)}")
+    return clients
+
+
+def _log_statuses(host: Host, batch: list, batch_statuses: list, statuses: list[str]) -> None:
+    for step, status in zip(batch, batch_statuses):
         status = status if status is not None else "ok"
+        set_log_todo(step.index, step.module)
+        statuses.append(status)
+        if journal is not None:
+            journal.record(host.name, step, status)
         logger.info(
-            f"Todo no {index} done ; module: `{todo.module}` on {host.ssh_address} ====> {status.upper()}\n"
+            f"Todo no {step.index} done ; module: `{step.module}` on {host.ssh_address} ====> {status.upper()}\n"
         )
 
-    ssh_client.close()
+
+def _log_queued(queued) -> None:
+    if queued.seconds >= 0.001:
+        logger.info(f"Queued {queued.seconds:.3f}s for the module pools.")
+
+
+def _resumed(host: Host, batch: tuple, statuses: list[str]) -> tuple:
+    """ Skips the steps of `batch` the journal records as done on the host, returns the others. """
+    remaining = []
+    for step in batch:
+        status = journal.status(host.name, step)
+        if status is None:
+            remaining.append(step)
+            continue
+        set_log_todo(step.index, step.module)
+        statuses.append("skipped")
+        logger.info(
+            f"Todo no {step.index} skipped ; module: `{step.module}` on {host.ssh_address} "
+            f"was {status.upper()} in the journal.\n")
+    return tuple(remaining)
+
+
+def executor(host: Host, plan: Plan, ssh_client: any) -> list[str]:
+    """ For a precise host, executes the steps of the plan and returns their statuses.
+
+    With `--agent`, the runs of consecutive batches the agent can apply are
+    sent to it at once, the other batches still run from here, in order.
+    """
+    from resources.agent import Agent
+    from resources.facts import Facts, wanted_facts
+
+    statuses: list[str] = []
+    agent = None
+    facts = None
+    pending = []
+
+    def flush():
+        if pending:
+            set_log_todo([step.index for batch in pending for step in batch], None)
+            with scheduler.slots(step.module for batch in pending for step in batch) as queued:
+                _log_queued(queued)
+                results = agent.run(pending)
+            for batch in pending:
+                _log_statuses(host, batch, [results[step.index] for step in batch], statuses)
+            pending.clear()
+
+    try:
+        if AGENT and any(step.module_class.agent for step in plan.steps):
+            agent = Agent.start(ssh_client, host.ssh_password, host.ssh_address, logger)
+            if agent is None:
+                logger.warning(f"Running the todos of {host.ssh_address} without the agent.")
+        facts = Facts(host.name, FACT_TTL, logger)
+        facts.load()
+        facts.gather(ssh_client, wanted_facts(
+            [step for step in plan.steps if agent is None or not step.module_class.agent]))
+
+        for batch in plan.batches:
+            if journal is not None and journal.done:
+                batch = _resumed(host, batch, statuses)
+                if not batch:
+                    continue
+            module_class = batch[0].module_class
+            if agent is not None and module_class.agent:
+                pending.append(batch)
+                continue
+            flush()
+            set_log_todo(
+                [step.index for step in batch] if len(batch) > 1 else batch[0].index,
+                batch[0].module)
+            with scheduler.slots([batch[0].module]) as queued:
+                _log_queued(queued)
+                with profiler.measure("module", batch[0].module):
+                    batch_statuses = module_class.process_batch(
+                        [module_class(step.module, step.params, facts, host) for step in batch],
+                        ssh_client,
+                        host.ssh_password,
+                        host.ssh_address
+                    )
+            _log_statuses(host, batch, batch_statuses, statuses)
+        flush()
+    finally:
+        # also run when a module raises, the client is closed whatever happens
+        try:
+            if agent is not None:
+                agent.close()
+            set_log_todo(None, None)
+            if facts is not None:
+                facts.save()
+        finally:
+            close_sudo_session(ssh_client)
+            ssh_client.close()
+    return statuses
+
+
+def _run_host(host: Host, plan: Plan, ssh_client: any) -> list[str]:
+    """ Runs `executor` for one host so that its failure can't stop the others.
+
+    The host is connected first if the pre-flight didn't keep its client.
+    """
+    set_log_host(host.name)
+    if ssh_client is None:
+        state, ssh_client = connect(host)
+        if not state:
+            set_log_host("-")
+            return ["unreachable"]
+    try:
+        statuses = executor(host, plan, ssh_client)
+    except Exception as e:
+        logger.error(f"Execution stopped on {host.ssh_address}: {e.__str__()}")
+        statuses = ["failed"]
+    logger.info("Closing ssh connection.")
+    set_log_host("-")
+    return statuses
+
+
+def _print_summary(results: dict[str, list[str]]) -> None:
+    """ Prints a per-host table counting the statuses of its todos (and its time queued for the pools). """
+    columns = ("ok", "changed", "ko", "skipped")
+    queued = None
+    if scheduler.concurrency or scheduler.bandwidth:
+        hosts = profiler.report()["hosts"]
+        queued = {name: hosts.get(name, {}).get("queued", 0.0) for name in results}
+    width = max([len(name) for name in results] + [4])
+    lines = [
+        f"{'host'.ljust(width)}  " +
+        "  ".join(column.rjust(7) for column in columns) +
+        ("   queued" if queued is not None else "") + "  state"
+    ]
+    for name, statuses in results.items():
+        if statuses in (["unreachable"], ["failed"]):
+            state = statuses[0]
+        else:
+            state = "ko" if "ko" in statuses else "done"
+        lines.append(
+            f"{name.ljust(width)}  " +
+            "  ".join(str(statuses.count(column)).rjust(7) for column in columns) +
+            (f"  {queued[name]:6.3f}s" if queued is not None else "") +
+            f"  {state}"
+        )
+    logger.info("Summary:\n" + "\n".join(lines) + "\n")
 
 
 def main():
-    global TODO_FILE_PATH, INVENTORY_FILE_PATH
+    global TODO_FILE_PATH, INVENTORY_FILE_PATH, journal
 
     if not _valid_args():
-        return
+        raise SystemExit(2)
 
     try:
-        hosts = load_host(INVENTORY_FILE_PATH, logger)
-        todos = load_todos(TODO_FILE_PATH, logger)
+        from concurrent.futures import ThreadPoolExecutor
+
+        from load_resources import load_host, load_todos
+        from resources.journal import Journal, journal_path
+        from resources.registry import load_plugins
+
+        load_plugins(logger)
+        plan = load_todos(TODO_FILE_PATH, logger)
+        if plan is None:
+            logger.error("Invalid todos, process stopping.")
+            if SYNTAX_CHECK:
+                raise SystemExit(1)
+            return
+        if SYNTAX_CHECK:
+            if INVENTORY_FILE_PATH and not load_host(INVENTORY_FILE_PATH, logger, LIMIT):
+                logger.error("No host selected in the inventory.")
+                raise SystemExit(1)
+            logger.info("Syntax check passed.")
+            return
+        hosts = load_host(INVENTORY_FILE_PATH, logger, LIMIT)
+
+        clients = preflight(hosts)
+        if len(hosts) - len(clients) > _max_unreachable(len(hosts)):
+            logger.error(
+                f"More than {MAX_UNREACHABLE} hosts are unreachable, process stopping.")
+            for ssh_client in clients.values():
+                if ssh_client is not None:
+                    ssh_client.close()
+            raise SystemExit(1)
 
-        for host in hosts:
-            executor(host, todos)
-            logger.info("Closing ssh connection.")
+        journal = Journal(JOURNAL_PATH or journal_path(TODO_FILE_PATH, INVENTORY_FILE_PATH),
+                          RESUME)
+        if RESUME:
+            logger.info(f"Resuming from {journal.path}: {len(journal.done)} steps already done.")
+        results = {host.name: ["unreachable"] for host in hosts}
+        try:
+            with ThreadPoolExecutor(max_workers=FORKS) as pool:
+                futures = {
+                    host.name: pool.submit(
+                        _run_host, host, plan, clients[host.name])
+                    for host in hosts if host.name in clients
+                }
+            results.update(
+                {name: future.result() for name, future in futures.items()})
+        finally:
+            journal.close()
 
+        _print_summary(results)
+        report_path = REPORT_PATH or path.join(
+            MLA_HOME, "reports", strftime("report-%Y%m%d-%H%M%S.json"))
+        profiler.write(report_path)
+        logger.info(f"Run report written in {report_path}.")
+        if PROFILE:
+            logger.info("Profile:\n" + profiler.summary() + "\n")
         logger.info("Closing MLA session.")
     except Exception as e:
         logger.error(f""" Error: {e.__str__()} """)
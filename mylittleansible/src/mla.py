@@ -0,0 +1,6 @@
+""" Entry point of MLA, see `main.py`. """
+
+from main import main
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+""" Starts or stops the MLA connection broker.
+
+    mla_broker.py [--idle-timeout SECONDS]
+    mla_broker.py stop
+"""
+
+from sys import argv
+
+from resources.broker import serve, stop
+from resources.tools import Logs
+
+LOGS = Logs()
+LOGS.setHandler()
+logger = LOGS.logger
+
+
+def main():
+    if "stop" in argv:
+        try:
+            stop()
+            logger.info("Broker stopped.")
+        except OSError:
+            logger.error("No broker is running.")
+        return
+
+    idle_timeout = 600
+    if "--idle-timeout" in argv:
+        idle_timeout = float(argv[argv.index("--idle-timeout") + 1])
+    serve(logger, idle_timeout=idle_timeout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+""" Agent mode: the apt, service, sysctl and command todos run on the host.
+
+The helper of `agent_helper.py`, preceded by `decisions.py`, is sent once
+to `~/.mla` on the host and reused while its sha256 matches, then the
+batches of the plan are streamed to it as JSON lines over one channel and
+the status of each todo is read back as soon as it is done, instead of a
+few SSH round trips per todo.
+"""
+
+import json
+from hashlib import sha256
+from os import path
+from shlex import quote
+
+from resources.profiler import profiler
+from resources.tools import set_log_todo
+
+# the decisions shared with `classes/modules.py` come first, the helper uses them
+SOURCE = b""
+for _name in ("decisions.py", "agent_helper.py"):
+    with open(path.join(path.dirname(__file__), _name), "rb") as _source:
+        SOURCE += _source.read() + b"\n"
+DIGEST = sha256(SOURCE).hexdigest()
+
+# run by `python3 -c`: asks for the helper unless its cached copy matches, then runs it
+BOOTSTRAP = """\
+import hashlib, os, sys
+digest = sys.argv[1]
+helper_path = os.path.expanduser("~/.mla/agent-%s.py" % digest[:16])
+stdin = sys.stdin.buffer
+try:
+    with open(helper_path, "rb") as helper:
+        source = helper.read()
+except OSError:
+    source = b""
+if hashlib.sha256(source).hexdigest() != digest:
+    sys.stdout.write("SEND\\n")
+    sys.stdout.flush()
+    source = stdin.read(int(stdin.readline()))
+    os.makedirs(os.path.dirname(helper_path), exist_ok=True)
+    with open(helper_path + ".tmp", "wb") as helper:
+        helper.write(source)
+    os.replace(helper_path + ".tmp", helper_path)
+sys.argv = [helper_path]
+exec(compile(source, helper_path, "exec"), {"__name__": "__main__"})
+"""
+
+
+class AgentError(Exception):
+    """ The agent stopped before answering. """
+
+
+class Agent:
+    """ Session with the agent of one host. """
+
+    def __init__(self, files: tuple, ssh_host: str, logger):
+        # paramiko shuts the channel down once its stdin file is collected
+        self.files = files
+        self.channel = files[1].channel
+        self.ssh_host = ssh_host
+        self.logger = logger
+        self.buffer = b""
+        self.sent = 0
+
+    @classmethod
+    def start(cls, ssh_client: any, ssh_password: str, ssh_host: str, logger) -> "Agent":
+        """ Starts the agent of the host, uploading it if needed, returns None if it can't run. """
+        with profiler.measure("agent", "start") as measure:
+            agent = cls(ssh_client.exec_command(f"python3 -c {quote(BOOTSTRAP)} {DIGEST}"),
+                        ssh_host, logger)
+            try:
+                line = agent.readline()
+                if line == b"SEND\n":
+                    logger.debug(f"Uploading the agent ({len(SOURCE)} bytes) to {ssh_host}.")
+                    agent.send(b"%d\n" % len(SOURCE) + SOURCE)
+                    measure.bytes += len(SOURCE)
+                    line = agent.readline()
+                if json.loads(line).get("ready") is not True:
+                    raise AgentError(f"unexpected agent greeting {line!r}")
+            except (AgentError, ValueError) as e:
+                logger.warning(f"The agent can't run on {ssh_host} ({e.__str__()}).")
+                agent.close()
+                return None
+        agent.send(json.dumps({"password": ssh_password}).encode() + b"\n")
+        return agent
+
+    def send(self, data: bytes) -> None:
+        self.sent += len(data)
+        self.channel.sendall(data)
+
+    def readline(self) -> bytes:
+        """ Reads one line of the agent, raises AgentError when it is gone. """
+        while b"\n" not in self.buffer:
+            data = self.channel.recv(32768)
+            if not data:
+                stderr = b""
+                while self.channel.recv_stderr_ready():
+                    stderr += self.channel.recv_stderr(32768)
+                raise AgentError(
+                    f"exit code {self.channel.recv_exit_status()}"
+                    f"{', ' + stderr.decode(errors='replace').strip() if stderr else ''}")
+            self.buffer += data
+        line, _, self.buffer = self.buffer.partition(b"\n")
+        return line + b"\n"
+
+    def run(self, batches: list) -> dict:
+        """ Sends all the `batches` at once and returns the status of each step index.
+
+        The todo logs of the agent are written as they come back.
+        """
+        statuses = {}
+        with profiler.measure("agent", "run") as measure:
+            self.sent = 0
+            self.send(b"".join(
+                json.dumps({"batch": [{"index": step.index, "module": step.module,
+                                       "params": dict(step.params)} for step in batch]},
+                           default=str).encode() + b"\n"
+                for batch in batches))
+            modules = {step.index: step.module for batch in batches for step in batch}
+            received = 0
+            while len(statuses) < len(modules):
+                line = self.readline()
+                received += len(line)
+                result = json.loads(line)
+                set_log_todo(result["index"], modules[result["index"]])
+                for level, message in result["log"]:
+                    getattr(self.logger, level)(f"{self.ssh_host} (agent): {message}")
+                statuses[result["index"]] = result["status"]
+            measure.bytes += self.sent + received
+        return statuses
+
+    def close(self) -> None:
+        try:
+            self.channel.shutdown_write()
+            self.channel.close()
+        except Exception:
+            ...
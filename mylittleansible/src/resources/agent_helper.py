@@ -0,0 +1,315 @@
+""" MLA agent, run on the remote host by `resources/agent.py`.
+
+Python3 standard library only, sent after `decisions.py` whose functions
+(`plan_apt`, ...) it uses as globals. It reads JSON lines on
+stdin, `{"password": ...}` first, then `{"batch": [{"index", "module",
+"params"}, ...]}`, applies the apt, service, sysctl and command todos on
+the host itself and writes one `{"index", "status", "log"}` line per todo
+as soon as its batch is done.
+"""
+
+import collections
+import json
+import os
+import selectors
+import subprocess
+import sys
+import time
+import uuid
+
+try:
+    from shlex import quote
+except ImportError:  # pragma: no cover
+    from pipes import quote
+
+PASSWORD = ""
+# time of the last `apt-get update`, read from `APT_UPDATE_STAMPS` on first use
+UPDATED_AT = None
+
+
+def run(command, sudo=False):
+    """ Runs `command` with sh (through `sudo -S` if `sudo`), returns (stdout, stderr, exit code). """
+    argv = ["sh", "-c", command]
+    stdin = None
+    if sudo:
+        argv = ["sudo", "-S", "-p", ""] + argv
+        stdin = PASSWORD + "\n"
+    process = subprocess.run(argv, input=stdin, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+    return process.stdout, process.stderr, process.returncode
+
+
+def stream(command, todo, prefix, max_lines, sudo=False):
+    """ Runs `command` like `run`, keeping only the last `max_lines` lines of each stream.
+
+    The kept lines are added to the log of `todo`, returns (stdout, stderr, exit code).
+    """
+    argv = ["sh", "-c", command]
+    if sudo:
+        argv = ["sudo", "-S", "-p", ""] + argv
+    process = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    if sudo:
+        process.stdin.write((PASSWORD + "\n").encode())
+    process.stdin.close()
+    kept = {"STDOUT": collections.deque(maxlen=max_lines),
+            "STDERR": collections.deque(maxlen=max_lines)}
+    streams = {process.stdout: "STDOUT", process.stderr: "STDERR"}
+    partial = {"STDOUT": b"", "STDERR": b""}
+    with selectors.DefaultSelector() as selector:
+        for file in streams:
+            selector.register(file, selectors.EVENT_READ)
+        while selector.get_map():
+            for key, _ in selector.select():
+                name = streams[key.fileobj]
+                data = os.read(key.fd, 32768)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    data = b"\n" if partial[name] else b""
+                lines = (partial[name] + data).split(b"\n")
+                partial[name] = lines.pop()
+                kept[name].extend(line.decode("utf-8", "replace") for line in lines)
+    exit_code = process.wait()
+    for name in ("STDOUT", "STDERR"):
+        for line in kept[name]:
+            todo.debug("%s%s: %s" % (prefix, name, line))
+    return "\n".join(kept["STDOUT"]), "\n".join(kept["STDERR"]), exit_code
+
+
+def bad_password(stderr):
+    return "incorrect password" in stderr or "try again" in stderr
+
+
+def probe(section, names):
+    """ Values of `systemctl is-active` / `is-enabled` / `sysctl -n` for `names`. """
+    command = {"active": "systemctl is-active", "enabled": "systemctl is-enabled",
+               "sysctl": "sysctl -n"}[section]
+    names = sorted(names)
+    if not names:
+        return {}
+    stdout, _, _ = run("; ".join("echo \"$(%s %s 2>/dev/null | tr '\\n' ' ')\"" % (command, quote(name))
+                                 for name in names))
+    values = {}
+    for name, line in zip(names, stdout.split("\n")):
+        values[name] = " ".join(line.split())
+    return values
+
+
+class Todo:
+    """ A todo of a batch, with its own log. """
+
+    def __init__(self, item):
+        self.index = item["index"]
+        self.module = item["module"]
+        self.params = item["params"]
+        self.log = []
+
+    def info(self, message):
+        self.log.append(("info", message))
+
+    def debug(self, message):
+        self.log.append(("debug", message))
+
+    def error(self, message):
+        self.log.append(("error", message))
+
+
+def apt(todos):
+    global UPDATED_AT
+    names = [todo.params["name"] for todo in todos]
+
+    def installed():
+        present = set()
+        stdout, _, _ = run("dpkg-query -W -f='${Package}\\t${Status}\\n' %s 2>/dev/null"
+                           % " ".join(quote(name) for name in sorted(set(names))))
+        for line in stdout.splitlines():
+            name, _, status = line.partition("\t")
+            if "ok installed" in status:
+                present.add(name)
+        return {name: "present" if name in present else "absent" for name in names}
+
+    statuses, expected, runs = plan_apt([todo.params for todo in todos], installed())
+    for todo, status in zip(todos, statuses):
+        if status == "ok":
+            todo.info("%s already %s." % (todo.params["name"], "installed"
+                                           if todo.params["state"] == "present" else "uninstalled"))
+    if not runs:
+        return statuses
+
+    to_install = [todos[position] for apt_run in runs for position in apt_run["install"]]
+    if UPDATED_AT is None:
+        for stamp in APT_UPDATE_STAMPS:
+            if os.path.exists(stamp):
+                UPDATED_AT = os.stat(stamp).st_mtime
+                break
+    if to_install and not apt_cache_valid([todo.params for todo in to_install],
+                                          UPDATED_AT, time.time()):
+        _, stderr, exit_code = run("apt-get update", sudo=True)
+        if bad_password(stderr):
+            todos[0].error("Incorrect password provided in inventory file, apt module can't be executed.")
+            return [status if status == "ok" else "ko" for status in statuses]
+        if exit_code == 0:
+            UPDATED_AT = time.time()
+
+    for apt_run in runs:
+        for action, command in (("install", "apt-get install -y"),
+                                ("uninstall", "apt-get autoremove -y")):
+            if apt_run[action]:
+                names_list = " ".join(quote(todos[position].params["name"])
+                                      for position in apt_run[action])
+                _, stderr, exit_code = stream(
+                    "%s %s" % (command, names_list), todos[0], "apt ", 200, sudo=True)
+                if exit_code != 0:
+                    todos[0].error("While trying to %s %s, exit code %d, STDERR:\n%s"
+                                   % (action, names_list, exit_code, stderr))
+
+    final = installed()
+    for position, todo in enumerate(todos):
+        if statuses[position] == "ok":
+            continue
+        statuses[position] = apt_status(todo.params, final, expected)
+        if statuses[position] == "ko":
+            todo.error("Failed to %s %s." % ("install" if todo.params["state"] == "present"
+                                             else "uninstall", todo.params["name"]))
+    return statuses
+
+
+def service(todos):
+    current = {}
+    for section in ("active", "enabled"):
+        for name, state in probe(section, {todo.params["name"] for todo in todos
+                                           if service_section(todo.params) == section}).items():
+            current[(section, name)] = state
+    statuses, expected, calls = plan_service([todo.params for todo in todos], current)
+    for todo, status in zip(todos, statuses):
+        if status == "ok":
+            todo.info("%s already %s." % (todo.params["name"], todo.params["state"]))
+    to_change = [todo for todo, status in zip(todos, statuses) if status == "to change"]
+    if not to_change:
+        return statuses
+
+    _, stderr, _ = run("; ".join("systemctl %s %s" % (action, " ".join(quote(name) for name in names))
+                                 for action, names in calls), sudo=True)
+    if bad_password(stderr):
+        todos[0].error("Incorrect password provided in inventory file, service module can't be executed.")
+        return [status if status == "ok" else "ko" for status in statuses]
+
+    final = {}
+    for section in ("active", "enabled"):
+        for name, state in probe(section, {todo.params["name"] for todo in to_change
+                                           if service_section(todo.params) == section}).items():
+            final[(section, name)] = state
+    for position, todo in enumerate(todos):
+        if statuses[position] != "to change":
+            continue
+        statuses[position] = service_status(todo.params, final, expected)
+        if statuses[position] == "ko":
+            todo.error("A problem occured when executing %s for %s, current state is %s."
+                       % (SERVICE_ACTIONS[todo.params["state"]], todo.params["name"],
+                          final.get((service_section(todo.params), todo.params["name"]))))
+    return statuses
+
+
+def sysctl(todos):
+    files = sorted({sysctl_file(todo.params) for todo in todos if todo.params["permanent"]})
+    current = probe("sysctl", {todo.params["attribute"] for todo in todos})
+    dropins = {}
+    for file in files:
+        try:
+            with open(file) as dropin:
+                dropins[file] = read_dropin(dropin)
+        except OSError:
+            dropins[file] = {}
+
+    statuses, expected, wanted = plan_sysctl([todo.params for todo in todos], current, dropins)
+    for todo, status in zip(todos, statuses):
+        attribute = todo.params["attribute"]
+        if status == "ok":
+            todo.info("%s already set to %s." % (attribute, sysctl_value(todo.params)))
+        else:
+            todo.debug("%s < > %s, current: %s" % (attribute, sysctl_value(todo.params),
+                                                   current.get(attribute)))
+    if "to change" not in statuses:
+        return statuses
+
+    _, stderr, _ = run("; ".join(sysctl_commands([todo.params for todo in todos], statuses,
+                                                 dropins, wanted)), sudo=True)
+    if bad_password(stderr):
+        todos[0].error("Incorrect password provided in inventory file, sysctl module can't be executed.")
+        return [status if status == "ok" else "ko" for status in statuses]
+
+    final = probe("sysctl", {todo.params["attribute"] for todo in todos})
+    for position, todo in enumerate(todos):
+        if statuses[position] != "to change":
+            continue
+        statuses[position] = sysctl_status(todo.params, final, expected)
+        if statuses[position] == "ko":
+            todo.error("%s <--- %s FAILED, current: %s" % (
+                todo.params["attribute"], sysctl_value(todo.params),
+                final.get(todo.params["attribute"])))
+    return statuses
+
+
+def command(todos):
+    statuses = []
+    for todo in todos:
+        lines = command_lines(todo.params)
+        max_lines = todo.params.get("max_lines", 1000)
+        todo.info("command list:\n%s" % todo.params["command"])
+        status = "ok"
+        if todo.params.get("pipelined", False):
+            # one shell for all the lines, each one followed by its markers
+            token = "__MLA_%s" % uuid.uuid4().hex
+            stdout, stderr, _ = run(
+                command_script(lines, token, todo.params.get("stop_on_failure", False)))
+            results, rest = parse_command_output(stdout, stderr, token)
+            for result in results:
+                todo.info("Executed command: %s (exit code: %d, duration: %s)"
+                          % (lines[result["index"]], result["exit_code"], result["duration"]))
+                for output_line in result["stdout"].splitlines()[-max_lines:]:
+                    todo.debug("STDOUT: %s" % output_line)
+                for output_line in result["stderr"].splitlines()[-max_lines:]:
+                    todo.debug("STDERR: %s" % output_line)
+                if result["exit_code"] != 0:
+                    status = "ko"
+            if len(results) < len(lines):
+                todo.error("%d command(s) were not executed:\n%s"
+                           % (len(lines) - len(results), "\n".join(lines[len(results):])))
+                todo.debug("Output after the last command:\n%s" % rest)
+                status = "ko"
+        else:
+            for line in lines:
+                _, _, exit_code = stream(line, todo, "", max_lines)
+                todo.info("Executed command: %s (exit code: %d)" % (line, exit_code))
+        statuses.append(status)
+    return statuses
+
+
+MODULES = {"apt": apt, "service": service, "sysctl": sysctl, "command": command}
+
+
+def reply(message):
+    sys.stdout.write(json.dumps(message) + "\n")
+    sys.stdout.flush()
+
+
+def main():
+    global PASSWORD
+    reply({"ready": True})
+    stdin = sys.stdin.buffer if hasattr(sys.stdin, "buffer") else sys.stdin
+    for line in iter(stdin.readline, b""):
+        message = json.loads(line.decode("utf-8"))
+        if "password" in message:
+            PASSWORD = message["password"]
+            continue
+        todos = [Todo(item) for item in message["batch"]]
+        try:
+            statuses = MODULES[todos[0].module](todos)
+        except Exception as e:
+            todos[0].error("The agent failed: %r" % e)
+            statuses = ["ko"] * len(todos)
+        for todo, status in zip(todos, statuses):
+            reply({"index": todo.index, "status": status, "log": todo.log})
+
+
+main()
@@ -0,0 +1,498 @@
+""" Local SSH connection broker (ControlMaster like).
+
+The broker keeps authenticated transports to the hosts open and serves
+channels over a Unix socket, so that successive `mla` runs don't pay the
+TCP, key exchange and authentication again.
+
+Every request is a JSON line sent on a fresh Unix connection:
+    - {"kind": "connect", "host": {...}}: opens (or reuses) the transport;
+    - {"kind": "exec", "host": {...}, "command": "..."}: runs a command, the
+      connection then carries frames (see `_send_frame`);
+    - {"kind": "sftp", "host": {...}}: opens the sftp subsystem, the
+      connection then carries the raw sftp stream;
+    - {"kind": "stop"}: stops the broker.
+The broker answers each request with a JSON line {"ok": bool, "error": str}.
+"""
+
+import json
+import os
+import select
+import socket
+import socketserver
+import struct
+import threading
+import time
+from os import path
+
+from resources.classes.host import Host
+from resources.tools import MLA_HOME
+
+SOCKET_PATH = os.environ.get(
+    "MLA_BROKER_SOCKET", path.join(MLA_HOME, "broker.sock"))
+
+STDIN, STDIN_EOF, STDOUT, STDERR, EXIT = range(5)
+_FRAME_HEADER = struct.Struct("!BI")
+_CHUNK_SIZE = 32768
+
+
+def _send_frame(sock: socket.socket, kind: int, payload: bytes = b"") -> None:
+    """ Sends a `(kind, length)` header followed by `payload`. """
+    sock.sendall(_FRAME_HEADER.pack(kind, len(payload)) + payload)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    """ Reads exactly `size` bytes, or less if the peer closed the socket. """
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+
+def _recv_frame(sock: socket.socket) -> tuple:
+    """ Reads one frame, returns `(None, b"")` when the peer is gone. """
+    header = _recv_exact(sock, _FRAME_HEADER.size)
+    if len(header) < _FRAME_HEADER.size:
+        return None, b""
+    kind, size = _FRAME_HEADER.unpack(header)
+    return kind, _recv_exact(sock, size)
+
+
+def _recv_line(sock: socket.socket) -> bytes:
+    """ Reads a single `\\n` terminated line byte per byte. """
+    line = bytearray()
+    while not line.endswith(b"\n"):
+        char = sock.recv(1)
+        if not char:
+            break
+        line += char
+    return bytes(line)
+
+
+def _host_dict(host: Host) -> dict:
+    """ Serializes the connection parameters of `host`. """
+    return {
+        "name": host.name,
+        "ssh_address": host.ssh_address,
+        "ssh_port": host.ssh_port,
+        "auth": host.auth,
+        "ssh_user": host.ssh_user,
+        "ssh_password": host.ssh_password,
+        "ssh_key_file": host.ssh_key_file,
+    }
+
+
+class _Transports:
+    """ Thread safe pool of SSH clients keyed by address, port and user. """
+
+    def __init__(self, idle_timeout: float, logger):
+        self.idle_timeout = idle_timeout
+        self.logger = logger
+        self.clients: dict = {}
+        self.last_used: dict = {}
+        # channels relayed on each client, which is not reaped while it has some
+        self.channels: dict = {}
+        # guards the dicts only, each key has its own lock held while connecting
+        self.lock = threading.Lock()
+        self.key_locks: dict = {}
+
+    @staticmethod
+    def key(params: dict) -> tuple:
+        return params["ssh_address"], params["ssh_port"], params["ssh_user"]
+
+    def acquire(self, params: dict) -> tuple:
+        """ Counts a channel about to be opened on the client of `params`, returns its key. """
+        key = self.key(params)
+        with self.lock:
+            self.channels[key] = self.channels.get(key, 0) + 1
+        return key
+
+    def release(self, key: tuple) -> None:
+        """ Counts a channel of `acquire` as closed, the client is idle again after its last one. """
+        with self.lock:
+            self.channels[key] -= 1
+            if not self.channels[key]:
+                del self.channels[key]
+            if key in self.clients:
+                self.last_used[key] = time.monotonic()
+
+    def _active(self, key):
+        """ Returns the client of `key` if its transport is still up, under `self.lock`. """
+        client = self.clients.get(key)
+        if client is not None and client.get_transport() is not None \
+                and client.get_transport().is_active():
+            self.last_used[key] = time.monotonic()
+            return client
+        return None
+
+    def get(self, params: dict, timeouts: dict):
+        """ Returns a connected client for `params`, connecting if needed.
+
+        Only the requests of the same key wait for each other's connection.
+        """
+        from paramiko import SSHClient
+
+        key = self.key(params)
+        with self.lock:
+            client = self._active(key)
+            if client is not None:
+                return client
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self.lock:
+                client = self._active(key)
+            if client is not None:
+                return client
+
+            client = SSHClient()
+            client.load_system_host_keys()
+            if params["auth"]:
+                client.connect(params["ssh_address"], params["ssh_port"],
+                               params["ssh_user"], params["ssh_password"],
+                               **timeouts)
+            else:
+                client.connect(params["ssh_address"], params["ssh_port"],
+                               params["ssh_user"],
+                               key_filename=params["ssh_key_file"],
+                               **timeouts)
+            client.get_transport().set_keepalive(30)
+            self.logger.info(f"Broker connected to {params['ssh_address']}.")
+            with self.lock:
+                self.clients[key] = client
+                self.last_used[key] = time.monotonic()
+            return client
+
+    def reap(self) -> None:
+        """ Closes the transports without channels and unused for more than `idle_timeout`. """
+        now = time.monotonic()
+        with self.lock:
+            for key in list(self.clients):
+                if key not in self.channels and now - self.last_used[key] > self.idle_timeout:
+                    self.logger.info(
+                        f"Closing idle transport to {key[0]}:{key[1]}.")
+                    self.clients.pop(key).close()
+                    self.last_used.pop(key)
+
+    def close(self) -> None:
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients.clear()
+            self.last_used.clear()
+
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    """ Serves a single request received on the broker socket. """
+
+    def handle(self):
+        request = json.loads(_recv_line(self.request) or b"{}")
+        if request.get("kind") == "stop":
+            self._reply(True)
+            threading.Thread(target=self.server.shutdown).start()
+            return
+
+        transports = self.server.transports
+        key = None
+        try:
+            try:
+                # counted before connecting, the reaper keeps the client until the relay ends
+                key = transports.acquire(request["host"])
+                client = transports.get(request["host"], request.get("timeouts", {}))
+                channel = client.get_transport().open_session()
+                if request["kind"] == "exec":
+                    channel.exec_command(request["command"])
+                elif request["kind"] == "sftp":
+                    channel.invoke_subsystem("sftp")
+            except Exception as e:
+                self._reply(False, e.__str__())
+                return
+
+            self._reply(True)
+            try:
+                if request["kind"] == "exec":
+                    self._relay_exec(channel)
+                elif request["kind"] == "sftp":
+                    self._relay_raw(channel)
+            finally:
+                channel.close()
+        finally:
+            if key is not None:
+                transports.release(key)
+
+    def _reply(self, ok: bool, error: str = "") -> None:
+        self.request.sendall(
+            json.dumps({"ok": ok, "error": error}).encode() + b"\n")
+
+    def _relay_exec(self, channel) -> None:
+        """ Multiplexes stdin/stdout/stderr and the exit status in frames. """
+        sock = self.request
+        while True:
+            readable, _, _ = select.select([sock, channel], [], [], 0.5)
+            if sock in readable:
+                kind, payload = _recv_frame(sock)
+                if kind is None:
+                    return
+                if kind == STDIN:
+                    channel.sendall(payload)
+                elif kind == STDIN_EOF:
+                    channel.shutdown_write()
+            # the exit status comes after the output, check it first so that
+            # nothing received before it is left behind.
+            exited = channel.exit_status_ready()
+            while channel.recv_stderr_ready():
+                _send_frame(sock, STDERR, channel.recv_stderr(_CHUNK_SIZE))
+            while channel.recv_ready():
+                _send_frame(sock, STDOUT, channel.recv(_CHUNK_SIZE))
+            if exited and not channel.recv_ready() \
+                    and not channel.recv_stderr_ready():
+                status = channel.recv_exit_status()
+                _send_frame(sock, EXIT, struct.pack("!i", status))
+                return
+
+    def _relay_raw(self, channel) -> None:
+        """ Copies bytes both ways until one of the sides is closed. """
+        sock = self.request
+        while True:
+            readable, _, _ = select.select([sock, channel], [], [])
+            if sock in readable:
+                data = sock.recv(_CHUNK_SIZE)
+                if not data:
+                    return
+                channel.sendall(data)
+            if channel in readable:
+                data = channel.recv(_CHUNK_SIZE)
+                if not data:
+                    return
+                sock.sendall(data)
+
+
+class _BrokerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def serve(logger, socket_path: str = SOCKET_PATH, idle_timeout: float = 600) -> None:
+    """ Runs the broker until a `stop` request is received. """
+    os.makedirs(path.dirname(socket_path), mode=0o700, exist_ok=True)
+    if path.exists(socket_path):
+        os.unlink(socket_path)
+
+    server = _BrokerServer(socket_path, _BrokerHandler)
+    os.chmod(socket_path, 0o600)
+    server.transports = _Transports(idle_timeout, logger)
+
+    def reaper():
+        while True:
+            time.sleep(min(idle_timeout, 30))
+            server.transports.reap()
+
+    threading.Thread(target=reaper, daemon=True).start()
+    logger.info(f"Broker listening on {socket_path}.")
+    try:
+        server.serve_forever()
+    finally:
+        server.transports.close()
+        server.server_close()
+        os.unlink(socket_path)
+        logger.info("Broker stopped.")
+
+
+def _request(socket_path: str, request: dict) -> socket.socket:
+    """ Sends `request` to the broker and returns the connected socket. """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        answer = json.loads(_recv_line(sock) or b"{}")
+    except Exception:
+        sock.close()
+        raise
+    if not answer.get("ok"):
+        sock.close()
+        raise ConnectionError(answer.get("error", "broker closed the socket"))
+    return sock
+
+
+def stop(socket_path: str = SOCKET_PATH) -> None:
+    """ Asks the running broker to stop. """
+    _request(socket_path, {"kind": "stop"}).close()
+
+
+class BrokerChannel:
+    """ Client side of an `exec` request, mimics a paramiko `Channel`. """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.stdout = bytearray()
+        self.stderr = bytearray()
+        self.exit_status = None
+        self.closed = False
+        self.condition = threading.Condition()
+        threading.Thread(target=self._reader, daemon=True).start()
+
+    def _reader(self) -> None:
+        while True:
+            try:
+                kind, payload = _recv_frame(self.sock)
+            except OSError:
+                kind = None
+            with self.condition:
+                if kind == STDOUT:
+                    self.stdout += payload
+                elif kind == STDERR:
+                    self.stderr += payload
+                else:
+                    if kind == EXIT:
+                        self.exit_status = struct.unpack("!i", payload)[0]
+                    elif self.exit_status is None:
+                        self.exit_status = -1
+                    self.condition.notify_all()
+                    return
+                self.condition.notify_all()
+
+    def _recv(self, buffer: bytearray, nbytes: int) -> bytes:
+        with self.condition:
+            self.condition.wait_for(
+                lambda: buffer or self.exit_status is not None)
+            data = bytes(buffer[:nbytes])
+            del buffer[:nbytes]
+            return data
+
+    def recv(self, nbytes: int) -> bytes:
+        return self._recv(self.stdout, nbytes)
+
+    def recv_stderr(self, nbytes: int) -> bytes:
+        return self._recv(self.stderr, nbytes)
+
+    def recv_ready(self) -> bool:
+        return len(self.stdout) > 0
+
+    def recv_stderr_ready(self) -> bool:
+        return len(self.stderr) > 0
+
+    def exit_status_ready(self) -> bool:
+        return self.exit_status is not None
+
+    def recv_exit_status(self) -> int:
+        with self.condition:
+            self.condition.wait_for(lambda: self.exit_status is not None)
+            return self.exit_status
+
+    def sendall(self, data: bytes) -> None:
+        _send_frame(self.sock, STDIN, data)
+
+    def shutdown_write(self) -> None:
+        # like paramiko, closing the stdin of a finished command is a no-op
+        if self.exit_status is None:
+            try:
+                _send_frame(self.sock, STDIN_EOF)
+            except OSError:
+                ...
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.sock.close()
+
+
+class BrokerFile:
+    """ File like view on one of the streams of a `BrokerChannel`. """
+
+    def __init__(self, channel: BrokerChannel, stream: str):
+        self.channel = channel
+        self.stream = stream
+
+    def read(self, size: int = -1) -> bytes:
+        if self.stream == "stdout":
+            buffer, recv = self.channel.stdout, self.channel.recv
+        else:
+            buffer, recv = self.channel.stderr, self.channel.recv_stderr
+        if size >= 0:
+            return recv(size)
+        self.channel.recv_exit_status()
+        data = bytes(buffer)
+        del buffer[:]
+        return data
+
+    def write(self, data) -> None:
+        self.channel.sendall(data.encode() if isinstance(data, str) else data)
+
+    def flush(self) -> None:
+        ...
+
+    def close(self) -> None:
+        if self.stream == "stdin":
+            self.channel.shutdown_write()
+
+
+class _SFTPSocket:
+    """ Broker socket carrying a raw sftp stream, as `SFTPClient` expects it. """
+
+    def __init__(self, sock: socket.socket, name: str):
+        self.sock = sock
+        self.name = name
+
+    def send(self, data: bytes) -> int:
+        return self.sock.send(data)
+
+    def recv(self, nbytes: int) -> bytes:
+        return self.sock.recv(nbytes)
+
+    def recv_ready(self) -> bool:
+        return bool(select.select([self.sock], [], [], 0)[0])
+
+    def get_name(self) -> str:
+        return self.name
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+class BrokerClient:
+    """ Drop-in replacement of `SSHClient` for the operations MLA uses. """
+
+    def __init__(self, host: Host, socket_path: str = SOCKET_PATH):
+        self.host = _host_dict(host)
+        self.socket_path = socket_path
+
+    def connect(self, timeouts: dict) -> None:
+        """ Makes sure the broker holds an authenticated transport. """
+        _request(self.socket_path, {
+            "kind": "connect", "host": self.host, "timeouts": timeouts}).close()
+
+    def exec_command(self, command: str) -> tuple:
+        sock = _request(self.socket_path, {
+            "kind": "exec", "host": self.host, "command": command})
+        channel = BrokerChannel(sock)
+        return (BrokerFile(channel, "stdin"), BrokerFile(channel, "stdout"),
+                BrokerFile(channel, "stderr"))
+
+    def open_sftp(self):
+        from paramiko import SFTPClient
+
+        sock = _request(self.socket_path, {"kind": "sftp", "host": self.host})
+        return SFTPClient(_SFTPSocket(sock, f"broker-{self.host['name']}"))
+
+    def close(self) -> None:
+        ...
+
+
+def broker_client(host: Host, logger, connect_timeout: float = None,
+                  auth_timeout: float = None, socket_path: str = SOCKET_PATH):
+    """ Returns a `BrokerClient` for `host`, or None if no broker is running. """
+    if not path.exists(socket_path):
+        return None
+    client = BrokerClient(host, socket_path)
+    try:
+        client.connect({
+            "timeout": connect_timeout,
+            "banner_timeout": connect_timeout,
+            "auth_timeout": auth_timeout,
+        })
+    except (FileNotFoundError, ConnectionRefusedError):
+        logger.debug("No broker is listening, using a direct connection.")
+        return None
+    logger.debug(f"Using the broker transport for {host.ssh_address}.")
+    return client
@@ -1,14 +1,26 @@
-from dataclasses import dataclass
-from os import getlogin
+from dataclasses import dataclass, field
+from functools import lru_cache
+from getpass import getuser
+
+
+@lru_cache(maxsize=None)
+def default_user() -> str:
+    """ User running MLA, from the environment or the password database (no TTY needed). """
+    return getuser()
 
 
 @dataclass
 class Host:
-    """ Describes a precise host. """
+    """ Describes a precise host, `ssh_user` defaults to the user running MLA. """
     name: str
     ssh_address: str
     ssh_port: int
     auth: bool
-    ssh_user: str = getlogin()
+    ssh_user: str = None
     ssh_password: str = ""
     ssh_key_file: str = ""
+    vars: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        if self.ssh_user is None:
+            self.ssh_user = default_user()
@@ -0,0 +1,123 @@
+""" Index of the hosts and groups of an inventory, hosts are built on demand. """
+
+import re
+from fnmatch import fnmatchcase
+
+from .host import Host
+
+GLOB_CHARS = set("*?[")
+
+
+class Inventory:
+    """ Hosts (name -> variables) and groups (name -> members) of an inventory.
+
+    The variables of a host are those of `all`, then of its groups in the
+    order they were declared, then its own; `Host` objects are only built
+    for the selected hosts.
+    """
+
+    def __init__(self):
+        self.hosts: dict[str, dict] = {}
+        self.groups: dict[str, set] = {"all": set()}
+        self.group_vars: dict[str, dict] = {"all": {}}
+        self.children: dict[str, list] = {}
+        self.host_groups: dict[str, list] = {}
+        self.position: dict[str, int] = {}
+
+    def add_host(self, name: str, params: dict = None, groups: list = ()) -> None:
+        """ Adds (or completes) a host and its group memberships. """
+        self.hosts.setdefault(name, {}).update(params or {})
+        self.host_groups.setdefault(name, [])
+        self.groups["all"].add(name)
+        for group in groups:
+            self.add_group(group, hosts=[name])
+
+    def add_group(self, name: str, hosts: list = (), variables: dict = None,
+                  children: list = ()) -> None:
+        """ Adds (or completes) a group, its direct members, variables and child groups. """
+        self.groups.setdefault(name, set())
+        self.group_vars.setdefault(name, {}).update(variables or {})
+        self.children.setdefault(name, []).extend(children)
+        for host in hosts:
+            if host not in self.hosts:
+                self.add_host(host)
+            if name not in self.host_groups[host]:
+                self.host_groups[host].append(name)
+            self.groups[name].add(host)
+
+    def resolve(self) -> None:
+        """ Adds the members of the child groups to their parents and indexes the positions. """
+        def members(group: str, seen: set) -> set:
+            if group in seen:
+                return set()
+            seen.add(group)
+            result = self.groups.setdefault(group, set())
+            for child in self.children.get(group, []):
+                for host in members(child, seen):
+                    if group not in self.host_groups[host]:
+                        self.host_groups[host].append(group)
+                    result.add(host)
+            return result
+
+        for group in list(self.children):
+            members(group, set())
+        self.position = {name: index for index, name in enumerate(self.hosts)}
+
+    def match(self, term: str) -> set:
+        """ Names of the hosts matched by a host name, group name, glob or `~regex`. """
+        if term.startswith("~"):
+            regex = re.compile(term[1:])
+            return {name for name in self.hosts if regex.match(name)}
+        if term in self.hosts:
+            return {term}
+        if term in self.groups:
+            return set(self.groups[term])
+        if GLOB_CHARS & set(term):
+            matched = {name for name in self.hosts if fnmatchcase(name, term)}
+            for group in self.groups:
+                if fnmatchcase(group, term):
+                    matched |= self.groups[group]
+            return matched
+        return set()
+
+    def select(self, pattern: str = "") -> list[str]:
+        """ Names of the hosts selected by a comma separated `pattern`, in inventory order.
+
+        Terms are unioned, `&term` intersects and `!term` excludes; an
+        empty pattern selects every host.
+        """
+        terms = [term.strip() for term in pattern.split(",") if term.strip()]
+        included = [term for term in terms if term[0] not in "&!"]
+        selected = set().union(*(self.match(term) for term in included)) \
+            if included else set(self.hosts)
+        for term in terms:
+            if term[0] == "&":
+                selected &= self.match(term[1:])
+            elif term[0] == "!":
+                selected -= self.match(term[1:])
+        if len(selected) == len(self.hosts):
+            return list(self.hosts)
+        return sorted(selected, key=self.position.__getitem__)
+
+    def variables(self, name: str) -> dict:
+        """ Variables of the host `name`, merged from `all`, its groups and itself. """
+        merged = dict(self.group_vars["all"])
+        for group in self.host_groups.get(name, []):
+            merged.update(self.group_vars.get(group, {}))
+        merged.update(self.hosts[name])
+        return merged
+
+    def host(self, name: str) -> Host:
+        """ Builds the `Host` of `name`. """
+        params = self.variables(name)
+        key_file = params.get("ssh_key_file")
+        return Host(
+            name,
+            params.get("ssh_address", name),
+            params.get("ssh_port", 22),
+            key_file is None,
+            params.get("ssh_user"),
+            params.get("ssh_password", "") if key_file is None else "",
+            key_file or "",
+            {name: value for name, value in params.items() if not name.startswith("ssh_")}
+        )
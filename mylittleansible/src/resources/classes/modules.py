@@ -1,344 +1,894 @@
-from os import listdir, path
-
-from resources.tools import execute_command, Logs
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from os import path, stat, walk
+from queue import Empty, Queue
+from shlex import quote
+from time import perf_counter, time
+from uuid import uuid4
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+from resources.decisions import (SERVICE_ACTIONS, SERVICE_REACHED, SYSCTL_DROPIN,
+                                 apt_cache_valid, apt_status, command_lines,
+                                 command_script, parse_command_output, plan_apt,
+                                 plan_service, plan_sysctl, read_dropin, service_section,
+                                 service_status, sysctl_commands, sysctl_file,
+                                 sysctl_status, sysctl_value)
+from resources.facts import (packages_command, parse_packages, parse_probes,
+                             parse_sections, probe_command)
+from resources.profiler import profiler
+from resources.registry import register_module
+from resources.scheduler import scheduler
+from resources.source_cache import SourceReader, source_cache
+from resources.templates import ENGINES, load_jinja2, template_cache
+from resources.tools import (execute_command, get_log_context, set_log_context,
+                             stdCloser, stream_command, Logs)
 
 
 class Base:
     """ Base of all modules. """
     module: str
     params: dict
-    logs: Logs
-    logger: any
-
-    def __init__(self, module: str, params: dict):
+    logs: Logs = Logs()
+    logger: any = logs.logger
+    facts: any
+    host: any
+    # parameters a todo must give, allowed values of some parameters
+    required: tuple = ()
+    choices: dict = {}
+    # consecutive todos of the module are given together to `process_batch`
+    batched: bool = False
+    # the todos of the module can be run by the agent of `resources/agent.py`
+    agent: bool = False
+
+    def __init__(self, module: str, params: dict, facts: any = None, host: any = None):
         self.module = module
         self.params = params
-        self.logs = Logs()
-        self.logs.setHandler()
-        self.logger = self.logs.logger
+        self.facts = facts
+        self.host = host
+
+    @classmethod
+    def check(cls, params: dict) -> list[str]:
+        """ Lists the problems of `params`, checked once when the todos are compiled. """
+        errors = [f"missing parameter `{name}`"
+                  for name in cls.required if name not in params]
+        for name, allowed in cls.choices.items():
+            if name in params and params[name] not in allowed:
+                errors.append(
+                    f"`{name}` must be one of {', '.join(str(value) for value in allowed)}")
+        return errors
+
+    @classmethod
+    def process_batch(cls, modules: list, ssh_client, ssh_password, ssh_host) -> list[str]:
+        """ Applies consecutive todos of the module, one after the other by default. """
+        return [module.process(ssh_client, ssh_password, ssh_host) for module in modules]
 
     def process(self, ssh_client, ssh_password="", ssh_host=""):
         """ Apply the action to `ssh_client` using `params`. """
         ...
 
 
+class _CountingWriter:
+    """ Write-only file wrapper counting the bytes going through it, charged to the `pool` bandwidth. """
+
+    def __init__(self, file: any, pool: str = ""):
+        self.file = file
+        self.pool = pool
+        self.count = 0
+        self.queued = 0.0
+
+    def write(self, data: bytes) -> int:
+        self.queued += scheduler.throttle(self.pool, len(data))
+        self.file.write(data)
+        self.count += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        self.file.flush()
+
+
+def _wait_acks(remote_file: any, window: int) -> None:
+    """ Waits for the oldest writes of a pipelined sftp file until at most `window` are unacknowledged.
+
+    paramiko keeps them in the private `_reqs` queue: without it, only
+    paramiko's own bound (about 100 requests) applies.
+    """
+    requests = getattr(remote_file, "_reqs", None)
+    read_response = getattr(remote_file.sftp, "_read_response", None)
+    if requests is None or read_response is None:
+        return
+    while len(requests) > window:
+        read_response(requests.popleft())
+
+
+@register_module("copy")
 class Copy(Base):
     """ extends `Base` and contains as parameters:
         - src: path of the file / directory to copy (str);
         - dest: destination path (str);
-        - backup: backup or not (bool).
+        - backup: backup or not (bool);
+        - compare: how unchanged files are detected, `size`, `mtime` or `sha256` (str, default `sha256`);
+        - archive: stream the files as one tar, `auto`, `always` or `never` (str, default `auto`);
+        - archive_threshold: in `auto` mode, number of files from which a tar is streamed (int, default 100);
+        - compression: compression of the tar stream, `none`, `gzip` or `zstd` (str, default `gzip`);
+        - parallel: number of sftp channels sending files at the same time (int, default 4);
+        - pipeline_threshold: size from which the writes of a file are pipelined (int, default 8 MiB);
+        - chunk_size: size of a pipelined write (int, default 32768);
+        - window: number of pipelined writes waiting for their ack (int, default 64);
+        - resume: continue a partial upload from the remote file's current size (bool).
     """
+    compare_modes = ('size', 'mtime', 'sha256')
+    compressions = {'none': ('w|', ''), 'gzip': ('w|gz', ' -z'), 'zstd': ('w|', ' --zstd')}
+    required = ("src", "dest")
+    choices = {
+        "compare": compare_modes,
+        "archive": ("auto", "always", "never"),
+        "compression": tuple(compressions),
+    }
+
+    @classmethod
+    def check(cls, params: dict) -> list[str]:
+        errors = super().check(params)
+        if "src" in params and not path.exists(params["src"]):
+            errors.append(f"no such file or directory: {params['src']}")
+        return errors
+
+    def __init__(self, module: str, params: dict, facts: any = None, host: any = None):
+        super().__init__(module, params, facts, host)
+
+    def local_files(self, src: str) -> dict:
+        """ Maps the path (relative to `dest`) of every file of `src` to its local path. """
+        _, item = path.split(src)
+        if path.isfile(src):
+            return {item: src}
+
+        files = {}
+        for root, _, names in walk(src):
+            for name in names:
+                local_path = path.join(root, name)
+                files[path.join(item, path.relpath(local_path, src))] = local_path
+        return files
+
+    def remote_files(self, ssh_client: any, dest: str, item: str, dirs: set) -> dict:
+        """ Creates the `dirs` and lists the remote side of `item` in one command. """
+        compare = self.params.get("compare", "sha256")
+        if compare == "sha256":
+            listing = "find ./{} -type f -exec sha256sum {{}} +"
+        else:
+            listing = "find ./{} -type f -printf '%s %T@  %p\\n'"
 
-    def __init__(self, module: str, params: dict):
-        super.__init__(module, params)
+        mkdir = " ".join(quote(f"{dest}/{directory}") for directory in sorted(dirs))
+        command = f"mkdir -p {mkdir} && cd {quote(dest)} && " + \
+            listing.format(quote(item))
+        stdout, _ = execute_command(self.logger, False, ssh_client, command)
 
-    def mkdir_p(self, sftp: any, remote_directory: str) -> None:
-        """ Recursively generates directory if doesn't exist on remote host. """
-        if remote_directory != '':
+        files = {}
+        for line in stdout.splitlines():
+            signature, _, remote_path = line.partition("  ")
+            files[remote_path[2:]] = signature
+        return files
+
+    def local_signature(self, local_path: str) -> str:
+        """ Computes the signature of a local file, as `remote_files` prints it. """
+        compare = self.params.get("compare", "sha256")
+        if compare == "sha256":
+            return source_cache.get(local_path).digest
+
+        stat_result = stat(local_path)
+        return f"{stat_result.st_size} {int(stat_result.st_mtime)}"
+
+    def unchanged(self, local_path: str, signature: str) -> bool:
+        """ Tells if the remote `signature` matches the local file. """
+        if signature is None:
+            return False
+        compare = self.params.get("compare", "sha256")
+        local = self.local_signature(local_path)
+        if compare == "size":
+            return local.split(" ")[0] == signature.split(" ")[0]
+        if compare == "mtime":
+            size, _, mtime = signature.partition(" ")
+            return local == f"{size} {int(float(mtime))}"
+        return local == signature
+
+    def use_archive(self, files_count: int) -> bool:
+        """ Tells if `files_count` files have to be streamed as a tar. """
+        archive = self.params.get("archive", "auto")
+        if archive == "auto":
+            return files_count >= self.params.get("archive_threshold", 100)
+        return archive == "always"
+
+    def put_archive(self, ssh_client: any, dest: str, files: dict) -> int:
+        """ Streams `files` as a tar through one channel into `tar -x`, returns the bytes sent. """
+        compression = self.params.get("compression", "gzip")
+        if compression == "zstd" and zstandard is None:
+            self.logger.warning(
+                "zstandard is not installed, falling back to gzip compression.")
+            compression = "gzip"
+        mode, tar_option = self.compressions[compression]
+
+        with profiler.measure("tar", dest) as measure:
+            # the files belong to the ssh user as with sftp
+            stdin, stdout, stderr = ssh_client.exec_command(
+                f"tar -x -p --no-same-owner{tar_option} -C {quote(dest)} -f -")
+            try:
+                wire = _CountingWriter(stdin, self.module)
+                stream = wire
+                if compression == "zstd":
+                    stream = zstandard.ZstdCompressor().stream_writer(wire, closefd=False)
+
+                with tarfile.open(fileobj=stream, mode=mode) as archive:
+                    for relative_path, local_path in files.items():
+                        source = source_cache.get(local_path)
+                        # built from stat: gettarinfo records the local owner, and its
+                        # back reference to the archive keeps the channel alive until a gc
+                        local_stat = stat(local_path)
+                        info = tarfile.TarInfo(relative_path)
+                        info.size = source.size
+                        info.mtime = local_stat.st_mtime
+                        info.mode = local_stat.st_mode & 0o7777
+                        archive.addfile(info, SourceReader(source))
+                if compression == "zstd":
+                    stream.close()
+                stdin.flush()
+                stdin.channel.shutdown_write()
+
+                errors = stderr.read().decode()
+                measure.bytes = wire.count
+                if stdout.channel.recv_exit_status() != 0:
+                    raise IOError(f"tar -x failed on the remote host: {errors}")
+            finally:
+                stdCloser(stdin, stdout, stderr)
+        if wire.queued:
+            profiler.record("queue", f"{self.module} bandwidth", wire.queued)
+        return wire.count
+
+    def same_prefix(self, ssh_client: any, remote_path: str, source: any, length: int) -> bool:
+        """ Tells if the first `length` bytes of the remote file are those of `source`. """
+        stdout, _ = execute_command(
+            self.logger, False, ssh_client, f"head -c {length} {quote(remote_path)} | sha256sum")
+        return stdout.split(" ")[0].strip() == sha256(source.data[:length]).hexdigest()
+
+    def put_file(self, sftp: any, local_path: str, remote_path: str, ssh_client: any) -> int:
+        """ Sends one file, pipelining the writes of the big ones, returns the bytes sent.
+
+        With `resume`, a shorter remote file is completed if it is a prefix of the source.
+        """
+        source = source_cache.get(local_path)
+        size = source.size
+        offset = 0
+        if self.params.get("resume", False):
             try:
-                sftp.chdir(remote_directory)
+                remote_size = sftp.stat(remote_path).st_size
             except IOError:
-                dirname, basename = path.split(remote_directory.rsplit('/'))
-                self.mkdir_p(sftp, dirname)
-                sftp.mkdir(basename)
-                sftp.chdir(dirname)
+                remote_size = 0
+            if 0 < remote_size < size:
+                if self.same_prefix(ssh_client, remote_path, source, remote_size):
+                    self.logger.info(
+                        f"Resuming {remote_path} from byte {remote_size}.")
+                    offset = remote_size
+                else:
+                    self.logger.info(
+                        f"{remote_path} differs from {local_path} in its first {remote_size} bytes, "
+                        f"sending it whole.")
+
+        # the buffer is shared by all the hosts the file is copied to
+        data = source.data
+        queued = 0.0
+        with sftp.open(remote_path, "r+" if offset else "w") as remote_file:
+            remote_file.set_pipelined(True)
+            remote_file.seek(offset)
+            if size < self.params.get("pipeline_threshold", 8 * 1024 * 1024):
+                queued += scheduler.throttle(self.module, size - offset)
+                remote_file.write(data[offset:])
+            else:
+                chunk_size = self.params.get("chunk_size", 32768)
+                window = self.params.get("window", 64)
+                for position in range(offset, size, chunk_size):
+                    chunk = data[position:position + chunk_size]
+                    queued += scheduler.throttle(self.module, len(chunk))
+                    remote_file.write(chunk)
+                    _wait_acks(remote_file, window)
+        if queued:
+            profiler.record("queue", f"{self.module} bandwidth", queued)
+        return size - offset
+
+    def upload(self, ssh_client: any, transfers: list) -> list[int]:
+        """ Sends the `(local_path, remote_path)` transfers over `parallel` sftp channels. """
+        pending = Queue()
+        for transfer in sorted(transfers, key=lambda transfer: -stat(transfer[0]).st_size):
+            pending.put(transfer)
+        sent = []
+        context = get_log_context()
+
+        def worker():
+            set_log_context(*context)
+            sftp = ssh_client.open_sftp()
+            try:
+                while True:
+                    try:
+                        local_path, remote_path = pending.get_nowait()
+                    except Empty:
+                        return
+                    start = perf_counter()
+                    with profiler.measure("sftp", remote_path) as measure:
+                        size = self.put_file(sftp, local_path, remote_path, ssh_client)
+                        if self.params.get("compare") == "mtime":
+                            stat_result = stat(local_path)
+                            sftp.utime(remote_path,
+                                       (stat_result.st_atime, stat_result.st_mtime))
+                        measure.bytes = size
+                    elapsed = perf_counter() - start
+                    sent.append(size)
+                    self.logger.info(
+                        f"put {local_path} on {remote_path}: {size} bytes in {elapsed:.3f}s "
+                        f"({size / max(elapsed, 1e-6) / 1024:.1f} KiB/s)")
+            finally:
+                sftp.close()
+
+        parallel = max(1, min(self.params.get("parallel", 4), len(transfers)))
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            for future in [pool.submit(worker) for _ in range(parallel)]:
+                future.result()
+        return sent
 
-    def put_dir(self, sftp: any, src: str, dest: str) -> None:
-        """ Send the whole directory to remote host. """
-        _, dir_name = path.split(src)
-        src_dir = listdir(src)
+    def process(self, ssh_client, ssh_password="", ssh_host=""):
+        src = path.abspath(self.params["src"]).rstrip('/')
+        dest = self.params["dest"].rstrip('/')
+        _, item = path.split(src)
 
-        for item in src_dir:
-            item_path = path.join(src, item)
+        if not path.exists(src):
+            self.logger.error(f"No such file or directory: {src}")
+            return "ko"
 
-            if path.isfile(item_path):
-                self.logger.debug(f"put file {item_path} on {dest}/{item}\n")
-                sftp.put(item_path, f"{dest}/{item}", confirm=False)
+        files = self.local_files(src)
+        dirs = {path.dirname(relative_path) for relative_path in files} | {""}
+        remote = self.remote_files(ssh_client, dest, item, dirs)
+        changed = [
+            relative_path for relative_path, local_path in sorted(files.items())
+            if not self.unchanged(local_path, remote.get(relative_path))
+        ]
 
-            elif path.isdir(item_path):
-                self.mkdir_p(sftp, f"{dest}/{dir_name}")
-                self.put_dir(sftp, item_path, f"{dest}/{dir_name}")
+        if not changed:
+            self.logger.info(f"{src}: {len(files)} file(s) already up to date.")
+            return "ok"
 
-    def process(self, ssh_client: any) -> None:
-        src = path.abspath(self.params["src"]).rstrip('/')
-        dest = self.params["dest"].rstrip('/')
-        _, item = path.split(src)
+        if self.use_archive(len(changed)):
+            start = perf_counter()
+            total_bytes = sum(stat(files[relative_path]).st_size
+                              for relative_path in changed)
+            try:
+                wire_bytes = self.put_archive(
+                    ssh_client, dest, {relative_path: files[relative_path]
+                                       for relative_path in changed})
+            except IOError as e:
+                self.logger.error(e.__str__())
+                return "ko"
+            elapsed = perf_counter() - start
+            self.logger.info(
+                f"{src}: {len(changed)} file(s) streamed as a tar, {len(files) - len(changed)} unchanged, "
+                f"{total_bytes} bytes ({wire_bytes} on the wire) in {elapsed:.3f}s "
+                f"({total_bytes / max(elapsed, 1e-6) / 1024:.1f} KiB/s).")
+            return "changed"
 
-        sftp = ssh_client.open_sftp()
+        from paramiko import SSHException
 
-        if path.isdir(src):
-            self.mkdir_p(sftp, f"{dest}/{item}")
-            self.put_dir(sftp, src, f"{dest}/{item}")
-        elif path.isfile(src):
-            self.mkdir_p(sftp, dest)
-            self.logger.debug(f"put single file {src} on {dest}/{item}")
-            sftp.put(src, f"{dest}/{item}", confirm=False)
+        total_start = perf_counter()
+        try:
+            sent = self.upload(ssh_client, [
+                (files[relative_path], f"{dest}/{relative_path}")
+                for relative_path in changed
+            ])
+        except (IOError, SSHException) as e:
+            self.logger.error(f"Transfer to {dest} failed: {e.__str__()}")
+            return "ko"
 
-        # return "successfully copied."
+        total_bytes = sum(sent)
+        elapsed = perf_counter() - total_start
+        self.logger.info(
+            f"{src}: {len(changed)} file(s) sent, {len(files) - len(changed)} unchanged, "
+            f"{total_bytes} bytes in {elapsed:.3f}s.")
+        return "changed"
 
 
+@register_module("template")
 class Template(Base):
     """ extends `Base` and contains as parameters:
         - src: path of the template (str);
         - dest: path of the file to template using the template (str);
-        - vars: variables to change in the templated file (dict).
+        - vars: variables to change in the templated file, added to the host's (dict);
+        - engine: `string` ($name placeholders) or `jinja2` (str, default `string`);
+        - mode: octal permissions of the file, e.g. "0644" (str).
     """
+    required = ("src", "dest")
+    choices = {"engine": ENGINES}
+
+    def __init__(self, module: str, params: dict, facts: any = None, host: any = None):
+        super().__init__(module, params, facts, host)
+
+    @classmethod
+    def check(cls, params: dict) -> list[str]:
+        errors = super().check(params)
+        if errors:
+            return errors
+        if params.get("engine") == "jinja2" and load_jinja2() is None:
+            return ["jinja2 is not installed"]
+        try:
+            # parsed once here, the hosts reuse the compiled template
+            template_cache.compile(path.abspath(params["src"]), params.get("engine", "string"))
+        except Exception as e:
+            errors.append(f"{params['src']} can't be compiled: {e.__str__()}")
+        return errors
+
+    def process(self, ssh_client, ssh_password="", ssh_host=""):
+        src = path.abspath(self.params["src"])
+        dest = self.params["dest"]
+        variables = {**(self.host.vars if self.host is not None else {}),
+                     **self.params.get("vars", {})}
+        try:
+            render = template_cache.render(src, self.params.get("engine", "string"), variables)
+        except KeyError as e:
+            self.logger.error(f"{src} can't be rendered for {ssh_host}: undefined variable {e}")
+            return "ko"
+        except Exception as e:
+            self.logger.error(f"{src} can't be rendered for {ssh_host}: {e.__str__()}")
+            return "ko"
+
+        # the checksum and the permissions in one call
+        stdout, _ = execute_command(
+            self.logger, False, ssh_client,
+            f"sha256sum {quote(dest)} 2>/dev/null && stat -c %a {quote(dest)}")
+        lines = stdout.split("\n")
+        if lines[0].split(" ")[0] == render.digest:
+            if "mode" not in self.params or self.same_mode(lines[1] if len(lines) > 1 else ""):
+                self.logger.info(f"{dest} already up to date on {ssh_host}.")
+                return "ok"
+            return self.set_mode(ssh_client, dest, ssh_host)
+
+        # written next to `dest` then renamed, readers never see a partial file
+        tmp = f"{dest}.mla.tmp"
+        command = f"mkdir -p {quote(path.dirname(dest) or '.')} && cat > {quote(tmp)}"
+        if "mode" in self.params:
+            command += f" && chmod {quote(str(self.params['mode']))} {quote(tmp)}"
+        command += f" && mv -f {quote(tmp)} {quote(dest)}"
+        queued = scheduler.throttle(self.module, len(render.data))
+        if queued:
+            profiler.record("queue", f"{self.module} bandwidth", queued)
+        with profiler.measure("command", command) as measure:
+            stdin, stdout, stderr = ssh_client.exec_command(command)
+            stdin.write(render.data)
+            stdin.flush()
+            stdin.channel.shutdown_write()
+            errors = stderr.read().decode()
+            measure.bytes = len(render.data)
+            if stdout.channel.recv_exit_status() != 0:
+                self.logger.error(f"{dest} can't be written on {ssh_host}: {errors}")
+                return "ko"
+
+        self.logger.info(f"{dest} templated on {ssh_host}, {len(render.data)} bytes sent"
+                         f"{f' after {queued:.3f}s queued' if queued else ''}.")
+        return "changed"
 
-    def __init__(self, module: str, params: dict):
-        super.__init__(module, params)
+    def same_mode(self, current: str) -> bool:
+        """ Tells if the permissions `current`, as `stat -c %a` prints them, are the `mode` param. """
+        try:
+            return int(current.strip(), 8) == int(str(self.params["mode"]), 8)
+        except ValueError:
+            return False
+
+    def set_mode(self, ssh_client: any, dest: str, ssh_host: str) -> str:
+        """ Only changes the permissions of `dest`, whose content is up to date. """
+        command = f"chmod {quote(str(self.params['mode']))} {quote(dest)}"
+        _, stderr, exit_status = stream_command(self.logger, False, ssh_client, command)
+        if exit_status != 0:
+            self.logger.error(f"The mode of {dest} can't be changed on {ssh_host}: {stderr}")
+            return "ko"
+        self.logger.info(f"{dest} up to date on {ssh_host}, mode set to {self.params['mode']}.")
+        return "changed"
 
 
+@register_module("service")
 class Service(Base):
     """ extends `Base` and contains as parameters:
         - name: name of the service (str);
-        - state: describing the state of the service (str).
+        - state: started, stopped, restarted, enabled or disabled (str).
     """
     launch_tuple = ('started', 'restarted', 'stopped')
     activation_tuple = ('enabled', 'disabled')
+    actions = SERVICE_ACTIONS
+    reached = SERVICE_REACHED
+    required = ("name", "state")
+    choices = {"state": tuple(actions)}
+    batched = True
+    agent = True
+
+    def __init__(self, module: str, params: dict, facts: any = None, host: any = None):
+        super().__init__(module, params, facts, host)
+        self.section = service_section(self.params)
+
+    @classmethod
+    def current_states(cls, modules: list, ssh_client: any) -> list[str]:
+        """ Reads the states of the units from the facts, probing the unknown ones at once. """
+        missing = {"active": set(), "enabled": set()}
+        for module in modules:
+            if module.facts is None or module.facts.get(module.section, module.params["name"]) is None:
+                missing[module.section].add(module.params["name"])
+
+        probed = {"active": {}, "enabled": {}}
+        if any(missing.values()):
+            stdout, _ = execute_command(
+                modules[0].logger, False, ssh_client,
+                "; ".join(probe_command(section, names) for section, names in missing.items()))
+            lines = parse_sections(stdout)
+            probed = {section: parse_probes(lines[section]) for section in probed}
+
+        states = []
+        for module in modules:
+            name = module.params["name"]
+            if name in probed[module.section]:
+                state = probed[module.section][name]
+                if module.facts is not None:
+                    module.facts.set(module.section, name, state)
+            else:
+                state = module.facts.get(module.section, name)
+            states.append(state)
+        return states
+
+    @classmethod
+    def process_batch(cls, modules: list, ssh_client, ssh_password, ssh_host) -> list[str]:
+        """ Applies consecutive service todos in one `systemctl` session returning the final states. """
+        first = modules[0]
+        current = {(module.section, module.params["name"]): state
+                   for module, state in zip(modules, cls.current_states(modules, ssh_client))}
+        statuses, expected, calls = plan_service([module.params for module in modules], current)
+        for module, status in zip(modules, statuses):
+            if status == "ok":
+                module.logger.info(
+                    f"{module.params['name']} already {module.params['state']} on {ssh_host}.")
+        to_change = [module for module, status in zip(modules, statuses)
+                     if status == "to change"]
+        if not to_change:
+            return statuses
+
+        script = "; ".join(
+            [f"systemctl {action} {' '.join(quote(name) for name in names)}"
+             for action, names in calls] +
+            [probe_command(section, {module.params["name"] for module in to_change
+                                     if module.section == section})
+             for section in ("active", "enabled")])
 
-    def __init__(self, module: str, params: dict):
-        super.__init__(module, params)
-
-    def service_state(self, ssh_client: any, ssh_password: str) -> str:
-        """ Determines service's state. """
-        command = ""
-        if self.params["state"] in self.launch_tuple:
-            command = f"sudo -S systemctl is-active {self.params['name']}"
-        elif self.params["state"] in self.activation_tuple:
-            command = f"sudo -S systemctl is-enabled {self.params['name']}"
-
-        if command == "":
-            return "failed"
-
-        stdout, _ = execute_command(
-            self.logger, True, ssh_client, command, ssh_password)
-        return stdout[:-1]
-
-    def executor(self, ssh_client: any, ssh_password: str, ssh_host: str, action: str) -> str:
-        """ Execute the actions and return the state. """
-        command = f"sudo -S systemctl {action} {self.params['name']}"
-        _, stderr = execute_command(
-            self.logger, True, ssh_client, command, ssh_password)
-
+        stdout, stderr = execute_command(
+            first.logger, True, ssh_client, script, ssh_password)
         if "incorrect" in stderr:
-            self.logger.info(
+            first.logger.error(
                 f"Incorrect password provided in inventory file for {ssh_host}. ")
-            self.logger.info(
+            first.logger.error(
                 f"Service module can't be executed without sudo password.")
-            self.logger.error(
-                f"No password were provided in inventory file for {ssh_host}. ")
-            self.logger.error(
-                f"Service module can't be executed without sudo password.")
-            return "incorrect"
-
-        return self.service_state(ssh_client, ssh_password)
+            return [status if status == "ok" else "ko" for status in statuses]
+
+        lines = parse_sections(stdout)
+        final = {(section, name): state for section in ("active", "enabled")
+                 for name, state in parse_probes(lines[section]).items()}
+        for position, module in enumerate(modules):
+            if statuses[position] != "to change":
+                continue
+            name = module.params["name"]
+            state = final.get((module.section, name))
+            if module.facts is not None:
+                if state is None:
+                    module.facts.forget(module.section, name)
+                else:
+                    module.facts.set(module.section, name, state)
+            statuses[position] = service_status(module.params, final, expected)
+            if statuses[position] == "ko":
+                module.logger.error(
+                    f"A problem occured when executing {cls.actions[module.params['state']]} "
+                    f"for {name} on {ssh_host}, current state is {state}. ")
+
+        return statuses
 
     def process(self, ssh_client, ssh_password, ssh_host):
-        action = self.params["state"][:-
-                                      2] if self.params["state"] != "stopped" else self.params["state"][:-3]
-
-        if "failed" in self.service_state(ssh_client, ssh_password):
-            self.logger.debug(
-                f"{self.params['name']} initial state on {ssh_host} is FAILED.")
-
-        exec = self.executor(ssh_client, ssh_password, ssh_host, action)
-        if "failed" in exec:
-            self.logger.info(
-                f"A problem occured when executing {action} for {self.params['name']} on {ssh_host}. ")
-            self.logger.info(f"Current state is {exec}")
-            self.logger.error(
-                f"A problem occured when executing {action} for {self.params['name']} on {ssh_host}. ")
-            self.logger.error(f"Current state is {exec}")
-            return "ko"
-
-        return "changed"
+        return self.process_batch([self], ssh_client, ssh_password, ssh_host)[0]
 
 
+@register_module("command")
 class Command(Base):
     """ extends `Base` and contains as parameters:
-        - command: name of the service (str);
-        - shell: describing the state of the service (str).
+        - command: commands to execute, one per line (str);
+        - max_lines: number of output lines kept per command (int, default 1000);
+        - pipelined: send all the lines in a single shell session (bool);
+        - stop_on_failure: in pipelined mode, stop at the first failing line (bool).
     """
+    required = ("command",)
+    agent = True
 
-    def __init__(self, module: str, params: dict):
-        super.__init__(module, params)
+    def __init__(self, module: str, params: dict, facts: any = None, host: any = None):
+        super().__init__(module, params, facts, host)
 
-    def process(self, ssh_client, ssh_host):
+    def process_pipelined(self, ssh_client, ssh_host, commands: list[str]) -> str:
+        """ Runs all `commands` over one channel and reports each of them. """
+        token = f"__MLA_{uuid4().hex}"
+        script = command_script(commands, token, self.params.get("stop_on_failure", False))
+        stdout, stderr = execute_command(
+            self.logger, False, ssh_client, f"sh -c {quote(script)}")
+        results, rest = parse_command_output(stdout, stderr, token)
+
+        status = "ok"
+        for result in results:
+            command = commands[result["index"]]
+            self.logger.info(
+                f"On {ssh_host}, executed command: {command} "
+                f"(exit code: {result['exit_code']}, duration: {result['duration']})\n")
+            self.logger.debug(
+                f"While executing {command} on {ssh_host}, STDOUT:")
+            self.logger.debug(f"{result['stdout']}\n")
+            self.logger.debug(
+                f"While executing {command} on {ssh_host}, STDERR:")
+            self.logger.debug(f"{result['stderr']}\n")
+            if result["exit_code"] != 0:
+                status = "ko"
+
+        executed = len(results)
+        if executed < len(commands):
+            self.logger.error(
+                f"On {ssh_host}, {len(commands) - executed} command(s) were not executed:\n" +
+                "\n".join(commands[executed:]))
+            self.logger.debug(
+                f"Output after the last command on {ssh_host}:\n{rest}")
+            status = "ko"
+
+        return status
+
+    def process(self, ssh_client, ssh_password="", ssh_host=""):
         commands = self.params["command"]
 
         self.logger.info(f"{ssh_host}: command list:\n{commands}\n")
         self.logger.info(
             "Make sure to be in debug mode to see stdout and stderr for each command.\n")
 
-        for command in commands.split('\n'):
-            stdout, stderr = execute_command(
-                self.logger, False, ssh_client, command)
-            self.logger.info(f"On {ssh_host}, executed command: {command}\n")
-
-            self.logger.debug(
-                f"While executing {command} on {ssh_host}, STDOUT:")
-            self.logger.debug(f"{stdout}\n")
+        if self.params.get("pipelined", False):
+            return self.process_pipelined(ssh_client, ssh_host, command_lines(self.params))
 
-            self.logger.debug(
-                f"While executing {command} on {ssh_host}, STDERR:")
-            self.logger.debug(f"{stderr}\n")
+        for command in command_lines(self.params):
+            _, _, exit_code = stream_command(
+                self.logger, False, ssh_client, command,
+                on_line=lambda stream, line: self.logger.debug(
+                    f"{ssh_host} {stream.upper()}: {line}"),
+                max_lines=self.params.get("max_lines", 1000))
+            self.logger.info(
+                f"On {ssh_host}, executed command: {command} (exit code: {exit_code})\n")
 
         return "ok"
 
 
+@register_module("sysctl")
 class SysCTL(Base):
     """ extends `Base` and contains as parameters:
         - attribute: kernel attribute to update (str);
         - value: value to link to the kernel attribute (any);
-        - permanent: permanemt or not (bool).
+        - permanent: permanemt or not (bool);
+        - file: drop-in holding the permanent values (str, default /etc/sysctl.d/99-zz-mla.conf).
     """
+    dropin = SYSCTL_DROPIN
+    required = ("attribute", "value", "permanent")
+    batched = True
+    agent = True
+
+    def __init__(self, module: str, params: dict, facts: any = None, host: any = None):
+        super().__init__(module, params, facts, host)
+        self.value = sysctl_value(self.params)
+        self.file = sysctl_file(self.params)
+
+    @classmethod
+    def process_batch(cls, modules: list, ssh_client, ssh_password, ssh_host) -> list[str]:
+        """ Applies consecutive sysctl todos with one read, one sudo session and one drop-in write per file. """
+        first = modules[0]
+        files = sorted({module.file for module in modules if module.params["permanent"]})
+        missing = {module.params["attribute"] for module in modules
+                   if module.facts is None
+                   or module.facts.get("sysctl", module.params["attribute"]) is None}
+
+        current, dropins = {}, {file: {} for file in files}
+        if missing or files:
+            stdout, _ = execute_command(
+                first.logger, False, ssh_client, "; ".join(
+                    [probe_command("sysctl", missing)] +
+                    [f"echo {quote('== file ' + file)}; cat {quote(file)} 2>/dev/null"
+                     for file in files]))
+            lines = parse_sections(stdout)
+            current = parse_probes(lines["sysctl"])
+            dropins = {file: read_dropin(lines.get(f"file {file}", [])) for file in files}
+        for module in modules:
+            attribute = module.params["attribute"]
+            if attribute in current:
+                if module.facts is not None:
+                    module.facts.set("sysctl", attribute, current[attribute])
+            else:
+                current[attribute] = module.facts.get("sysctl", attribute)
+            current[attribute] = " ".join((current[attribute] or "").split())
+
+        # the last todo of an attribute wins, as if they ran one after the other
+        statuses, expected, wanted = plan_sysctl(
+            [module.params for module in modules], current, dropins)
+        for module, status in zip(modules, statuses):
+            attribute = module.params["attribute"]
+            if status == "ok":
+                module.logger.info(f"{attribute} already set to {module.value} on {ssh_host}.")
+            else:
+                module.logger.debug(
+                    f"{attribute} < > {module.value} on {ssh_host}, current: {current[attribute]}")
+        if "to change" not in statuses:
+            return statuses
+
+        commands = sysctl_commands([module.params for module in modules], statuses, dropins, wanted)
+        commands.append(probe_command(
+            "sysctl", {module.params["attribute"] for module in modules}))
 
-    def __init__(self, module: str, params: dict):
-        super.__init__(module, params)
-
-    def none_perm_module_state(self, ssh_client: any, ssh_password: str) -> str:
-        """ Determines the module's NON PERMANENT state. """
-        command = f"sudo -S sysctl -n {self.params['attribute']}"
-        stdout, _ = execute_command(
-            self.logger, True, ssh_client, command, ssh_password)
-
-        return stdout[:-1]
-
-    def permanent_module_state(self, ssh_client: any, ssh_password: str) -> any:
-        """ Determines the module's PERMANENT state. """
-        command = f'cat /etc/sysctl.conf | grep {self.params["attribute"]} | cut -d "=" -f2'
-        stdout, _ = execute_command(self.logger, False, ssh_client, command)
-        value = stdout[:-1]
-        none_perm_value = self.none_perm_module_state(ssh_client, ssh_password)
-
-        return none_perm_value, value
-
-    def executor(self, ssh_client: any, ssh_password: str) -> str:
-        """ Applies changes to the given ssh_host's kernel. """
-        if not self.params["permanent"]:
-            command = f'sudo -S sysctl -w {self.params["attribute"]}={str(self.params["value"])}'
-            execute_command(self.logger, True, ssh_client,
-                            command, ssh_password)
-            return self.none_perm_module_state(ssh_client, ssh_password)
-
-        none_perm_value, _ = self.permanent_module_state(
-            ssh_client, ssh_password
-        )
-
-        if none_perm_value != self.params['value']:
-            command = f'sudo -S echo {self.params["attribute"]}={self.params["value"]} >> /etc/sysctl.conf'
-            execute_command(self.logger, True, ssh_client,
-                            command, ssh_password)
-
-        command = "sudo -S sysctl -p"
-        execute_command(self.logger, True, ssh_client, command, ssh_password)
-        return self.none_perm_module_state(ssh_client, ssh_password)
+        stdout, stderr = execute_command(
+            first.logger, True, ssh_client, "; ".join(commands), ssh_password)
+        if "incorrect" in stderr:
+            first.logger.error(
+                f"Incorrect password provided in inventory file for {ssh_host}. ")
+            first.logger.error(
+                f"SysCTL module can't be executed without sudo password.")
+            return [status if status == "ok" else "ko" for status in statuses]
+
+        final = {attribute: " ".join(value.split()) for attribute, value
+                 in parse_probes(parse_sections(stdout)["sysctl"]).items()}
+        for position, module in enumerate(modules):
+            attribute = module.params["attribute"]
+            if module.facts is not None:
+                if attribute in final:
+                    module.facts.set("sysctl", attribute, final[attribute])
+                else:
+                    module.facts.forget("sysctl", attribute)
+            if statuses[position] != "to change":
+                continue
+            statuses[position] = sysctl_status(module.params, final, expected)
+            if statuses[position] == "ko":
+                module.logger.error(
+                    f"{attribute} <--- {module.value} FAILED on {ssh_host}, current: {final.get(attribute)}")
+
+        return statuses
 
     def process(self, ssh_client, ssh_password, ssh_host):
-        if not self.params['permanent']:
-            none_perm_value = self.none_perm_module_state(
-                ssh_client, ssh_password)
-            if self.params['value'] != none_perm_value:
-                self.logger.debug(
-                    f"{self.params['attribute']} < > {self.params['value']} on {ssh_host}, current: {none_perm_value}"
-                )
-        else:
-            none_perm_value, perm_value = self.permanent_module_state(
-                ssh_client, ssh_password)
-            if none_perm_value != self.params['value']:
-                self.logger.debug(
-                    f"{self.params['attribute']}={self.params['value']} not applied permanently yet on {ssh_host}. ")
-                self.logger.debug(f"Currently value: {none_perm_value}. ")
-                self.logger.debug(
-                    f"Currently defined in /etc/sysctl.conf file: {perm_value}")
-
-        if none_perm_value == self.params['value']:
-            return "ok"
-
-        module_value = self.executor(ssh_client, ssh_password)
-
-        if module_value == self.params['value']:
-            return "changed"
-
-        self.logger.debug(
-            f"{self.params['attribute']} <--- {self.params['value']} FAILED on {ssh_host}, current: {module_value}"
-        )
-
-        return "ko"
+        return self.process_batch([self], ssh_client, ssh_password, ssh_host)[0]
 
 
+@register_module("apt")
 class Apt(Base):
     """ extends `Base` and contains as parameters:
         - name: name of the package;
-        - state: install (present) or uninstall (absent) the package (str).
+        - state: install (present) or uninstall (absent) the package (str);
+        - cache_valid_time: skip `apt-get update` if it ran less than this many seconds ago (int).
     """
     action: str
+    required = ("name", "state")
+    choices = {"state": ("present", "absent")}
+    batched = True
+    agent = True
 
-    def __init__(self, module: str, params: dict):
-        super.__init__(module, params)
+    def __init__(self, module: str, params: dict, facts: any = None, host: any = None):
+        super().__init__(module, params, facts, host)
         self.action = "install" if self.params["state"] == "present" else "uninstall"
 
-    def executor(self, ssh_client: any, ssh_host: str) -> str:
-        """ Execute the actions and return the state. """
-        command = f'dpkg -s {self.params["name"]} | grep "Status"'
-        stdout, _ = execute_command(self.logger, False, ssh_client, command)
-
-        if self.params["state"] == "present":
-            if "ok installed" in stdout:
-                self.logger.info(
-                    f"{self.params['name']} already installed on {ssh_host}. Todos DONE with status OK.")
-                return "ok"
-        elif self.params["state"] == "absent":
-            if "ok installed" not in stdout:
-                self.logger.info(
-                    f"{self.params['name']} already uninstalled on {ssh_host}. Todos DONE with status OK.")
-                return "ok"
+    @classmethod
+    def current_states(cls, modules: list, ssh_client: any) -> dict:
+        """ Reads the states of the packages from the facts, querying the unknown ones at once. """
+        installed, missing = {}, set()
+        for module in modules:
+            name = module.params["name"]
+            state = module.facts.get("packages", name) if module.facts is not None else None
+            if state is None:
+                missing.add(name)
+            else:
+                installed[name] = state
+        if missing:
+            stdout, _ = execute_command(
+                modules[0].logger, False, ssh_client, packages_command(missing))
+            for name, state in parse_packages(stdout, missing).items():
+                installed[name] = state
+                if modules[0].facts is not None:
+                    modules[0].facts.set("packages", name, state)
+        return installed
+
+    @classmethod
+    def cache_valid(cls, modules: list, ssh_host: str) -> bool:
+        """ Tells if the last `apt-get update` is younger than the `cache_valid_time` of all the `modules`. """
+        facts = modules[0].facts
+        updated_at = facts.get("apt", "updated_at") if facts is not None else None
+        if updated_at is None or not apt_cache_valid(
+                [module.params for module in modules], float(updated_at), time()):
+            return False
+        modules[0].logger.debug(
+            f"apt cache of {ssh_host} updated {int(time() - float(updated_at))}s ago, "
+            f"skipping `apt-get update`.")
+        return True
+
+    @classmethod
+    def process_batch(cls, modules: list, ssh_client, ssh_password, ssh_host) -> list[str]:
+        """ Applies consecutive apt todos with a single update and one install/autoremove per run.
+
+        The todos are planned as if they ran one after the other: a package
+        installed then removed in the same batch splits it in two runs.
+        """
+        first = modules[0]
+        statuses, expected, runs = plan_apt(
+            [module.params for module in modules], cls.current_states(modules, ssh_client))
+        for module, status in zip(modules, statuses):
+            if status == "ok":
+                module.logger.info(
+                    f"{module.params['name']} already "
+                    f"{'installed' if module.action == 'install' else 'uninstalled'} on {ssh_host}. "
+                    f"Todos DONE with status OK.")
+        if not runs:
+            return statuses
+
+        to_install = [modules[position] for run in runs for position in run["install"]]
+        if to_install and not cls.cache_valid(to_install, ssh_host):
+            _, stderr = execute_command(
+                first.logger,
+                True,
+                ssh_client,
+                "apt-get update",
+                ssh_password
+            )
+            if "incorrect" in stderr:
+                first.logger.warning(
+                    f"Incorrect password provided in inventory file for {ssh_host}. ")
+                first.logger.warning(
+                    f"apt module can't be executed without sudo password.")
+                first.logger.error(
+                    f"No password were provided in inventory file for {ssh_host}. ")
+                first.logger.error(
+                    f"apt module can't be executed without sudo password.")
+                return [state if state == "ok" else "ko" for state in statuses]
+            if first.facts is not None:
+                first.facts.set("apt", "updated_at", time())
+
+        for run in runs:
+            for action, command in (("install", "apt-get install -y"),
+                                    ("uninstall", "apt-get autoremove -y")):
+                if not run[action]:
+                    continue
+                names = " ".join(quote(modules[position].params["name"])
+                                 for position in run[action])
+                _, stderr, exit_status = stream_command(
+                    first.logger,
+                    True,
+                    ssh_client,
+                    f"{command} {names}",
+                    ssh_password,
+                    on_line=lambda stream, line: first.logger.debug(
+                        f"{ssh_host} apt {stream.upper()}: {line}"),
+                    max_lines=200
+                )
+                if exit_status != 0:
+                    first.logger.error(
+                        f"While trying to {action} {names} on {ssh_host}, exit code {exit_status}, STDERR:\n{stderr}")
 
-        return "to change"
+        # one status query tells which of the todos were applied
+        names = set(expected)
+        stdout, _ = execute_command(
+            first.logger, False, ssh_client, packages_command(names))
+        installed = parse_packages(stdout, names)
+
+        for position, module in enumerate(modules):
+            if statuses[position] == "ok":
+                continue
+            name = module.params["name"]
+            if module.facts is not None:
+                module.facts.set("packages", name, installed[name])
+            statuses[position] = apt_status(module.params, installed, expected)
+            if statuses[position] == "ko":
+                first.logger.error(
+                    f"Failed to {module.action} {name} on {ssh_host}.")
+
+        return statuses
 
     def process(self, ssh_client, ssh_password, ssh_host):
-        command = f'echo "{ssh_password}" | sudo -S apt-get update'
-        _, stderr = execute_command(
-            self.logger,
-            True,
-            ssh_client,
-            command,
-            ssh_password
-        )
-
-        if "incorrect" in stderr:
-            self.logger.warning(
-                f"Incorrect password provided in inventory file for {ssh_host}. ")
-            self.logger.warning(
-                f"apt module can't be executed without sudo password.")
-            self.logger.error(
-                f"No password were provided in inventory file for {ssh_host}. ")
-            self.logger.error(
-                f"apt module can't be executed without sudo password.")
-            return "ko"
-        state = self.executor(ssh_client, ssh_host)
-
-        if state == "ok":
-            return state
-
-        install_cmd = f'echo "{ssh_password}" | sudo -S apt-get install -y {self.params["name"]}'
-        uninstall_cmd = f'echo "{ssh_password}" | sudo -S apt-get auto-remove -y {self.params["name"]}'
-        command = install_cmd if self.action == "install" else uninstall_cmd
-
-        stdout, stderr = execute_command(
-            self.logger,
-            True,
-            ssh_client,
-            command,
-            ssh_password
-        )
-
-        self.logger.debug(
-            f"While trying to {self.action} {self.params['name']}, STDOUT:\n{stdout}")
-
-        if stderr != "" and "dpkg-preconfigure: unable to re-open stdin:" not in stderr:
-            self.logger.error(
-                f"While trying to {self.action} {self.params['name']}, STDERR:\n{stderr}")
-            return "ko"
-
-        return "changed"
+        return self.process_batch([self], ssh_client, ssh_password, ssh_host)[0]
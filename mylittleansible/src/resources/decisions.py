@@ -0,0 +1,249 @@
+""" Decisions of the batched modules, shared by `classes/modules.py` and the agent.
+
+Pure functions of the todo params and of the states read on the host: they
+tell which todos are already done and which commands apply the others.
+`agent.py` prepends this file to `agent_helper.py` before sending it to
+the hosts, so it only uses the python3 standard library and no f-strings.
+"""
+
+import os
+import re
+
+try:
+    from shlex import quote
+except ImportError:  # pragma: no cover
+    from pipes import quote
+
+APT_ACTIONS = {"present": "install", "absent": "uninstall"}
+# modified by `apt-get update`, the first one found tells when it last ran
+APT_UPDATE_STAMPS = ("/var/lib/apt/periodic/update-success-stamp", "/var/lib/apt/lists")
+
+SERVICE_ACTIONS = {
+    "started": "start",
+    "restarted": "restart",
+    "stopped": "stop",
+    "enabled": "enable",
+    "disabled": "disable",
+}
+# states of `systemctl is-active` / `is-enabled` meeting each wanted state
+SERVICE_REACHED = {
+    "started": ("active",),
+    "restarted": ("active",),
+    "stopped": ("inactive", "failed"),
+    "enabled": ("enabled",),
+    "disabled": ("disabled",),
+}
+
+# sorted after the `99-sysctl.conf` link to /etc/sysctl.conf that Debian and Ubuntu ship,
+# the last file read wins
+SYSCTL_DROPIN = "/etc/sysctl.d/99-zz-mla.conf"
+SYSCTL_HEADER = "# Managed by MLA, local changes are overwritten.\n"
+
+
+def plan_apt(todos, installed):
+    """ Plans consecutive apt todos as if they ran one after the other.
+
+    `todos` are the params of the todos, `installed` maps each package to
+    "present" or "absent". Returns the status of each todo ("ok" or "to
+    change"), the state expected for each package once all of them are
+    applied, and the runs of apt-get: each run is a dict of "install" and
+    "uninstall" todo positions, installed then removed in one call each; a
+    new run starts when a package changes direction.
+    """
+    expected = {}
+    statuses = []
+    runs = []
+    for position, params in enumerate(todos):
+        name, state = params["name"], params["state"]
+        if expected.get(name, installed[name]) == state:
+            statuses.append("ok")
+            continue
+        statuses.append("to change")
+        expected[name] = state
+        opposite = "uninstall" if APT_ACTIONS[state] == "install" else "install"
+        if not runs or any(todos[other]["name"] == name for other in runs[-1][opposite]):
+            runs.append({"install": [], "uninstall": []})
+        runs[-1][APT_ACTIONS[state]].append(position)
+    return statuses, expected, runs
+
+
+def apt_status(params, final, expected):
+    """ Status of an applied apt todo, given the `final` state of its package.
+
+    A later todo of the batch may have changed the package again, reaching
+    the `expected` state counts as done too.
+    """
+    state = final.get(params["name"])
+    return "changed" if state in (params["state"], expected[params["name"]]) else "ko"
+
+
+def apt_cache_valid(todos, updated_at, now):
+    """ Tells if the last `apt-get update` is younger than the `cache_valid_time` of all the `todos`. """
+    if updated_at is None:
+        return False
+    return all("cache_valid_time" in params and now - updated_at < params["cache_valid_time"]
+               for params in todos)
+
+
+def service_section(params):
+    """ "enabled" for the todos enabling or disabling a unit, "active" for the others. """
+    return "enabled" if params["state"] in ("enabled", "disabled") else "active"
+
+
+def plan_service(todos, current):
+    """ Plans consecutive service todos as if they ran one after the other.
+
+    `current` maps each `(section, name)` to its state. Returns the status
+    of each todo ("ok" or "to change"), the state expected for each unit
+    once all of them are applied, and the `systemctl` calls as `(action,
+    names)`: consecutive todos of the same action share a call, the order
+    is kept.
+    """
+    expected = {}
+    statuses = []
+    calls = []
+    for params in todos:
+        key = (service_section(params), params["name"])
+        state = expected.get(key, current.get(key))
+        expected[key] = SERVICE_REACHED[params["state"]][0]
+        if params["state"] != "restarted" and state in SERVICE_REACHED[params["state"]]:
+            statuses.append("ok")
+            continue
+        statuses.append("to change")
+        action = SERVICE_ACTIONS[params["state"]]
+        if calls and calls[-1][0] == action:
+            calls[-1][1].append(params["name"])
+        else:
+            calls.append((action, [params["name"]]))
+    return statuses, expected, calls
+
+
+def service_status(params, final, expected):
+    """ Status of an applied service todo, given the `final` states of the units. """
+    key = (service_section(params), params["name"])
+    state = final.get(key)
+    # a later todo of the batch may have changed the unit again
+    return "changed" if state in SERVICE_REACHED[params["state"]] or state == expected[key] \
+        else "ko"
+
+
+def sysctl_value(params):
+    """ Value of a sysctl todo, its whitespace normalized as `sysctl -n` prints it. """
+    return " ".join(str(params["value"]).split())
+
+
+def sysctl_file(params):
+    """ Drop-in holding the value of a permanent sysctl todo. """
+    return params.get("file", SYSCTL_DROPIN)
+
+
+def read_dropin(lines):
+    """ Parses the `attribute = value` lines of a drop-in. """
+    values = {}
+    for line in lines:
+        line = line.strip()
+        if line and line[0] not in "#;" and "=" in line:
+            attribute, _, value = line.partition("=")
+            values[attribute.strip()] = " ".join(value.split())
+    return values
+
+
+def write_dropin(values):
+    """ Formats the content of a drop-in. """
+    return SYSCTL_HEADER + "".join(
+        "%s = %s\n" % (attribute, value) for attribute, value in values.items())
+
+
+def plan_sysctl(todos, current, dropins):
+    """ Plans consecutive sysctl todos, the last todo of an attribute wins.
+
+    `current` maps each attribute to its normalized value, `dropins` maps
+    each drop-in of the permanent todos to its values. Returns the status
+    of each todo ("ok" or "to change"), the value expected for each
+    attribute and the values wanted in each drop-in.
+    """
+    expected = dict(current)
+    wanted = dict((file, dict(values)) for file, values in dropins.items())
+    statuses = []
+    for params in todos:
+        attribute, value = params["attribute"], sysctl_value(params)
+        in_file = not params["permanent"] or wanted[sysctl_file(params)].get(attribute) == value
+        if expected.get(attribute) == value and in_file:
+            statuses.append("ok")
+            continue
+        expected[attribute] = value
+        if params["permanent"]:
+            wanted[sysctl_file(params)][attribute] = value
+        statuses.append("to change")
+    return statuses, expected, wanted
+
+
+def sysctl_commands(todos, statuses, dropins, wanted):
+    """ Commands applying the planned sysctl todos, to run as root. """
+    commands = []
+    runtime = [params for params, status in zip(todos, statuses)
+               if status == "to change" and not params["permanent"]]
+    if runtime:
+        commands.append("sysctl -w " + " ".join(
+            quote("%s=%s" % (params["attribute"], sysctl_value(params))) for params in runtime))
+    for file in sorted(dropins):
+        # written next to the target and renamed, `sysctl -p` (--load) applies it
+        if wanted[file] != dropins[file]:
+            tmp = file + ".mla.tmp"
+            commands.append("mkdir -p %s && printf '%%s' %s > %s && mv -f %s %s" % (
+                quote(os.path.dirname(file) or "."), quote(write_dropin(wanted[file])),
+                quote(tmp), quote(tmp), quote(file)))
+        if any(status == "to change" and params["permanent"] and sysctl_file(params) == file
+               for params, status in zip(todos, statuses)):
+            commands.append("sysctl -p %s > /dev/null" % quote(file))
+    return commands
+
+
+def sysctl_status(params, final, expected):
+    """ Status of an applied sysctl todo, given the `final` values of the attributes. """
+    return "changed" if final.get(params["attribute"]) in (
+        sysctl_value(params), expected[params["attribute"]]) else "ko"
+
+
+def command_lines(params):
+    """ The non blank lines of a command todo, one command each. """
+    return [line for line in params["command"].split("\n") if line.strip()]
+
+
+def command_script(commands, token, stop_on_failure):
+    """ Chains `commands` in one script, each one followed by in-band markers. """
+    lines = []
+    for index, command in enumerate(commands):
+        lines += [
+            "__mla_start=$(date +%s%N)",
+            command,
+            "__mla_rc=$?",
+            "__mla_end=$(date +%s%N)",
+            "printf '\\n%s %%d %%d %%s %%s\\n' %d $__mla_rc $__mla_start $__mla_end" % (token, index),
+            "printf '\\n%s %%d\\n' %d >&2" % (token, index),
+        ]
+        if stop_on_failure:
+            lines.append('[ "$__mla_rc" -eq 0 ] || exit "$__mla_rc"')
+    return "\n".join(lines)
+
+
+def parse_command_output(stdout, stderr, token):
+    """ Splits the output of a `command_script` per command.
+
+    Returns a dict per executed command (index, exit_code, duration,
+    stdout, stderr), then the output printed after the last marker.
+    """
+    # every chunk is followed by the marker of the command that printed it
+    stdout_parts = re.split(r"\n%s (\d+) (-?\d+) (\S+) (\S+)\n" % token, stdout)
+    stderr_parts = re.split(r"\n%s (\d+)\n" % token, stderr)
+    stderrs = dict(zip(stderr_parts[1::2], stderr_parts[0::2]))
+    results = []
+    for position in range(0, len(stdout_parts) - 1, 5):
+        output, index, exit_code, start, end = stdout_parts[position:position + 5]
+        try:
+            duration = "%.3fs" % ((int(end) - int(start)) / 1e9)
+        except ValueError:
+            duration = "unknown"
+        results.append({"index": int(index), "exit_code": int(exit_code), "duration": duration,
+                        "stdout": output, "stderr": stderrs.get(index, "")})
+    return results, stdout_parts[-1] + stderr_parts[-1]
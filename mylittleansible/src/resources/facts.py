@@ -0,0 +1,167 @@
+""" Host facts (packages status, units states and kernel parameters).
+
+Facts are gathered in a single remote command and kept in a per-host
+cache (`~/.mla/facts/<host>.json`) for `ttl` seconds.
+"""
+
+import json
+import os
+import time
+from os import path
+from shlex import quote
+
+from resources.decisions import APT_UPDATE_STAMPS
+from resources.tools import MLA_HOME, execute_command
+
+FACTS_DIR = path.join(MLA_HOME, "facts")
+SECTIONS = ("packages", "active", "enabled", "sysctl", "apt")
+PROBES = {
+    "active": "systemctl is-active",
+    "enabled": "systemctl is-enabled",
+    "sysctl": "sysctl -n",
+}
+
+
+def packages_command(names: list) -> str:
+    """ Builds the command printing the dpkg status of the `names` packages. """
+    packages = " ".join(quote(name) for name in sorted(names))
+    return f"dpkg-query -W -f='${{Package}}\t${{Status}}\n' {packages} 2>/dev/null"
+
+
+def parse_packages(stdout: str, names: list) -> dict:
+    """ Maps each of the `names` packages to "present" or "absent". """
+    installed = {name: "absent" for name in names}
+    for line in stdout.splitlines():
+        name, _, status = line.partition("\t")
+        if "ok installed" in status:
+            installed[name] = "present"
+    return installed
+
+
+def probe_command(section: str, names) -> str:
+    """ Builds the command printing the `section` value of each of the `names`. """
+    commands = [f"echo '== {section}'"]
+    for name in sorted(names):
+        commands.append(
+            f"printf '%s\\t%s\\n' {quote(name)} \"$({PROBES[section]} {quote(name)} 2>/dev/null)\"")
+    return "; ".join(commands)
+
+
+def parse_sections(stdout: str) -> dict:
+    """ Splits the output of the probes in lines per section. """
+    section = None
+    lines = {section: [] for section in SECTIONS}
+    for line in stdout.splitlines():
+        if line.startswith("== "):
+            section = line[3:]
+        elif section is not None:
+            lines.setdefault(section, []).append(line)
+    return lines
+
+
+def parse_probes(lines: list) -> dict:
+    """ Maps the names of the probe lines of a section to their values. """
+    return dict(line.partition("\t")[::2] for line in lines)
+
+
+def wanted_facts(todos: list) -> dict:
+    """ Lists the facts the `todos` will read, per section. """
+    wanted = {section: set() for section in SECTIONS}
+    for todo in todos:
+        if todo.module == "apt":
+            wanted["packages"].add(todo.params["name"])
+            wanted["apt"].add("updated_at")
+        elif todo.module == "service":
+            section = "enabled" if todo.params["state"] in ("enabled", "disabled") else "active"
+            wanted[section].add(todo.params["name"])
+        elif todo.module == "sysctl":
+            wanted["sysctl"].add(todo.params["attribute"])
+    return wanted
+
+
+class Facts:
+    """ Facts of a precise host, read by the modules instead of probing it. """
+
+    def __init__(self, host_name: str, ttl: float, logger):
+        self.host_name = host_name
+        self.ttl = ttl
+        self.logger = logger
+        self.cache_path = path.join(FACTS_DIR, f"{host_name}.json")
+        self.gathered_at = 0.0
+        self.values: dict = {section: {} for section in SECTIONS}
+
+    def get(self, section: str, name: str):
+        """ Returns the known value of `name`, None if it has to be probed. """
+        return self.values[section].get(name)
+
+    def set(self, section: str, name: str, value: str) -> None:
+        """ Records the value observed (or applied) by a module. """
+        self.values[section][name] = value
+
+    def forget(self, section: str, name: str) -> None:
+        """ Drops a fact that can't be trusted anymore. """
+        self.values[section].pop(name, None)
+
+    def load(self) -> None:
+        """ Loads the cached facts if they are younger than `ttl`. """
+        if self.ttl <= 0 or not path.isfile(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as cache:
+                cached = json.load(cache)
+        except (OSError, ValueError):
+            return
+        if time.time() - cached["gathered_at"] < self.ttl:
+            self.gathered_at = cached["gathered_at"]
+            self.values.update(cached["values"])
+
+    def save(self) -> None:
+        """ Writes the facts in the cache, atomically. """
+        if self.ttl <= 0:
+            return
+        os.makedirs(FACTS_DIR, mode=0o700, exist_ok=True)
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as cache:
+            json.dump({"gathered_at": self.gathered_at,
+                       "values": self.values}, cache)
+        os.replace(tmp_path, self.cache_path)
+
+    def gather_command(self, missing: dict) -> str:
+        """ Builds the single command printing the `missing` facts. """
+        commands = [
+            "echo '== packages'",
+            packages_command(missing["packages"]) if missing["packages"] else "true",
+            "echo '== apt'",
+        ]
+        if missing["apt"]:
+            # the age of the last `apt-get update`, the host clock may differ
+            commands.append(
+                f"__mla_apt=$(stat -c %Y {' '.join(APT_UPDATE_STAMPS)} 2>/dev/null | head -n 1); "
+                "printf 'updated_at\\t%s\\n' $(( $(date +%s) - ${__mla_apt:-0} ))")
+        for section in PROBES:
+            commands.append(probe_command(section, missing[section]))
+        return "; ".join(commands)
+
+    def gather(self, ssh_client, wanted: dict) -> None:
+        """ Gathers the `wanted` facts not already known, in one round trip. """
+        missing = {
+            section: {name for name in names if name not in self.values[section]}
+            for section, names in wanted.items()
+        }
+        if not any(missing.values()):
+            self.logger.debug(f"Facts of {self.host_name} read from the cache.")
+            return
+
+        stdout, _ = execute_command(
+            self.logger, False, ssh_client, self.gather_command(missing))
+
+        lines = parse_sections(stdout)
+        self.values["packages"].update(
+            parse_packages("\n".join(lines["packages"]), missing["packages"]))
+        for section in PROBES:
+            self.values[section].update(parse_probes(lines[section]))
+        for line in lines["apt"]:
+            name, _, age = line.partition("\t")
+            self.values["apt"][name] = time.time() - int(age)
+        self.gathered_at = self.gathered_at or time.time()
+        self.logger.debug(f"Facts of {self.host_name} gathered.")
@@ -0,0 +1,104 @@
+""" Journal of a run: the status of each step of each host, as it completes.
+
+Records are JSON lines appended to the journal; they are buffered and
+written (under `flock`, so that several runs can share a journal) then
+fsynced every `batch_size` records, every `interval` seconds by a
+background thread, and when the journal is closed. `--resume` reads the
+journal of the previous run and skips the steps it records as ok or
+changed for the same todo content.
+"""
+
+import fcntl
+import json
+import os
+import threading
+from hashlib import sha256
+from os import path
+from time import time
+
+from resources.tools import MLA_HOME
+
+JOURNALS_DIR = path.join(MLA_HOME, "journals")
+DONE = ("ok", "changed")
+
+
+def journal_path(todos_file_path: str, inventory_file_path: str) -> str:
+    """ Default journal of the runs of these todos on this inventory. """
+    key = f"{path.abspath(todos_file_path)}\0{path.abspath(inventory_file_path)}"
+    return path.join(JOURNALS_DIR, sha256(key.encode()).hexdigest()[:16] + ".jsonl")
+
+
+class Journal:
+    """ Thread safe, append only writer of the step results. """
+
+    def __init__(self, journal_path: str, resume: bool = False,
+                 batch_size: int = 64, interval: float = 1.0):
+        self.path = journal_path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending: list[bytes] = []
+        self.closed = threading.Event()
+        self.done = self.read() if resume else {}
+        os.makedirs(path.dirname(path.abspath(journal_path)), mode=0o700, exist_ok=True)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | (0 if resume else os.O_TRUNC)
+        self.fd = os.open(journal_path, flags, 0o600)
+        self.flusher = threading.Thread(target=self._flush_every_interval, daemon=True)
+        self.flusher.start()
+
+    def read(self) -> dict:
+        """ Maps the (host, index, digest) of the steps done by the previous runs to their status. """
+        done = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # the last line of a run which died while writing it
+                    key = (record["host"], record["index"], record["digest"])
+                    if record["status"] in DONE:
+                        done[key] = record["status"]
+                    else:
+                        done.pop(key, None)
+        except OSError:
+            ...
+        return done
+
+    def status(self, host_name: str, step: any) -> str:
+        """ Status of `step` on the host in the previous runs, None if it has to run. """
+        return self.done.get((host_name, step.index, step.digest))
+
+    def record(self, host_name: str, step: any, status: str) -> None:
+        """ Adds the result of `step` on the host. """
+        line = json.dumps({"time": time(), "host": host_name, "index": step.index,
+                           "module": step.module, "digest": step.digest, "status": status})
+        with self.lock:
+            self.pending.append(line.encode() + b"\n")
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+
+    def _flush_every_interval(self) -> None:
+        """ Writes the pending records every `interval` seconds until the journal is closed. """
+        while not self.closed.wait(self.interval):
+            with self.lock:
+                self._flush()
+
+    def _flush(self) -> None:
+        if self.pending:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                data = b"".join(self.pending)
+                while data:
+                    data = data[os.write(self.fd, data):]
+                os.fsync(self.fd)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.pending.clear()
+
+    def close(self) -> None:
+        self.closed.set()
+        self.flusher.join()
+        with self.lock:
+            self._flush()
+            os.close(self.fd)
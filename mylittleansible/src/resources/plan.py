@@ -0,0 +1,69 @@
+""" Todos compiled once, before any connection, into a plan all the hosts share. """
+
+import json
+from hashlib import sha256
+from types import MappingProxyType
+
+import resources.classes.modules  # registers the built-in modules
+from resources.registry import MODULES
+
+
+class PlanError(ValueError):
+    """ Lists every problem found in the todos. """
+
+    def __init__(self, errors: list[str]):
+        super().__init__("\n".join(errors))
+        self.errors = errors
+
+
+class _Frozen:
+    """ Slots set once by `__init__`. """
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+
+class Step(_Frozen):
+    """ A validated todo: its index, module name and class, read-only params and their digest. """
+    __slots__ = ("index", "module", "module_class", "params", "digest")
+
+
+class Plan(_Frozen):
+    """ The steps of the todos, grouped in the batches they run in. """
+    __slots__ = ("steps", "batches")
+
+
+def compile_plan(todos: list[dict]) -> Plan:
+    """ Validates the todos and groups the consecutive steps of batched modules. """
+    errors = []
+    steps = []
+    for index, todo in enumerate(todos):
+        module_class = MODULES.get(todo["module"])
+        if module_class is None:
+            errors.append(f"todo no {index}: unknown module `{todo['module']}`")
+            continue
+        errors.extend(f"todo no {index} ({todo['module']}): {error}"
+                      for error in module_class.check(todo["params"]))
+        digest = sha256(json.dumps([todo["module"], todo["params"]], sort_keys=True,
+                                   default=str).encode()).hexdigest()
+        steps.append(Step(index=index, module=todo["module"], module_class=module_class,
+                          params=MappingProxyType(dict(todo["params"])), digest=digest))
+    if errors:
+        raise PlanError(errors)
+
+    batches = []
+    for step in steps:
+        if batches and step.module_class.batched \
+                and batches[-1][-1].module_class is step.module_class:
+            batches[-1].append(step)
+        else:
+            batches.append([step])
+    return Plan(steps=tuple(steps), batches=tuple(tuple(batch) for batch in batches))
@@ -0,0 +1,146 @@
+""" Run instrumentation: time, bytes and remote calls per host and todo. """
+
+import heapq
+import json
+import os
+import threading
+from contextlib import contextmanager
+from os import path
+from time import perf_counter, time
+
+from resources.tools import get_log_context
+
+# kinds of events which are a round trip with the remote host
+REMOTE_KINDS = ("command", "sftp", "tar", "agent")
+
+
+class Measure:
+    """ Mutable part of a measure, the code measured adds the bytes it moved. """
+
+    def __init__(self):
+        self.bytes = 0
+
+
+class Profiler:
+    """ Thread safe recorder of the events of a run. """
+
+    def __init__(self):
+        self.started = time()
+        self.events: list[dict] = []
+        self._report = None
+        self.lock = threading.Lock()
+
+    def clear(self) -> None:
+        """ Forgets the events recorded so far. """
+        with self.lock:
+            self.events.clear()
+            self._report = None
+
+    def record(self, kind: str, name: str, seconds: float, bytes_moved: int = 0) -> None:
+        """ Records an event of the current host and todo. """
+        host, todo, module = get_log_context()
+        event = {
+            "host": host,
+            "todo": todo,
+            "module": module,
+            "kind": kind,
+            "name": name,
+            "seconds": seconds,
+            "bytes": bytes_moved,
+        }
+        with self.lock:
+            self.events.append(event)
+            self._report = None
+
+    @contextmanager
+    def measure(self, kind: str, name: str = ""):
+        """ Records the wall time of the enclosed block. """
+        measure = Measure()
+        start = perf_counter()
+        try:
+            yield measure
+        finally:
+            self.record(kind, name, perf_counter() - start, measure.bytes)
+
+    def report(self, top: int = 20) -> dict:
+        """ Aggregates the events per host and todo.
+
+        The report is computed once and reused until a new event is recorded.
+        """
+        with self.lock:
+            events = list(self.events)
+            cached = self._report
+        if cached is not None and cached[0] == top:
+            return cached[1]
+
+        def totals(selected: list) -> dict:
+            return {
+                "seconds": sum(event["seconds"] for event in selected
+                               if event["kind"] in ("connect", "module")),
+                "remote_calls": sum(1 for event in selected
+                                    if event["kind"] in REMOTE_KINDS),
+                "bytes": sum(event["bytes"] for event in selected),
+                "queued": sum(event["seconds"] for event in selected
+                              if event["kind"] == "queue"),
+            }
+
+        # one pass: the events of each host, and of each todo of the host
+        by_host = {}
+        seconds_per_kind = {}
+        for event in events:
+            host_events, todos = by_host.setdefault(event["host"], ([], {}))
+            host_events.append(event)
+            if event["todo"] is not None:
+                todos.setdefault(json.dumps(event["todo"]), []).append(event)
+            seconds_per_kind[event["kind"]] = \
+                seconds_per_kind.get(event["kind"], 0) + event["seconds"]
+
+        hosts = {}
+        for host in sorted(by_host):
+            host_events, todos = by_host[host]
+            hosts[host] = {
+                **totals(host_events),
+                "todos": {
+                    todo: {"module": todo_events[0]["module"], **totals(todo_events)}
+                    for todo, todo_events in todos.items()
+                },
+            }
+
+        report = {
+            "started": self.started,
+            "duration": time() - self.started,
+            "totals": {**totals(events), "seconds_per_kind": seconds_per_kind},
+            "hosts": hosts,
+            "slowest": heapq.nlargest(top, events, key=lambda event: event["seconds"]),
+        }
+        with self.lock:
+            if len(self.events) == len(events):
+                self._report = (top, report)
+        return report
+
+    def write(self, report_path: str) -> None:
+        """ Writes the report as JSON. """
+        directory = path.dirname(report_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(report_path, "w", encoding="utf-8") as report_file:
+            json.dump(self.report(), report_file, indent=2)
+
+    def summary(self, top: int = 10) -> str:
+        """ Formats the `top` slowest events and the totals per kind. """
+        report = self.report()
+        lines = [f"{'seconds':>9}  {'kind':<8} {'host':<16} {'todo':<8} name"]
+        for event in report["slowest"][:top]:
+            lines.append(
+                f"{event['seconds']:9.3f}  {event['kind']:<8} {event['host']:<16} "
+                f"{json.dumps(event['todo']):<8} {event['name'][:60]}")
+        lines.append("")
+        for kind, seconds in sorted(report["totals"]["seconds_per_kind"].items()):
+            lines.append(f"{seconds:9.3f}  total {kind}")
+        lines.append(
+            f"{report['totals']['remote_calls']} remote calls, "
+            f"{report['totals']['bytes']} bytes moved in {report['duration']:.3f}s.")
+        return "\n".join(lines)
+
+
+profiler = Profiler()
@@ -0,0 +1,33 @@
+""" Registry of the modules todos can use, plugins add their own. """
+
+import importlib.util
+from os import listdir, path
+
+from resources.tools import MLA_HOME
+
+PLUGINS_DIR = path.join(MLA_HOME, "plugins")
+MODULES: dict[str, type] = {}
+
+
+def register_module(name: str):
+    """ Class decorator registering a module class under `name`. """
+    def register(module_class: type) -> type:
+        MODULES[name] = module_class
+        return module_class
+    return register
+
+
+def load_plugins(logger, directory: str = PLUGINS_DIR) -> None:
+    """ Imports the `*.py` files of `directory`, they register their modules. """
+    if not path.isdir(directory):
+        return
+    for file_name in sorted(listdir(directory)):
+        if not file_name.endswith(".py"):
+            continue
+        try:
+            spec = importlib.util.spec_from_file_location(
+                f"mla_plugin_{file_name[:-3]}", path.join(directory, file_name))
+            spec.loader.exec_module(importlib.util.module_from_spec(spec))
+            logger.debug(f"Plugin {file_name} loaded.")
+        except Exception as e:
+            logger.error(f"The plugin {file_name} could not be loaded: {e.__str__()}")
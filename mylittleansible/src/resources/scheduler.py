@@ -0,0 +1,111 @@
+""" Run-wide scheduler: named resource pools shared by all the hosts.
+
+A pool is named after a module and is either a number of concurrent
+steps (`apt=20`: at most 20 hosts run apt todos at once) or a bandwidth
+(`copy=500MB/s`: the copies of all the hosts send 500 MB per second in
+total). The time spent waiting for a pool is recorded as `queue` events.
+"""
+
+import re
+import threading
+from contextlib import contextmanager
+from time import monotonic, perf_counter, sleep
+
+from resources.profiler import profiler
+
+UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+class ConcurrencyPool:
+    """ At most `limit` steps of the pool run at once. """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.semaphore = threading.BoundedSemaphore(limit)
+
+
+class BandwidthPool:
+    """ Token bucket of `rate` bytes per second, holding at most one second of tokens. """
+
+    def __init__(self, name: str, rate: float):
+        self.name = name
+        self.rate = rate
+        self.tokens = rate
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes: int) -> float:
+        """ Takes `nbytes` tokens, sleeping until they are paid for, returns the seconds waited. """
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # the bucket goes into debt, the later callers wait for it too
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+
+class Queued:
+    """ Seconds a step waited for its pools. """
+
+    def __init__(self):
+        self.seconds = 0.0
+
+
+class Scheduler:
+    """ Pools of the run, by module name. """
+
+    def __init__(self):
+        self.concurrency: dict[str, ConcurrencyPool] = {}
+        self.bandwidth: dict[str, BandwidthPool] = {}
+
+    def configure(self, spec: str) -> None:
+        """ Creates the pools of a `name=N,name=RATE[K|M|G]B/s` spec, raises ValueError if invalid. """
+        for item in (item.strip() for item in spec.split(",")):
+            if not item:
+                continue
+            name, _, value = item.partition("=")
+            name, value = name.strip(), value.strip()
+            bandwidth = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMG]?)B/s", value, re.IGNORECASE)
+            if bandwidth is not None and float(bandwidth.group(1)) > 0:
+                rate = float(bandwidth.group(1)) * UNITS[bandwidth.group(2).upper()]
+                self.bandwidth[name] = BandwidthPool(name, rate)
+            elif value.isdigit() and int(value) > 0:
+                self.concurrency[name] = ConcurrencyPool(name, int(value))
+            else:
+                raise ValueError(f"invalid pool `{item}`, expected NAME=N or NAME=RATE[K|M|G]B/s")
+
+    @contextmanager
+    def slots(self, names):
+        """ Holds a slot of the concurrency pool of each of the `names` for the enclosed block.
+
+        The pools are taken in name order so that two steps can't wait for
+        each other; yields the `Queued` time.
+        """
+        queued = Queued()
+        pools = [self.concurrency[name] for name in sorted(set(names)) if name in self.concurrency]
+        acquired = []
+        try:
+            for pool in pools:
+                start = perf_counter()
+                pool.semaphore.acquire()
+                acquired.append(pool)
+                waited = perf_counter() - start
+                queued.seconds += waited
+                profiler.record("queue", pool.name, waited)
+            yield queued
+        finally:
+            for pool in acquired:
+                pool.semaphore.release()
+
+    def throttle(self, name: str, nbytes: int) -> float:
+        """ Charges `nbytes` to the bandwidth pool `name`, if any, returns the seconds waited. """
+        pool = self.bandwidth.get(name)
+        return pool.consume(nbytes) if pool is not None and nbytes else 0.0
+
+
+scheduler = Scheduler()
@@ -0,0 +1,113 @@
+""" Per-run cache of the files sent by the `copy` module.
+
+When the same files are copied to many hosts, each file is read (or
+mapped) once, hashed once, and the same buffer is sent to every host.
+Buffers are evicted in least recently used order when the cache goes over
+its budget: `max_bytes` for the files read in memory, `max_mapped` for
+the big files mapped with mmap (backed by the page cache). The digests
+are kept apart from the buffers and outlive their eviction.
+"""
+
+import mmap
+import threading
+from collections import OrderedDict
+from hashlib import sha256
+from os import stat
+
+
+class Source:
+    """ Content and digest of a local file. """
+
+    def __init__(self, local_path: str, size: int, mapped: bool,
+                 digests: dict = None, key: tuple = None):
+        self.local_path = local_path
+        self.size = size
+        self.mapped = mapped
+        self.lock = threading.Lock()
+        self.digest_lock = threading.Lock()
+        self._data = None
+        self._digests = {} if digests is None else digests
+        self._key = key
+
+    @property
+    def data(self) -> memoryview:
+        """ Content of the file, read on first use. """
+        with self.lock:
+            if self._data is None:
+                with open(self.local_path, "rb") as local_file:
+                    if self.size == 0:
+                        self._data = b""
+                    elif self.mapped:
+                        self._data = mmap.mmap(
+                            local_file.fileno(), 0, access=mmap.ACCESS_READ)
+                    else:
+                        self._data = local_file.read()
+            return memoryview(self._data)
+
+    @property
+    def digest(self) -> str:
+        """ sha256 of the file, computed on first use. """
+        with self.digest_lock:
+            digest = self._digests.get(self._key)
+            if digest is None:
+                digest = self._digests[self._key] = sha256(self.data).hexdigest()
+            return digest
+
+
+class SourceReader:
+    """ Read-only file object over a `Source`, without copying its buffer. """
+
+    def __init__(self, source: Source):
+        self.data = source.data
+        self.position = 0
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self.data) if size < 0 else self.position + size
+        chunk = self.data[self.position:end]
+        self.position += len(chunk)
+        return chunk
+
+
+class SourceCache:
+    """ Thread safe LRU cache of `Source`, keyed by path, size and mtime. """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024,
+                 max_mapped: int = 8 * 1024 * 1024 * 1024,
+                 mmap_threshold: int = 16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_mapped = max_mapped
+        self.mmap_threshold = mmap_threshold
+        # one LRU and one running byte count per budget, by `Source.mapped`
+        self.entries = {False: OrderedDict(), True: OrderedDict()}
+        self.used = {False: 0, True: 0}
+        self.digests: dict = {}
+        self.lock = threading.Lock()
+
+    def get(self, local_path: str) -> Source:
+        """ Returns the cached `Source` of `local_path`, creating it if needed. """
+        stat_result = stat(local_path)
+        key = (local_path, stat_result.st_size, stat_result.st_mtime_ns)
+        mapped = stat_result.st_size >= self.mmap_threshold
+        entries = self.entries[mapped]
+        with self.lock:
+            source = entries.get(key)
+            if source is not None:
+                entries.move_to_end(key)
+                return source
+            source = Source(local_path, stat_result.st_size, mapped, self.digests, key)
+            entries[key] = source
+            self.used[mapped] += source.size
+            self._evict(mapped)
+            return source
+
+    def _evict(self, mapped: bool) -> None:
+        """ Drops the least recently used buffers of a budget until it is met. """
+        budget = self.max_mapped if mapped else self.max_bytes
+        entries = self.entries[mapped]
+        while self.used[mapped] > budget and entries:
+            # hosts still sending it keep their own reference
+            _, source = entries.popitem(last=False)
+            self.used[mapped] -= source.size
+
+
+source_cache = SourceCache()
@@ -0,0 +1,98 @@
+""" Per-run cache of the templates of the `template` module.
+
+A template is read and compiled once per run, and each render is kept,
+keyed by the template and the variables, so that the hosts sharing the
+same variables share the same bytes (and checksum).
+"""
+
+import json
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from hashlib import sha256
+from os import stat
+from string import Template as StringTemplate
+
+ENGINES = ("string", "jinja2")
+
+
+@lru_cache(maxsize=None)
+def load_jinja2() -> any:
+    """ Returns the `jinja2` module, imported on first use, or None if it is not installed. """
+    try:
+        import jinja2
+    except ImportError:
+        return None
+    return jinja2
+
+
+class Render:
+    """ Rendered content of a template and its sha256. """
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.digest = sha256(data).hexdigest()
+
+
+class TemplateCache:
+    """ Thread safe cache of compiled templates and of their renders (LRU, `max_bytes`). """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.compiled: dict = {}
+        self.renders: OrderedDict = OrderedDict()
+        # running byte count of `renders`
+        self.used = 0
+        self.lock = threading.Lock()
+        # striped: the keys sharing a lock compile or render one at a time
+        self.key_locks = tuple(threading.Lock() for _ in range(64))
+
+    def _key_lock(self, key: tuple) -> threading.Lock:
+        return self.key_locks[hash(key) % len(self.key_locks)]
+
+    def compile(self, template_path: str, engine: str) -> tuple[tuple, any]:
+        """ Returns the key and the compiled template of `template_path`, compiling it once. """
+        stat_result = stat(template_path)
+        key = (template_path, stat_result.st_size, stat_result.st_mtime_ns, engine)
+        with self._key_lock(key):
+            if key not in self.compiled:
+                with open(template_path, "r", encoding="utf-8") as template_file:
+                    text = template_file.read()
+                if engine == "jinja2":
+                    jinja2 = load_jinja2()
+                    environment = jinja2.Environment(
+                        undefined=jinja2.StrictUndefined, keep_trailing_newline=True)
+                    self.compiled[key] = environment.from_string(text)
+                else:
+                    self.compiled[key] = StringTemplate(text)
+            return key, self.compiled[key]
+
+    def render(self, template_path: str, engine: str, variables: dict) -> Render:
+        """ Renders the template with `variables`, once per distinct set of variables. """
+        template_key, template = self.compile(template_path, engine)
+        key = (template_key, json.dumps(variables, sort_keys=True, default=str))
+        with self._key_lock(key):
+            with self.lock:
+                render = self.renders.get(key)
+                if render is not None:
+                    self.renders.move_to_end(key)
+                    return render
+            if engine == "jinja2":
+                text = template.render(**variables)
+            else:
+                text = template.substitute(variables)
+            render = Render(text.encode("utf-8"))
+            with self.lock:
+                self.renders[key] = render
+                self.used += len(render.data)
+                self._evict()
+        return render
+
+    def _evict(self) -> None:
+        """ Drops the least recently used renders until `max_bytes` is met. """
+        while self.used > self.max_bytes and len(self.renders) > 1:
+            _, render = self.renders.popitem(last=False)
+            self.used -= len(render.data)
+
+
+template_cache = TemplateCache()
@@ -1,9 +1,107 @@
 """ Shared Tools. """
 
+import atexit
+import json
 import logging
+import re
+import threading
+import weakref
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+from os import path
+from queue import SimpleQueue
+from select import select
+from shlex import quote
 from sys import stdout
+from time import monotonic, sleep
+from uuid import uuid4
 
-import colorlog
+MLA_HOME = path.join(path.expanduser("~"), ".mla")
+_CHUNK_SIZE = 32768
+SUDO_PROMPT = "[mla-sudo] "
+SUDO_AUTH_TIMEOUT = 30.0
+
+_log_context = threading.local()
+_listener: QueueListener = None
+_listener_lock = threading.Lock()
+
+
+class HostFilter(logging.Filter):
+    """ Tags each record with the host, todo and module handled by the emitting thread. """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.host = getattr(_log_context, "host", "-")
+        record.todo = getattr(_log_context, "todo", None)
+        record.module = getattr(_log_context, "module", None)
+        return True
+
+
+def set_log_host(host_name: str) -> None:
+    """ Sets the host used to tag the log lines of the current thread. """
+    _log_context.host = host_name
+    set_log_todo(None, None)
+
+
+def get_log_host() -> str:
+    """ Returns the host tagging the log lines of the current thread. """
+    return getattr(_log_context, "host", "-")
+
+
+def set_log_todo(todo_index: any, module: str) -> None:
+    """ Sets the todo index and module used to tag the log lines of the current thread. """
+    _log_context.todo = todo_index
+    _log_context.module = module
+
+
+def get_log_context() -> tuple:
+    """ Returns the host, todo index and module of the current thread. """
+    return (getattr(_log_context, "host", "-"), getattr(_log_context, "todo", None),
+            getattr(_log_context, "module", None))
+
+
+def set_log_context(host_name: str, todo_index: any, module: str) -> None:
+    """ Sets the context returned by `get_log_context`, for a worker thread. """
+    set_log_host(host_name)
+    set_log_todo(todo_index, module)
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats each record as a JSON object on a single line. """
+
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps({
+            "time": record.created,
+            "level": record.levelname,
+            "host": record.host,
+            "todo": record.todo,
+            "module": record.module,
+            "message": record.getMessage(),
+        })
+
+
+class _ColoredFormatter(logging.Formatter):
+    """ Colored formatter of `colorlog`, imported when the first record is written. """
+
+    def __init__(self, fmt: str):
+        super().__init__()
+        self.fmt = fmt
+        self.formatter = None
+
+    def format(self, record: logging.LogRecord) -> str:
+        if self.formatter is None:
+            import colorlog
+
+            self.formatter = colorlog.ColoredFormatter(
+                self.fmt,
+                log_colors={
+                    'DEBUG': 'cyan',
+                    'INFO': 'green',
+                    'WARNING': 'yellow',
+                    'ERROR': 'red',
+                    'CRITICAL': 'red,bg_white',
+                },
+            )
+        return self.formatter.format(record)
 
 
 class Logs():
@@ -14,28 +112,44 @@ class Logs():
         self.logger = logging.getLogger('MLA')
         self.logger.setLevel(logging.DEBUG)
 
-    def setFormatter(self, fmt: str) -> colorlog.ColoredFormatter:
+    def setFormatter(self, fmt: str) -> logging.Formatter:
         """ Creates and sets a custom formatter with colors for logging. """
-        return colorlog.ColoredFormatter(
-            fmt,
-            log_colors={
-                'DEBUG': 'cyan',
-                'INFO': 'green',
-                'WARNING': 'yellow',
-                'ERROR': 'red',
-                'CRITICAL': 'red,bg_white',
-            },
-        )
+        return _ColoredFormatter(fmt)
 
     def setHandler(self) -> None:
-        """ Sets the handler an dadd it to the logging."""
-        fmt = "%(log_color)s%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-        handler = logging.StreamHandler(stdout)
+        """ Sets, once per process, the queue handler and the thread writing the logs. """
+        global _listener
+        with _listener_lock:
+            if _listener is not None:
+                return
 
-        handler.setLevel(logging.DEBUG)
-        handler.setFormatter(self.setFormatter(fmt))
+            fmt = "%(log_color)s%(asctime)s - %(name)s - %(levelname)s - [%(host)s] %(message)s"
+            handler = logging.StreamHandler(stdout)
+            handler.setLevel(logging.DEBUG)
+            handler.setFormatter(self.setFormatter(fmt))
+
+            log_queue = SimpleQueue()
+            queue_handler = QueueHandler(log_queue)
+            queue_handler.addFilter(HostFilter())
+            self.logger.addHandler(queue_handler)
 
-        self.logger.addHandler(handler)
+            _listener = QueueListener(
+                log_queue, handler, respect_handler_level=True)
+            _listener.start()
+            atexit.register(_listener.stop)
+
+    def setJsonSink(self, json_path: str) -> None:
+        """ Adds a JSON lines sink, `-` replaces the colored output on stdout. """
+        self.setHandler()
+        if json_path == "-":
+            handler = logging.StreamHandler(stdout)
+            handlers = ()
+        else:
+            handler = logging.FileHandler(json_path, encoding="utf-8")
+            handlers = _listener.handlers
+        handler.setLevel(logging.DEBUG)
+        handler.setFormatter(JsonFormatter())
+        _listener.handlers = handlers + (handler,)
 
 
 def stdCloser(stdin: any, stdout_channel: any, stderr: any):
@@ -44,20 +158,237 @@ def stdCloser(stdin: any, stdout_channel: any, stderr: any):
     stderr.close()
 
 
-def execute_command(logger, sudo: bool, client: any, command: str, host_pwd: str = "") -> any:
-    """ Command executor. """
-    if sudo:
-        stdin, stdout_channel, stderr = client.exec_command(
-            f'echo "{host_pwd}" | {command}'
-        )
-        logger.debug(f'Execute command "{command}" WITH sudo.\n')
-    else:
-        stdin, stdout_channel, stderr = client.exec_command(f'{command}')
-        logger.debug(f'Execute command "{command}" WITHOUT sudo.\n')
+class _LineBuffer:
+    """ Splits a stream in lines and keeps the last `max_lines` of them. """
+
+    def __init__(self, name: str, on_line, max_lines: int = None):
+        self.name = name
+        self.on_line = on_line
+        self.lines = deque(maxlen=max_lines)
+        self.dropped = 0
+        self.pending = b""
 
-    stdout_str = stdout_channel.read().decode()
-    stderr_str = stderr.read().decode()
+    def feed(self, data: bytes) -> None:
+        *lines, self.pending = (self.pending + data).split(b"\n")
+        for line in lines:
+            self._add(line.decode(errors="replace") + "\n")
 
-    stdCloser(stdin, stdout_channel, stderr)
+    def close(self) -> None:
+        if self.pending:
+            self._add(self.pending.decode(errors="replace"))
+            self.pending = b""
 
+    def _add(self, line: str) -> None:
+        if self.on_line is not None:
+            self.on_line(self.name, line.rstrip("\n"))
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(line)
+
+    def text(self) -> str:
+        header = f"[... {self.dropped} lines dropped ...]\n" if self.dropped else ""
+        return header + "".join(self.lines)
+
+
+def _receive(channel: any, deadline: float = None) -> tuple[bytes, bytes, bool]:
+    """ Waits for output of `channel`, returns its stdout, stderr and whether it is closed.
+
+    With a `deadline` (a `monotonic` time), returns empty output once it has passed.
+    """
+    while True:
+        # sampled before reading: the last output may come with the exit status,
+        # the channel is closed only if nothing was left to read once it was there.
+        exited = channel.exit_status_ready()
+        data = channel.recv(_CHUNK_SIZE) if channel.recv_ready() else b""
+        errors = channel.recv_stderr(_CHUNK_SIZE) if channel.recv_stderr_ready() else b""
+        if data or errors or exited:
+            return data, errors, not (data or errors)
+        timeout = 0.5
+        if deadline is not None:
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                return b"", b"", False
+        if hasattr(channel, "fileno"):
+            select([channel], [], [], min(timeout, 0.5))
+        else:
+            sleep(min(timeout, 0.01))
+
+
+class SudoSession:
+    """ Root shell opened once per SSH client with `sudo -S`, running the privileged commands in turn.
+
+    The password is only sent when sudo asks for it, a second prompt
+    means that it is wrong. Each command is followed by markers carrying
+    its exit code on stdout and closing its stderr.
+    """
+
+    def __init__(self, client: any, host_pwd: str, logger):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.token = f"__MLA_{uuid4().hex}"
+        # paramiko shuts the channel down once its stdin file is collected
+        self.files = client.exec_command(
+            f"sudo -S -p {quote(SUDO_PROMPT)} sh -c {quote(f'echo {self.token}; exec sh')}")
+        self.channel = self.files[1].channel
+        self.state = self._authenticate(host_pwd)
+        logger.debug(f"Privileged session: {self.state}.")
+
+    def _authenticate(self, host_pwd: str) -> str:
+        """ Answers the prompt of sudo, returns "ready", "incorrect" or "failed". """
+        stdout_data, stderr_data, prompts = b"", b"", 0
+        deadline = monotonic() + SUDO_AUTH_TIMEOUT
+        # up to the end of the banner line, or its newline would go to the first command
+        while self.token.encode() + b"\n" not in stdout_data:
+            if stderr_data.count(SUDO_PROMPT.encode()) > prompts:
+                prompts += 1
+                if prompts > 1:
+                    self.close()
+                    return "incorrect"
+                self.channel.sendall(f"{host_pwd}\n".encode())
+            if monotonic() > deadline:
+                self.close()
+                return "failed"
+            data, errors, closed = _receive(self.channel, deadline)
+            if closed:
+                return "incorrect" if prompts or b"incorrect" in stderr_data else "failed"
+            stdout_data += data
+            stderr_data += errors
+        return "ready"
+
+    def run(self, command: str, out: _LineBuffer, err: _LineBuffer, measure: any) -> int:
+        """ Runs `command` as root, feeding its output to `out` and `err`, returns its exit status. """
+        token = self.token.encode()
+        markers = (re.compile(rb"\n" + token + rb" (-?\d+)\n"), re.compile(rb"\n" + token + rb"\n"))
+        with self.lock:
+            # the command gets its own shell so that it can't read or end the session
+            self.channel.sendall((
+                f"sh -c {quote(command)} < /dev/null\n"
+                f"__mla_rc=$?\n"
+                f"printf '\\n{self.token} %d\\n' $__mla_rc\n"
+                f"printf '\\n{self.token}\\n' >&2\n").encode())
+            pending, buffers, matches = [b"", b""], (out, err), [None, None]
+            while None in matches:
+                received = _receive(self.channel)
+                if received[2]:
+                    self.state = "failed"
+                    err.feed(b"\nThe privileged session was closed.\n")
+                    return -1
+                for stream in (0, 1):
+                    if matches[stream] is not None or not received[stream]:
+                        continue
+                    measure.bytes += len(received[stream])
+                    pending[stream] += received[stream]
+                    matches[stream] = markers[stream].search(pending[stream])
+                    if matches[stream] is not None:
+                        buffers[stream].feed(pending[stream][:matches[stream].start()])
+                    else:
+                        # the last line may be the beginning of the marker
+                        cut = pending[stream].rfind(b"\n")
+                        if cut > 0:
+                            buffers[stream].feed(pending[stream][:cut])
+                            pending[stream] = pending[stream][cut:]
+            return int(matches[0].group(1))
+
+    def close(self) -> None:
+        try:
+            self.channel.shutdown_write()
+            self.channel.close()
+        except Exception:
+            ...
+
+
+_sudo_sessions = weakref.WeakKeyDictionary()
+# one lock per client, held while its session is opened
+_sudo_locks = weakref.WeakKeyDictionary()
+_sudo_sessions_lock = threading.Lock()
+
+
+def sudo_session(client: any, host_pwd: str, logger) -> SudoSession:
+    """ Returns the privileged session of `client`, opening it on first use; None if it can't be opened. """
+    with _sudo_sessions_lock:
+        client_lock = _sudo_locks.setdefault(client, threading.Lock())
+    # the other hosts don't wait for the authentication of this one
+    with client_lock:
+        with _sudo_sessions_lock:
+            session = _sudo_sessions.get(client)
+        if session is None:
+            try:
+                session = SudoSession(client, host_pwd, logger)
+            except Exception as e:
+                logger.debug(f"The privileged session could not be opened: {e.__str__()}")
+                return None
+            with _sudo_sessions_lock:
+                _sudo_sessions[client] = session
+    return session if session.state != "failed" else None
+
+
+def close_sudo_session(client: any) -> None:
+    """ Closes the privileged session of `client`, if any. """
+    with _sudo_sessions_lock:
+        session = _sudo_sessions.pop(client, None)
+        _sudo_locks.pop(client, None)
+    if session is not None:
+        session.close()
+
+
+def stream_command(logger, sudo: bool, client: any, command: str, host_pwd: str = "",
+                   on_line=None, max_lines: int = None) -> tuple[str, str, int]:
+    """ Runs `command` reading stdout and stderr as they come.
+
+    Each line is passed to `on_line(stream, line)` when it arrives, only
+    the last `max_lines` lines of each stream are kept (all of them when
+    None). Returns the kept stdout, stderr and the exit status.
+    With `sudo`, `command` runs as root in the privileged session of
+    `client`, or through its own `sudo -S` if the session can't be opened.
+    """
+    from resources.profiler import profiler
+
+    with profiler.measure("command", command) as measure:
+        out = _LineBuffer("stdout", on_line, max_lines)
+        err = _LineBuffer("stderr", on_line, max_lines)
+        session = sudo_session(client, host_pwd, logger) if sudo else None
+        if session is not None:
+            logger.debug(f'Execute command "{command}" in the privileged session.\n')
+            if session.state == "incorrect":
+                err.feed(b"sudo: incorrect password\n")
+                exit_status = 1
+            else:
+                exit_status = session.run(command, out, err, measure)
+            out.close()
+            err.close()
+            return out.text(), err.text(), exit_status
+
+        if sudo:
+            stdin, stdout_channel, stderr = client.exec_command(
+                f"sudo -S -p '' sh -c {quote(command)}")
+            stdin.write(f"{host_pwd}\n")
+            stdin.flush()
+            logger.debug(f'Execute command "{command}" WITH sudo.\n')
+        else:
+            stdin, stdout_channel, stderr = client.exec_command(f'{command}')
+            logger.debug(f'Execute command "{command}" WITHOUT sudo.\n')
+
+        channel = stdout_channel.channel
+        while True:
+            # the exit status comes after the output, once it is there and the
+            # buffers are empty nothing is left to read.
+            data, errors, closed = _receive(channel)
+            measure.bytes += len(data) + len(errors)
+            out.feed(data)
+            err.feed(errors)
+            if closed:
+                break
+        out.close()
+        err.close()
+        exit_status = channel.recv_exit_status()
+
+        stdCloser(stdin, stdout_channel, stderr)
+
+    return out.text(), err.text(), exit_status
+
+
+def execute_command(logger, sudo: bool, client: any, command: str, host_pwd: str = "") -> any:
+    """ Command executor. """
+    stdout_str, stderr_str, _ = stream_command(
+        logger, sudo, client, command, host_pwd)
     return stdout_str, stderr_str
@@ -0,0 +1,45 @@
+""" Reaping of the transports kept by the broker.
+
+    python3 -m pytest tests
+"""
+
+import logging
+import sys
+import unittest
+from os import path
+from unittest import mock
+
+SRC_DIR = path.join(path.dirname(path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+from resources.broker import _Transports  # noqa: E402
+
+PARAMS = {"ssh_address": "10.0.0.1", "ssh_port": 22, "ssh_user": "u"}
+
+
+class ReapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.transports = _Transports(0, logging.getLogger("mla-tests"))
+        self.key = _Transports.key(PARAMS)
+        self.client = mock.Mock()
+        self.transports.clients[self.key] = self.client
+        self.transports.last_used[self.key] = 0
+
+    def test_idle_transport_is_closed(self):
+        self.transports.reap()
+        self.client.close.assert_called_once()
+        self.assertEqual(self.transports.clients, {})
+
+    def test_transport_with_a_relayed_channel_is_kept(self):
+        key = self.transports.acquire(PARAMS)
+        self.transports.reap()
+        self.client.close.assert_not_called()
+        self.transports.release(key)
+        self.assertEqual(self.transports.channels, {})
+        self.transports.reap()
+        self.client.close.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
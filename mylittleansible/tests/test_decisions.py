@@ -0,0 +1,137 @@
+""" Decisions of the batched modules, and the agent applying them with the bench stubs.
+
+    python3 -m pytest tests
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from os import path
+
+SRC_DIR = path.join(path.dirname(path.abspath(__file__)), "..", "src")
+STUBS_DIR = path.join(path.dirname(path.abspath(__file__)), "..", "bench", "stubs")
+sys.path.insert(0, SRC_DIR)
+
+from resources.decisions import (apt_status, command_script,  # noqa: E402
+                                 parse_command_output, plan_apt, plan_service,
+                                 plan_sysctl, service_status, sysctl_commands)
+
+
+def run_agent(home: str, batch: list) -> list:
+    """ Runs the agent on this host with the stubs, returns the reply to each todo of `batch`. """
+    from resources.agent import SOURCE
+
+    messages = [{"password": "pw"},
+                {"batch": [{"index": index, "module": module, "params": params}
+                           for index, (module, params) in enumerate(batch)]}]
+    env = dict(os.environ, HOME=home, PATH=STUBS_DIR + os.pathsep + os.environ["PATH"])
+    stdout = subprocess.run(
+        [sys.executable, "-c", SOURCE.decode()], env=env, check=True, capture_output=True,
+        input="".join(json.dumps(message) + "\n" for message in messages).encode()).stdout
+    replies = [json.loads(line) for line in stdout.decode().splitlines()][1:]
+    return sorted(replies, key=lambda reply: reply["index"])
+
+
+class PlanAptTest(unittest.TestCase):
+
+    def test_done_todos_are_ok(self):
+        statuses, expected, runs = plan_apt(
+            [{"name": "x", "state": "present"}, {"name": "y", "state": "absent"}],
+            {"x": "present", "y": "absent"})
+        self.assertEqual(statuses, ["ok", "ok"])
+        self.assertEqual((expected, runs), ({}, []))
+
+    def test_one_run_per_direction_change(self):
+        todos = [{"name": "x", "state": "absent"}, {"name": "x", "state": "present"}]
+        statuses, expected, runs = plan_apt(todos, {"x": "present"})
+        self.assertEqual(statuses, ["to change", "to change"])
+        self.assertEqual(expected, {"x": "present"})
+        self.assertEqual(runs, [{"install": [], "uninstall": [0]},
+                                {"install": [1], "uninstall": []}])
+        self.assertEqual([apt_status(params, {"x": "present"}, expected) for params in todos],
+                         ["changed", "changed"])
+
+    def test_earlier_todos_of_the_batch_count(self):
+        todos = [{"name": "x", "state": "present"}, {"name": "y", "state": "present"},
+                 {"name": "x", "state": "present"}]
+        statuses, _, runs = plan_apt(todos, {"x": "absent", "y": "absent"})
+        self.assertEqual(statuses, ["to change", "to change", "ok"])
+        self.assertEqual(runs, [{"install": [0, 1], "uninstall": []}])
+
+
+class PlanServiceTest(unittest.TestCase):
+
+    def test_calls_keep_the_todos_order(self):
+        todos = [{"name": "x", "state": "started"}, {"name": "x", "state": "stopped"},
+                 {"name": "x", "state": "enabled"}]
+        statuses, expected, calls = plan_service(
+            todos, {("active", "x"): "inactive", ("enabled", "x"): "enabled"})
+        self.assertEqual(statuses, ["to change", "to change", "ok"])
+        self.assertEqual(calls, [("start", ["x"]), ("stop", ["x"])])
+        self.assertEqual(service_status(todos[0], {("active", "x"): "inactive"}, expected),
+                         "changed")
+
+
+class PlanSysctlTest(unittest.TestCase):
+
+    def test_the_last_todo_of_an_attribute_wins(self):
+        todos = [{"attribute": "a", "value": 1, "permanent": True, "file": "/d/x.conf"},
+                 {"attribute": "a", "value": "2", "permanent": True, "file": "/d/x.conf"},
+                 {"attribute": "b", "value": "3  4", "permanent": False}]
+        dropins = {"/d/x.conf": {"a": "2"}}
+        statuses, expected, wanted = plan_sysctl(todos, {"a": "2", "b": "3 4"}, dropins)
+        self.assertEqual(statuses, ["to change", "to change", "ok"])
+        self.assertEqual(expected, {"a": "2", "b": "3 4"})
+        self.assertEqual(wanted, {"/d/x.conf": {"a": "2"}})
+        commands = sysctl_commands(todos, statuses, dropins, wanted)
+        self.assertEqual(commands, ["sysctl -p /d/x.conf > /dev/null"])
+
+
+class CommandScriptTest(unittest.TestCase):
+
+    def test_each_line_is_reported(self):
+        script = command_script(["echo a; echo b >&2", "false", "echo c"], "TOKEN", True)
+        process = subprocess.run(["sh", "-c", script], capture_output=True, text=True)
+        results, rest = parse_command_output(process.stdout, process.stderr, "TOKEN")
+        self.assertEqual([(result["index"], result["exit_code"], result["stdout"], result["stderr"])
+                          for result in results], [(0, 0, "a\n", "b\n"), (1, 1, "", "")])
+        self.assertTrue(all(result["duration"].endswith("s") for result in results))
+        self.assertEqual(rest, "")
+
+
+class AgentAptTest(unittest.TestCase):
+
+    def test_remove_then_install_leaves_the_package(self):
+        with tempfile.TemporaryDirectory() as home:
+            packages = path.join(home, ".stub", "packages")
+            os.makedirs(packages)
+            open(path.join(packages, "x"), "w").close()
+            replies = run_agent(home, [("apt", {"name": "x", "state": "absent"}),
+                                       ("apt", {"name": "x", "state": "present"})])
+            self.assertEqual([reply["status"] for reply in replies], ["changed", "changed"])
+            self.assertTrue(path.exists(path.join(packages, "x")))
+
+
+class AgentCommandTest(unittest.TestCase):
+
+    def test_pipelined_lines_report_stderr_and_duration(self):
+        with tempfile.TemporaryDirectory() as home:
+            reply, = run_agent(home, [("command", {"command": "echo a >&2\nfalse",
+                                                   "pipelined": True})])
+        self.assertEqual(reply["status"], "ko")
+        self.assertIn(["debug", "STDERR: a"], reply["log"])
+        self.assertTrue(any(level == "info" and "duration: " in message
+                            for level, message in reply["log"]))
+
+    def test_output_is_bounded(self):
+        with tempfile.TemporaryDirectory() as home:
+            reply, = run_agent(home, [("command", {"command": "seq 1 5000", "max_lines": 3})])
+        self.assertEqual([message for level, message in reply["log"] if level == "debug"],
+                         ["STDOUT: 4998", "STDOUT: 4999", "STDOUT: 5000"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+""" Groups, variables and `--limit` patterns of the inventories.
+
+    python3 -m pytest tests
+"""
+
+import sys
+import unittest
+from os import path
+
+SRC_DIR = path.join(path.dirname(path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+from load_resources import _index  # noqa: E402
+from resources.classes.inventory import Inventory  # noqa: E402
+
+CONTENT = {
+    "vars": {"ssh_port": 22, "env": "base"},
+    "hosts": {"web1": {"ssh_address": "10.0.0.1"}, "web2": {},
+              "db1": {"env": "host"}, "db10": {}},
+    "groups": {
+        "web": {"hosts": ["web1", "web2"], "vars": {"ssh_user": "www", "env": "web"}},
+        "db": {"hosts": ["db1", "db10"]},
+        "prod": {"children": ["web", "db"]},
+        "everything": {"children": ["prod"]},
+        "loop_a": {"children": ["loop_b"]},
+        "loop_b": {"hosts": ["web1"], "children": ["loop_a"]},
+        "canary": {"hosts": ["web1"], "vars": {"env": "canary"}},
+    },
+}
+
+
+def inventory() -> Inventory:
+    indexed = Inventory()
+    _index(CONTENT, indexed)
+    indexed.resolve()
+    return indexed
+
+
+class SelectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.inventory = inventory()
+
+    def test_empty_pattern_selects_every_host_in_order(self):
+        self.assertEqual(self.inventory.select(""), ["web1", "web2", "db1", "db10"])
+
+    def test_hosts_and_groups_are_unioned(self):
+        self.assertEqual(self.inventory.select("db10,web"), ["web1", "web2", "db10"])
+
+    def test_intersection_and_exclusion(self):
+        self.assertEqual(self.inventory.select("prod,&web,!web2"), ["web1"])
+        self.assertEqual(self.inventory.select("!web"), ["db1", "db10"])
+
+    def test_globs_match_hosts_and_groups(self):
+        self.assertEqual(self.inventory.select("web?"), ["web1", "web2"])
+        # `d?` names no host, only the group `db`
+        self.assertEqual(self.inventory.select("d?"), ["db1", "db10"])
+
+    def test_regexes_match_host_names_from_their_start(self):
+        self.assertEqual(self.inventory.select(r"~db\d+"), ["db1", "db10"])
+        self.assertEqual(self.inventory.select(r"~db\d$"), ["db1"])
+        self.assertEqual(self.inventory.select("~b"), [])
+
+    def test_unknown_terms_select_nothing(self):
+        self.assertEqual(self.inventory.select("nope"), [])
+
+
+class ChildrenTest(unittest.TestCase):
+
+    def test_nested_children_are_members(self):
+        self.assertEqual(inventory().select("everything"), ["web1", "web2", "db1", "db10"])
+
+    def test_cycles_end(self):
+        self.assertEqual(inventory().select("loop_a"), ["web1"])
+
+
+class VariablesTest(unittest.TestCase):
+
+    def test_host_overrides_groups_overriding_all(self):
+        variables = inventory().variables
+        self.assertEqual(variables("web2"), {"ssh_port": 22, "env": "web", "ssh_user": "www"})
+        self.assertEqual(variables("db1")["env"], "host")
+        self.assertEqual(variables("db10")["env"], "base")
+
+    def test_later_groups_override_earlier_ones(self):
+        self.assertEqual(inventory().variables("web1")["env"], "canary")
+
+    def test_host_defaults(self):
+        web1, db1 = inventory().host("web1"), inventory().host("db1")
+        self.assertEqual((web1.ssh_address, web1.ssh_port, web1.ssh_user), ("10.0.0.1", 22, "www"))
+        self.assertEqual(web1.vars, {"env": "canary"})
+        self.assertEqual((db1.ssh_address, db1.auth), ("db1", True))
+
+
+if __name__ == "__main__":
+    unittest.main()
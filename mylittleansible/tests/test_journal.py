@@ -0,0 +1,69 @@
+""" Replay of the journals by `--resume`.
+
+    python3 -m pytest tests
+"""
+
+import sys
+import tempfile
+import unittest
+from os import path
+from types import SimpleNamespace
+
+SRC_DIR = path.join(path.dirname(path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+from resources.journal import Journal  # noqa: E402
+
+
+def step(index: int, digest: str = "d0") -> SimpleNamespace:
+    return SimpleNamespace(index=index, module="command", digest=digest)
+
+
+class ReadTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = path.join(directory.name, "journal.jsonl")
+
+    def write(self, records: list, resume: bool = False) -> None:
+        journal = Journal(self.path, resume)
+        for host_name, index, status in records:
+            journal.record(host_name, step(index), status)
+        journal.close()
+
+    def resumed(self) -> Journal:
+        journal = Journal(self.path, resume=True)
+        self.addCleanup(journal.close)
+        return journal
+
+    def test_done_steps_are_skipped_per_host(self):
+        self.write([("a", 0, "ok"), ("a", 1, "changed"), ("a", 2, "ko"), ("b", 0, "ko")])
+        journal = self.resumed()
+        self.assertEqual([journal.status("a", step(index)) for index in range(3)],
+                         ["ok", "changed", None])
+        self.assertIsNone(journal.status("b", step(0)))
+
+    def test_a_later_failure_clears_an_earlier_success(self):
+        self.write([("a", 0, "ok")])
+        self.write([("a", 0, "ko"), ("a", 1, "ok")], resume=True)
+        self.assertEqual(self.resumed().done, {("a", 1, "d0"): "ok"})
+
+    def test_a_truncated_last_line_is_ignored(self):
+        self.write([("a", 0, "ok"), ("a", 1, "ok")])
+        with open(self.path, "rb+") as journal:
+            journal.truncate(path.getsize(self.path) - 10)
+        self.assertEqual(self.resumed().done, {("a", 0, "d0"): "ok"})
+
+    def test_a_changed_todo_runs_again(self):
+        self.write([("a", 0, "ok")])
+        self.assertIsNone(self.resumed().status("a", step(0, digest="d1")))
+
+    def test_a_new_run_without_resume_starts_over(self):
+        self.write([("a", 0, "ok")])
+        self.write([])
+        self.assertEqual(self.resumed().done, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
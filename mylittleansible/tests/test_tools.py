@@ -0,0 +1,193 @@
+""" The reading of the command channels and the privileged session, over local processes.
+
+    python3 -m pytest tests
+"""
+
+import logging
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from os import path
+from types import SimpleNamespace
+from unittest import mock
+
+SRC_DIR = path.join(path.dirname(path.abspath(__file__)), "..", "src")
+STUBS_DIR = path.join(path.dirname(path.abspath(__file__)), "..", "bench", "stubs")
+sys.path.insert(0, SRC_DIR)
+
+from resources import tools  # noqa: E402
+from resources.tools import SudoSession, _LineBuffer, stream_command  # noqa: E402
+
+logger = logging.getLogger("mla-tests")
+
+
+class LocalChannel:
+    """ The part of a paramiko channel read by `tools`, over a local `sh -c command`.
+
+    `recv` and `recv_stderr` return at most `chunk_size` bytes, to split the
+    output anywhere.
+    """
+
+    def __init__(self, command: str, path_dirs: list, chunk_size: int):
+        env = dict(os.environ, PATH=os.pathsep.join(path_dirs + [os.environ["PATH"]]))
+        self.process = subprocess.Popen(["sh", "-c", command], env=env, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.buffers = (bytearray(), bytearray())
+        self.readers = [threading.Thread(target=self._read, args=(file, buffer), daemon=True)
+                        for file, buffer in ((self.process.stdout, self.buffers[0]),
+                                             (self.process.stderr, self.buffers[1]))]
+        for reader in self.readers:
+            reader.start()
+
+    def _read(self, file: any, buffer: bytearray) -> None:
+        for data in iter(lambda: os.read(file.fileno(), 4096), b""):
+            with self.lock:
+                buffer += data
+
+    def _recv(self, buffer: bytearray, size: int) -> bytes:
+        with self.lock:
+            data = bytes(buffer[:min(size, self.chunk_size)])
+            del buffer[:len(data)]
+        return data
+
+    def recv_ready(self) -> bool:
+        return bool(self.buffers[0])
+
+    def recv_stderr_ready(self) -> bool:
+        return bool(self.buffers[1])
+
+    def recv(self, size: int) -> bytes:
+        return self._recv(self.buffers[0], size)
+
+    def recv_stderr(self, size: int) -> bytes:
+        return self._recv(self.buffers[1], size)
+
+    def exit_status_ready(self) -> bool:
+        # like ssh, the exit status comes after all the output
+        return self.process.poll() is not None and not any(
+            reader.is_alive() for reader in self.readers)
+
+    def recv_exit_status(self) -> int:
+        return self.process.wait()
+
+    def sendall(self, data: bytes) -> None:
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def shutdown_write(self) -> None:
+        self.process.stdin.close()
+
+    def close(self) -> None:
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process.stdout.close()
+        self.process.stderr.close()
+
+
+class LocalClient:
+    """ Runs the commands of `exec_command` on this host, with `path_dirs` first in the PATH. """
+
+    def __init__(self, path_dirs: list = (STUBS_DIR,), chunk_size: int = 32768):
+        self.path_dirs = list(path_dirs)
+        self.chunk_size = chunk_size
+
+    def exec_command(self, command: str) -> tuple:
+        channel = LocalChannel(command, self.path_dirs, self.chunk_size)
+        return None, SimpleNamespace(channel=channel), None
+
+
+class LateChannel:
+    """ A channel whose last output and exit status arrive while `_receive` checks its stderr. """
+
+    def __init__(self):
+        self.data = b""
+        self.exited = False
+
+    def recv_ready(self) -> bool:
+        return bool(self.data)
+
+    def recv_stderr_ready(self) -> bool:
+        if not self.exited:
+            self.data, self.exited = b"last line\n", True
+        return False
+
+    def recv(self, size: int) -> bytes:
+        data, self.data = self.data, b""
+        return data
+
+    def exit_status_ready(self) -> bool:
+        return self.exited
+
+    def recv_exit_status(self) -> int:
+        return 0
+
+    def close(self) -> None:
+        ...
+
+
+class ReceiveTest(unittest.TestCase):
+
+    def test_output_coming_with_the_exit_status_is_read(self):
+        channel = LateChannel()
+        client = SimpleNamespace(exec_command=lambda command: (
+            mock.Mock(), SimpleNamespace(channel=channel, close=lambda: None), mock.Mock()))
+        self.assertEqual(stream_command(logger, False, client, "true"), ("last line\n", "", 0))
+
+
+class SudoSessionTest(unittest.TestCase):
+
+    def run_session(self, commands: list, chunk_size: int = 32768) -> list:
+        """ Runs `commands` in one session, returns the (stdout, stderr, exit code) of each. """
+        session = SudoSession(LocalClient(chunk_size=chunk_size), "pw", logger)
+        self.assertEqual(session.state, "ready")
+        results = []
+        try:
+            for command in commands:
+                out, err = _LineBuffer("stdout", None), _LineBuffer("stderr", None)
+                exit_code = session.run(command, out, err, SimpleNamespace(bytes=0))
+                out.close()
+                err.close()
+                results.append((out.text(), err.text(), exit_code))
+        finally:
+            session.close()
+        return results
+
+    def test_outputs_and_exit_codes(self):
+        self.assertEqual(self.run_session(["echo a; echo b >&2", "exit 3", "echo c"]),
+                         [("a\n", "b\n", 0), ("", "", 3), ("c\n", "", 0)])
+
+    def test_markers_split_across_reads(self):
+        commands = ["echo out; echo err >&2", "printf 'x%.0s' $(seq 1 100); false"]
+        for chunk_size in (1, 3, 7):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.run_session(commands, chunk_size),
+                                 [("out\n", "err\n", 0), ("x" * 100, "", 1)])
+
+    def test_output_without_trailing_newline(self):
+        self.assertEqual(self.run_session(["printf a; printf b >&2", "printf c"], 5),
+                         [("a", "b", 0), ("c", "", 0)])
+
+    def test_wrong_password(self):
+        session = SudoSession(LocalClient(), "wrong", logger)
+        self.assertEqual(session.state, "incorrect")
+        session.close()
+
+    def test_silent_sudo_times_out(self):
+        with tempfile.TemporaryDirectory() as stubs:
+            with open(path.join(stubs, "sudo"), "w") as sudo:
+                sudo.write("#!/bin/sh\nexec sleep 30\n")
+            os.chmod(path.join(stubs, "sudo"), stat.S_IRWXU)
+            with mock.patch.object(tools, "SUDO_AUTH_TIMEOUT", 0.3):
+                session = SudoSession(LocalClient([stubs]), "pw", logger)
+        self.assertEqual(session.state, "failed")
+
+
+if __name__ == "__main__":
+    unittest.main()